@@ -20,7 +20,24 @@ individual process memory usage, and offers the ability to display this informat
 '''
 
 import argparse
+import csv
+import errno
+import gzip
+import io
+import json
+import math
 import os, sys
+import heapq
+import re
+import resource
+import socket
+import struct
+import subprocess
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 def parse_command_args() -> object:
     "The function will return an object (argparse.Namespace).It is designed to parse command-line arguments when called in the main function."
@@ -37,16 +54,588 @@ def parse_command_args() -> object:
     # This adds the argument for `-l` and `--length`. `type=int`: Specifies that the argument expects an integer value. `default=20`: If the user doesn't provide a value for `-l`, the default value of `20` will be used.
     # `help`: This shows a description of what the argument does.
 
-    parser.add_argument("program", type=str, nargs='?', help="If a program is specified, show memory use of all associated processes. Show only total use if not.")
+    parser.add_argument("-m", "--match", choices=ProcessIndex.MATCH_MODES, default="exact", help="How to match the program name against process names. Default is exact.")
+    # This adds the argument for `-m` and `--match`. `choices` limits the value to exact, prefix or regex.
+
+    parser.add_argument("-r", "--rss-source", choices=RSS_SOURCES, default="rollup", help="Where to read process RSS from: rollup (smaps_rollup), statm (fastest) or smaps (slowest, per mapping). Default is rollup.")
+    # This adds the argument for `-r` and `--rss-source`, trading accuracy for speed when reading each process.
+
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of threads used to read process memory. 0 picks a size for this machine. Default is 1 (serial).")
+    # This adds the argument for `-w` and `--workers`, the size of the thread pool used by collect_rss().
+
+    parser.add_argument("-t", "--timing", action="store_true", help="Show how long reading process memory took, compared with a serial read when using workers.")
+    # This adds the argument for `-t` and `--timing`. Like `-H` it is a flag, so it is either True or False.
+
+    parser.add_argument("-P", "--pss", action="store_true", help="Also account PSS and USS, so memory shared between processes is not counted once per process.")
+    # This adds the argument for `-P` and `--pss`. Shared pages are split between processes (PSS) or left out (USS).
+
+    parser.add_argument("--mappings", type=int, metavar="N", help="With a program, show the N mappings (files, [heap], [stack], [anon], [shmem]) holding the most of its memory.")
+    # This adds the `--mappings` option. It reads the full smaps of every process of the program.
+
+    parser.add_argument("-n", "--top", type=int, metavar="N", help="When no program is given, show the N programs using the most memory.")
+    # This adds the argument for `-n` and `--top`. When it is not given `args.top` is None.
+
+    parser.add_argument("-o", "--output", choices=OUTPUT_FORMATS, default="text", help="Output format. json, ndjson and csv write machine readable records. Default is text.")
+    # This adds the argument for `-o` and `--output`. `choices` limits it to the formats RecordWriter knows.
+
+    parser.add_argument("--per-pid", action="store_true", help="With a program and a structured --output, also write one record per process.")
+    # This adds the `--per-pid` flag for the per process breakdown.
+
+    parser.add_argument("--pressure", action="store_true", help="Also show swap, page cache, memory pressure (PSI) and VM event rates from meminfo, /proc/pressure/memory and /proc/vmstat.")
+    # This adds the `--pressure` option. With --watch the rates are per second since the previous frame, otherwise since boot.
+
+    parser.add_argument("-c", "--cgroup", action="store_true", help="Report total and available memory against this process's cgroup v2 limit instead of the host's RAM.")
+    parser.add_argument("--cgroups", type=int, metavar="DEPTH", help="Show the memory of every cgroup down to DEPTH levels below the root, read from cgroup counters.")
+    parser.add_argument("--cgroup-root", default=CGROUP_ROOT, metavar="DIR", help=f"Where the cgroup v2 hierarchy is mounted. Default is {CGROUP_ROOT}.")
+    # These add the cgroup options. Inside a container MemTotal is the host's, the container's real limit is in memory.max.
+
+    parser.add_argument("--profile", action="store_true", help="Print where the run spent its time (per stage) and how many files and bytes it read, on stderr.")
+    parser.add_argument("--profile-format", choices=("text", "json"), default="text", help="Write the --profile summary as a text table or as one JSON object. Default is text.")
+    # These add the profiling options. Without --profile nothing is timed or counted.
+
+    parser.add_argument("--proc-root", default="/proc", metavar="DIR", help="Read process and memory information from DIR instead of /proc, e.g. a host /proc mounted in a container.")
+    # This adds the `--proc-root` option, the directory every reader treats as /proc.
+
+    parser.add_argument("--record", metavar="FILE", help="Save everything read during this run to FILE (JSON, gzip if it ends in .gz) for --replay.")
+    parser.add_argument("--replay", metavar="FILE", help="Read from a snapshot saved with --record instead of /proc.")
+    # These add `--record` and `--replay`, so a run can be captured and rerun offline later.
+
+    parser.add_argument("--history", type=int, default=600, metavar="SAMPLES", help="Samples kept in memory per metric for --history-window. Default is 600.")
+    parser.add_argument("--history-log", metavar="FILE", help="Append every sample to the binary log FILE (rotated to FILE.1, FILE.2, FILE.3) and load it on start.")
+    parser.add_argument("--history-log-max", type=int, default=8 * 1024 * 1024, metavar="BYTES", help="Rotate the history log once it reaches BYTES. Default is 8 MiB.")
+    parser.add_argument("--history-window", type=float, metavar="SECONDS", help="Show min/avg/max bars for each metric over the last SECONDS.")
+    # These add the history options. Memory use is fixed by --history, and the log on disk by --history-log-max.
+
+    parser.add_argument("--leaks", action="store_true", help="With --watch and a program, flag processes whose memory (PSS with --pss) grows steadily, and show which mappings grew.")
+    parser.add_argument("--leak-rate", type=float, default=10240, metavar="KB_PER_HOUR", help="Growth that counts as a leak. Default is 10240 (10 MiB/h).")
+    parser.add_argument("--leak-samples", type=int, default=10, metavar="N", help="Frames a process must be watched for before it can be flagged. Default is 10.")
+    # These add the leak options. Each process keeps a running regression line, not its samples, and older samples weigh less.
+
+    parser.add_argument("--meta-cache", type=int, default=4096, metavar="ENTRIES", help="With --watch, remember the names of up to ENTRIES processes between redraws (keyed by PID and start time). 0 turns it off. Default is 4096.")
+    # This adds the `--meta-cache` option. A PID that is reused gets a new start time, so its names are read again.
+
+    parser.add_argument("--alert", action="append", metavar="RULE", help="With --watch, alert on a rule such as 'system.used > 90%% for 30s' or 'rate(rss:nginx) > 100MiB/min'. Can be repeated.")
+    parser.add_argument("--alert-hysteresis", type=float, default=0.05, metavar="FRACTION", help="A firing alert resolves only once the value is this fraction back past its threshold. Default is 0.05.")
+    parser.add_argument("--alert-cooldown", type=float, default=300.0, metavar="SECONDS", help="Minimum time between two firings of the same rule. Default is 300.")
+    parser.add_argument("--alert-exec", metavar="COMMAND", help="Run COMMAND for every alert, with ALERT_RULE, ALERT_STATE, ALERT_METRIC and ALERT_VALUE set and the event as JSON on stdin.")
+    parser.add_argument("--alert-to", metavar="TARGET", help="Append every alert as a JSON line to a file, or send it to unix:PATH, tcp:HOST:PORT or udp:HOST:PORT.")
+    # These add the alert options. Rules use the history metrics: system.used, system.available, rss:<program>, pss:<program>,
+    # and with --pressure swap.used, psi.some.avg10, psi.full.avg10 and rate.<vm event> (e.g. rate.pgmajfault).
+
+    parser.add_argument("--watch", type=float, metavar="INTERVAL", help="Keep running and redraw the report every INTERVAL seconds.")
+    # This adds the `--watch` option. When it is not given `args.watch` is None and the report is printed once.
+
+    parser.add_argument("--serve", type=int, metavar="PORT", help="Serve system and program memory as Prometheus metrics on http://HOST:PORT/metrics.")
+    parser.add_argument("--serve-interval", type=float, default=15.0, metavar="SECONDS", help="With --serve, collect every SECONDS; scrapes get the last collection. Default is 15.")
+    parser.add_argument("--serve-bind", default="", metavar="ADDRESS", help="With --serve, the address to listen on. Default is every address.")
+    # These add the exporter options. The program, or --top N, picks which programs are exported.
+
+    parser.add_argument("-T", "--tree", action="store_true", help="With a program, also count every process it started (whatever its name) and show them as an indented tree.")
+    # This adds the `--tree` option. Parents come from /proc/<pid>/stat, read once per process.
+
+    parser.add_argument("-g", "--group-file", metavar="FILE", help="Report program groups read from FILE, one per line such as 'web = nginx,php-fpm'.")
+    # This adds the `--group-file` option. All the groups are answered from one meminfo read and one scan of /proc.
+
+    parser.add_argument("program", type=str, nargs='?', help="If a program is specified, show memory use of all associated processes. Several programs can be separated by commas. Show only total use if not.")
     # This adds the positional argument `program` and `nargs='?'`: means the argument is optional, and if not provided, it will be `None`. `type=str`: Specifies that the argument expects a string (the program name).
     # `help`: Describes what this argument does.
 
     args = parser.parse_args() # Calls `parse_args()` to parse the command-line arguments provided by the user.
     # It returns an object containing the parsed arguments which is stored as attributes.
 
+    args.program_groups = None # {group name: [program names]} when more than one program is asked for
+    if args.group_file or (args.program and ',' in args.program):
+        names = [name.strip() for name in (args.program or '').split(',')]
+        args.program_groups = {name: [name] for name in names if name} # each listed program is its own group
+        if args.group_file:
+            try:
+                with open(args.group_file, 'r') as f:
+                    args.program_groups.update(read_program_groups(f))
+            except (OSError, ValueError) as e:
+                parser.error(f"--group-file: {e}")
+        args.program = None # the single program report is not used for a batch
+        if args.mappings or args.tree:
+            parser.error("--mappings and --tree need a single program")
+
+    if args.tree and not args.program:
+        parser.error("--tree needs a program")
+    if args.workers < 0:
+        parser.error("--workers cannot be negative")
+    if args.top is not None and args.top < 1:
+        parser.error("--top N must be at least 1")
+    if args.mappings is not None and args.mappings < 1:
+        parser.error("--mappings N must be at least 1")
+    if args.watch is not None and args.watch <= 0: # A zero interval would spin the CPU instead of watching
+        parser.error("--watch INTERVAL must be greater than 0")
+    if args.cgroups is not None and args.cgroups < 0:
+        parser.error("--cgroups DEPTH cannot be negative")
+    if args.serve is not None and not 0 <= args.serve <= 65535:
+        parser.error("--serve PORT must be between 0 and 65535")
+    if args.serve is not None and (args.watch is not None or args.output != 'text'):
+        parser.error("--serve cannot be combined with --watch or --output")
+    if args.serve_interval <= 0:
+        parser.error("--serve-interval SECONDS must be greater than 0")
+    if args.alert and args.watch is None:
+        parser.error("--alert needs --watch")
+    if args.alert:
+        try: # parse the rules now, so a typo is reported before watching starts
+            args.alert = [AlertRule(rule, args.alert_hysteresis, args.alert_cooldown) for rule in args.alert]
+        except ValueError as e:
+            parser.error(str(e))
+    if args.leaks and (args.watch is None or not args.program or not args.meta_cache):
+        parser.error("--leaks needs --watch, a single program and the --meta-cache")
+    if args.leak_samples < 2:
+        parser.error("--leak-samples N must be at least 2")
+    if args.meta_cache < 0:
+        parser.error("--meta-cache ENTRIES cannot be negative")
+    if args.history < 1:
+        parser.error("--history SAMPLES must be at least 1")
+    if args.history_window is not None and args.watch is None and not args.history_log:
+        parser.error("--history-window needs --watch or --history-log, a single run has no history to show")
+    if args.replay and (args.record or args.proc_root != "/proc"): # A replay does not read any directory
+        parser.error("--replay cannot be combined with --record or --proc-root")
+
     return args # returns the `args` object, which contains the parsed command-line arguments.
 
 
+#------------------------------------------------------------DATA SOURCES----------------------------------------------------------------------
+OUT_OF_FILES = (errno.EMFILE, errno.ENFILE) # open() failing with these says nothing about the process being read
+
+
+def fd_budget(share: int=4) -> int:
+    "return how many descriptors a ProcFileCache may hold: a share of RLIMIT_NOFILE, so the process keeps room for everything else it opens"
+    soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if soft == resource.RLIM_INFINITY:
+        return 1024
+    return max(16, min(1024, soft // share))
+
+
+def read_failed(message: str, e: OSError, quiet: bool=False) -> None:
+    "print why a /proc read failed; quiet only hides a process that went away, running out of descriptors is always an error"
+    if e.errno in OUT_OF_FILES:
+        print(f"{message}: {e} (out of file descriptors, not a process that exited)", file=sys.stderr)
+    elif not quiet:
+        print(f"{message}: {e}")
+
+
+class ProcFileCache:
+    "keeps small /proc files open so repeated reads cost a seek instead of an open"
+
+    def __init__(self, limit: int=None) -> None:
+        self.limit = limit if limit is not None else fd_budget() # never hold more than this many descriptors open
+        self.files = {} # path -> open file object, least recently read first
+        self.per_pid = True # False when the watched processes would not fit, then only system wide files stay open
+        self.lock = threading.Lock() # collect_rss() may read from several threads at once, and eviction closes files
+
+    def read(self, path: str) -> str:
+        "return the whole current contents of path, reusing an open descriptor when there is one"
+        # the lock only covers the dict: a file is taken out while it is read, so reads run in parallel
+        # and another thread's eviction can never close a file mid-read
+        with self.lock:
+            f = self.files.pop(path, None)
+        if f is not None:
+            try:
+                f.seek(0) # /proc regenerates the contents on every read from the start
+                text = f.read()
+            except OSError: # the process behind this file has exited
+                f.close()
+                raise
+        else:
+            with self.lock: # make room before opening, not after
+                self._evict(self.limit - 1)
+            try:
+                f = open(path, 'r')
+            except OSError as e:
+                if e.errno not in OUT_OF_FILES or not self.files:
+                    raise
+                self.close_all() # something else holds the descriptors, give ours back and try once more
+                f = open(path, 'r')
+            try:
+                text = f.read()
+            except OSError:
+                f.close()
+                raise
+        with self.lock:
+            duplicate = self.files.pop(path, None) # another thread opened the same file meanwhile
+            self._evict(self.limit - 1)
+            self.files[path] = f # back in as the most recently read
+        if duplicate is not None:
+            duplicate.close()
+        return text
+
+    def _evict(self, keep: int) -> None:
+        "close the least recently read files until at most keep are open, the caller holds the lock"
+        while len(self.files) > keep:
+            self.files.pop(next(iter(self.files))).close()
+
+    def close(self, path: str) -> None:
+        "close and forget one cached file"
+        with self.lock:
+            f = self.files.pop(path, None)
+        if f is not None:
+            f.close()
+
+    def forget(self, prefix: str) -> None:
+        "close every cached file whose path starts with prefix, e.g. the directory of a process that has gone away"
+        for path in [path for path in list(self.files) if path.startswith(prefix)]:
+            self.close(path)
+
+    def close_all(self) -> None:
+        with self.lock:
+            self._evict(0)
+
+
+class ProcSource:
+    "where /proc data comes from: the live /proc, or another directory laid out like it (a container, a mounted host /proc)"
+
+    def __init__(self, root: str="/proc", keep_open: bool=False) -> None:
+        self.root = root.rstrip('/') or '/'
+        self.files = ProcFileCache() if keep_open else None # only --watch keeps descriptors open between ticks
+
+    def path(self, rel: str) -> str:
+        "turn a path relative to /proc (e.g. '1234/statm') into a real path"
+        return f'{self.root}/{rel}'
+
+    def open(self, rel: str, errors: str=None) -> object:
+        "open a file for streaming line by line, such as a large smaps"
+        def _open() -> object:
+            if errors is None:
+                return open(self.path(rel), 'r')
+            return open(self.path(rel), 'r', errors=errors)
+        try:
+            return _open()
+        except OSError as e:
+            if e.errno not in OUT_OF_FILES or not self.files or not self.files.files:
+                raise
+            self.files.close_all() # the kept-open files are the descriptors we can give back
+            return _open()
+
+    def read(self, rel: str, errors: str=None) -> str:
+        "return the whole contents of a small file"
+        with ProcSource.open(self, rel, errors) as f: # not self.open(), subclasses build open() on top of read()
+            return f.read()
+
+    def reread(self, rel: str) -> str:
+        "read a small file that is polled every tick (meminfo, statm, smaps_rollup), through a kept-open descriptor when there is a cache"
+        if self.files is not None and (self.files.per_pid or not rel[:1].isdigit()):
+            return self.files.read(self.path(rel))
+        return self.read(rel)
+
+    def keep_pids_open(self, count: int) -> None:
+        "keep per-PID files open only while count processes fit in the cache; more would just reopen every file every tick"
+        if self.files is None:
+            return
+        fits = count <= self.files.limit // 2 # leave the other half for meminfo, vmstat and new processes
+        if self.files.per_pid and not fits:
+            for path in list(self.files.files):
+                if path[len(self.root) + 1:][:1].isdigit():
+                    self.files.close(path)
+        self.files.per_pid = fits
+
+    def listdir(self, rel: str) -> tuple:
+        "return (subdirectories, files) of a directory, both sorted"
+        dirs, files = [], []
+        for entry in os.scandir(self.path(rel)):
+            (dirs if entry.is_dir(follow_symlinks=False) else files).append(entry.name)
+        return sorted(dirs), sorted(files)
+
+    def pids(self) -> list:
+        "return the PIDs that exist right now"
+        return [entry.name for entry in os.scandir(self.root) if entry.name.isdigit()] # only the numbered directories are processes
+
+    def forget_pid(self, pid: str) -> None:
+        "close any kept-open files of a process that has gone away"
+        if self.files is not None:
+            self.files.forget(self.path(f'{pid}/'))
+
+    def close(self) -> None:
+        if self.files is not None:
+            self.files.close_all()
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.root!r})"
+
+
+class RecordingSource(ProcSource):
+    "reads like ProcSource and keeps a copy of everything read, so the run can be saved and replayed with RecordedSource"
+
+    def __init__(self, root: str="/proc") -> None:
+        super().__init__(root)
+        self.captured = {} # path relative to root -> text, or the errno the read failed with
+        self.listings = {} # directory relative to root -> [subdirectories, files], or the errno
+        self.pid_list = []
+        self.attached = {} # name -> RecordingSource of another tree saved in the same snapshot, e.g. 'cgroups'
+
+    def read(self, rel: str, errors: str=None) -> str:
+        try:
+            text = super().read(rel, errors)
+        except OSError as e:
+            self.captured[rel] = e.errno
+            raise
+        self.captured[rel] = text
+        return text
+
+    def open(self, rel: str, errors: str=None) -> object:
+        return io.StringIO(self.read(rel, errors))
+
+    def reread(self, rel: str) -> str:
+        return self.read(rel)
+
+    def listdir(self, rel: str) -> tuple:
+        try:
+            listing = super().listdir(rel)
+        except OSError as e:
+            self.listings[rel] = e.errno
+            raise
+        self.listings[rel] = listing
+        return listing
+
+    def pids(self) -> list:
+        self.pid_list = super().pids()
+        return self.pid_list
+
+    def attach(self, name: str, source: 'RecordingSource') -> 'RecordingSource':
+        "save what source reads in this snapshot too, under name; returns source"
+        self.attached[name] = source
+        return source
+
+    def contents(self) -> dict:
+        return {'root': self.root, 'pids': self.pid_list, 'files': self.captured, 'dirs': self.listings}
+
+    def save(self, path: str) -> None:
+        "write what was read to path as JSON (gzip compressed when path ends in .gz)"
+        snapshot = {'version': 1, 'time': round(time.time(), 3), **self.contents()}
+        snapshot.update((name, source.contents()) for name, source in self.attached.items())
+        with (gzip.open(path, 'wt') if path.endswith('.gz') else open(path, 'w')) as f:
+            json.dump(snapshot, f)
+
+
+class RecordedSource(ProcSource):
+    "replays a snapshot saved by RecordingSource (--record), so reports can be rerun offline"
+
+    def __init__(self, path: str, snapshot: dict=None) -> None:
+        "snapshot is an already loaded part of a recording, see attached()"
+        super().__init__(f"recording:{path}")
+        if snapshot is None:
+            with (gzip.open(path, 'rt') if path.endswith('.gz') else open(path, 'r')) as f:
+                snapshot = json.load(f)
+        self.snapshot = snapshot
+        self.captured = snapshot['files']
+        self.listings = snapshot.get('dirs', {}) # recordings made before cgroups were recorded have none
+        self.pid_list = snapshot.get('pids', [])
+
+    def attached(self, name: str) -> 'RecordedSource':
+        "the tree recorded alongside this one under name (e.g. 'cgroups'); empty, so every read fails, if it was not recorded"
+        return RecordedSource(f"{self.root.partition(':')[2]}#{name}", self.snapshot.get(name, {'files': {}}))
+
+    def read(self, rel: str, errors: str=None) -> str:
+        text = self.captured.get(rel, errno.ENOENT) # anything not recorded behaves like a process that has gone
+        if isinstance(text, int):
+            raise OSError(text, os.strerror(text), rel) # OSError picks the matching subclass, e.g. FileNotFoundError
+        return text
+
+    def open(self, rel: str, errors: str=None) -> object:
+        return io.StringIO(self.read(rel))
+
+    def reread(self, rel: str) -> str:
+        return self.read(rel)
+
+    def listdir(self, rel: str) -> tuple:
+        listing = self.listings.get(rel, errno.ENOENT)
+        if isinstance(listing, int):
+            raise OSError(listing, os.strerror(listing), rel)
+        return tuple(listing)
+
+    def pids(self) -> list:
+        return list(self.pid_list)
+
+
+LIVE_PROC = ProcSource() # used whenever a function is not given a source
+
+
+#------------------------------------------------------------PROFILING----------------------------------------------------------------------
+class Stage:
+    "times one pass through a stage of a Profile, used as a with block"
+    __slots__ = ('profile', 'name', 'started')
+
+    def __init__(self, profile: 'Profile', name: str) -> None:
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self) -> 'Stage':
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.profile.add_time(self.name, time.perf_counter() - self.started)
+
+
+class Profile:
+    "what --profile measures: wall clock time per stage, and files opened and bytes read per kind of /proc file"
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.stages = {} # stage name -> [seconds, passes], in the order stages first ran
+        self.files = {} # file kind (e.g. 'statm') -> [opens, reads, bytes, failures]
+        self.caches = {} # cache name -> [hits, misses], e.g. the MetaCache of a watch
+        self.lock = threading.Lock() # files are read from the collector threads too
+
+    def stage(self, name: str) -> Stage:
+        return Stage(self, name)
+
+    def add_time(self, name: str, seconds: float) -> None:
+        entry = self.stages.setdefault(name, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += 1
+
+    def read(self, rel: str, nbytes: int, opened: bool=True) -> None:
+        "count one read of nbytes from rel (relative to the source root); opened is False for a kept-open descriptor"
+        kind = rel.rsplit('/', 1)[-1]
+        with self.lock:
+            entry = self.files.setdefault(kind, [0, 0, 0, 0])
+            entry[0] += opened
+            entry[1] += 1
+            entry[2] += nbytes
+
+    def failed(self, rel: str) -> None:
+        "count a file that could not be opened or read (a process that exited, or one we may not read)"
+        with self.lock:
+            self.files.setdefault(rel.rsplit('/', 1)[-1], [0, 0, 0, 0])[3] += 1
+
+    def cache(self, name: str, hits: int, misses: int) -> None:
+        "record how often a cache answered (hits) or had to read (misses)"
+        self.caches[name] = [hits, misses]
+
+    def as_dict(self) -> dict:
+        return {'total_ms': round((time.perf_counter() - self.started) * 1000, 3),
+                'stages': {name: {'ms': round(seconds * 1000, 3), 'passes': passes} for name, (seconds, passes) in self.stages.items()},
+                'files': {kind: {'opened': opened, 'reads': reads, 'bytes': nbytes, 'failed': failed}
+                          for kind, (opened, reads, nbytes, failed) in sorted(self.files.items())},
+                'caches': {name: {'hits': hits, 'misses': misses} for name, (hits, misses) in self.caches.items()}}
+
+    def summary(self) -> list:
+        "return the lines of the --profile text summary"
+        data = self.as_dict()
+        lines = [f"Profile: {data['total_ms']:.2f} ms in total", f"{'stage':<16} {'ms':>10} {'passes':>7}"]
+        lines += [f"{name:<16} {stage['ms']:>10.3f} {stage['passes']:>7}" for name, stage in data['stages'].items()]
+        lines.append(f"{'file':<16} {'opened':>10} {'reads':>7} {'bytes':>12} {'failed':>7}")
+        lines += [f"{kind:<16} {f['opened']:>10} {f['reads']:>7} {f['bytes']:>12} {f['failed']:>7}" for kind, f in data['files'].items()]
+        totals = [sum(f[key] for f in data['files'].values()) for key in ('opened', 'reads', 'bytes', 'failed')]
+        lines.append(f"{'all files':<16} {totals[0]:>10} {totals[1]:>7} {totals[2]:>12} {totals[3]:>7}")
+        if data['caches']:
+            lines.append(f"{'cache':<16} {'hits':>10} {'misses':>7}")
+            lines += [f"{name:<16} {c['hits']:>10} {c['misses']:>7}" for name, c in data['caches'].items()]
+        return lines
+
+
+class NullProfile:
+    "the Profile used without --profile: every call does nothing, and /proc is not wrapped at all"
+
+    def stage(self, name: str) -> 'NullProfile':
+        return self
+
+    def cache(self, name: str, hits: int, misses: int) -> None:
+        pass
+
+    def __enter__(self) -> 'NullProfile':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+
+NO_PROFILE = NullProfile()
+
+
+class CountedFile:
+    "a file opened through a ProfiledSource, counting what is read before it is closed"
+
+    def __init__(self, f: object, profile: Profile, rel: str) -> None:
+        self.f = f
+        self.profile = profile
+        self.rel = rel
+        self.nbytes = 0
+        self.reads = 0
+
+    def __iter__(self):
+        for line in self.f:
+            self.nbytes += len(line)
+            yield line
+
+    def read(self, size: int=-1) -> str:
+        text = self.f.read(size)
+        self.nbytes += len(text)
+        return text
+
+    def close(self) -> None:
+        if self.f is not None:
+            self.f.close()
+            self.profile.read(self.rel, self.nbytes)
+            self.f = None
+
+    def __enter__(self) -> 'CountedFile':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class ProfiledSource(ProcSource):
+    "wraps another source (live, recording or replay) and counts every file it opens and every byte read, for --profile"
+
+    def __init__(self, inner: ProcSource, profile: Profile) -> None:
+        self.inner = inner
+        self.profile = profile
+        self.root = inner.root
+        self.files = inner.files
+
+    def __getattr__(self, name: str) -> object:
+        return getattr(self.inner, name) # e.g. save() of a RecordingSource
+
+    def path(self, rel: str) -> str:
+        return self.inner.path(rel)
+
+    def open(self, rel: str, errors: str=None) -> object:
+        try:
+            return CountedFile(self.inner.open(rel, errors), self.profile, rel)
+        except OSError:
+            self.profile.failed(rel)
+            raise
+
+    def read(self, rel: str, errors: str=None) -> str:
+        try:
+            text = self.inner.read(rel, errors)
+        except OSError:
+            self.profile.failed(rel)
+            raise
+        self.profile.read(rel, len(text))
+        return text
+
+    def reread(self, rel: str) -> str:
+        cached = self.files is not None and self.path(rel) in self.files.files # already open, this read is a seek
+        try:
+            text = self.inner.reread(rel)
+        except OSError:
+            self.profile.failed(rel)
+            raise
+        self.profile.read(rel, len(text), not cached)
+        return text
+
+    def pids(self) -> list:
+        pids = self.inner.pids()
+        self.profile.read('(pid list)', 0)
+        return pids
+
+    def forget_pid(self, pid: str) -> None:
+        self.inner.forget_pid(pid)
+
+    def close(self) -> None:
+        self.inner.close()
+
+    def __repr__(self) -> str:
+        return f"ProfiledSource({self.inner!r})"
+
+
 #---------------------------------------------------------------MILESTONE 1------------------------------------------------------------------------------------------------------
 
 def percent_to_graph(percent: float, length: int=20) -> str:
@@ -59,84 +648,682 @@ def percent_to_graph(percent: float, length: int=20) -> str:
 
     return '#' * num_hashes + ' ' * num_spaces # This constructs and returns the bar graph
 
-def get_sys_mem() -> int:
-    "return total system memory (used or available) in kB"
+class MemInfo:
+    "a snapshot of every field in /proc/meminfo, all taken from the same read (values in kB)"
+    __slots__ = ('fields',) # only one attribute per snapshot, so no per-instance __dict__ is created
+
+    def __init__(self, fields: dict) -> None:
+        "fields maps a meminfo key (e.g. 'MemTotal') to its integer value"
+        self.fields = fields
+
+    def __getitem__(self, key: str) -> int:
+        return self.fields[key]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.fields
+
+    def get(self, key: str, default: int=0) -> int:
+        "return the value of a meminfo field, or default if this kernel does not report it"
+        return self.fields.get(key, default)
+
+    @property
+    def total(self) -> int:
+        return self.fields['MemTotal']
+
+    @property
+    def available(self) -> int:
+        return self.fields['MemAvailable']
+
+    @property
+    def used(self) -> int:
+        return self.total - self.available
+
+    def __repr__(self) -> str:
+        return f"MemInfo(total={self.get('MemTotal')}, available={self.get('MemAvailable')}, fields={len(self.fields)})"
+
+
+def parse_meminfo(lines) -> MemInfo:
+    "build a MemInfo from an iterable of meminfo lines such as 'MemTotal:  16318480 kB'"
+    fields = {}
+    for line in lines:
+        key, sep, rest = line.partition(':') # the key is everything before the first colon
+        if not sep:
+            continue # skip anything that is not a 'Key: value' line
+        value = rest.split()
+        if value:
+            fields[key.strip()] = int(value[0]) # the unit ('kB') is dropped, HugePages_* counts have no unit
+    return MemInfo(fields)
+
+
+def read_meminfo(proc: ProcSource=None) -> MemInfo:
+    "read /proc/meminfo once and return a MemInfo snapshot, None if it cannot be read"
+    proc = proc if proc is not None else LIVE_PROC
     try:
-        with open("/proc/meminfo", "r") as meminfo_file: #This code opens the /proc/meminfo file in read only mode and we name the file meminfo_file
-            # The below code helps us read the file line by line
-            for line in meminfo_file:
-                # This checks if the lines contain "MemTotal"
-                if "MemTotal" in line:
-                    # The below captures the memory value and converts it to an integer and return it
-                    total_memory = int(line.split()[1])  # we split the output and the second element,  the memory value is converted to an integer and then is returned as total_memory
-                    return total_memory
+        # one read gives every field from the same moment, --watch keeps the descriptor open for the next tick
+        return parse_meminfo(proc.reread("meminfo").splitlines())
     except FileNotFoundError: #this is here in case we do not find the meminfo file
-        print("Error: /proc/meminfo file not found.")
+        print(f"Error: {proc.path('meminfo')} file not found.")
         return None
-    except Exception as e: # this is here in case any other error other than the file not found happens 
+    except Exception as e: # this is here in case any other error other than the file not found happens
         print(f"An error occurred: {e}")
         return None
-    
-def get_avail_mem() -> int:
-    "return total memory that is available"
-    try:
-        with open("/proc/meminfo", "r") as meminfo_file: #This code opens the /proc/meminfo file in read only mode and we name the file meminfo_file
-            # to read the file line by line
-            for line in meminfo_file:
-                # to check if the line contains "MemAvailable"
-                if "MemAvailable" in line:
-                    # The below captures the memory value and converts it to an integer and return it
-                    available_memory = int(line.split()[1])  # we split the output and the second element,  the memory value is converted to an integer and then is returned as available_memory
-                    return available_memory
-    except FileNotFoundError: #this is here in case we do not find the meminfo file
-        print("Error: /proc/meminfo file not found.")
+
+
+def get_sys_mem(snapshot: MemInfo=None, proc: ProcSource=None) -> int:
+    "return total system memory (used or available) in kB"
+    if snapshot is None: # read a fresh snapshot unless the caller already has one
+        snapshot = read_meminfo(proc)
+    if snapshot is None or 'MemTotal' not in snapshot:
         return None
-    except Exception as e: # this is here in case any other error other than the file not found happens 
-        print(f"An error occurred: {e}")
+    return snapshot.total
+
+def get_avail_mem(snapshot: MemInfo=None, proc: ProcSource=None) -> int:
+    "return total memory that is available"
+    if snapshot is None: # read a fresh snapshot unless the caller already has one
+        snapshot = read_meminfo(proc)
+    if snapshot is None or 'MemAvailable' not in snapshot:
         return None
+    return snapshot.available
 
 #------------------------------------------------------------MILESTONE 2----------------------------------------------------------------------
-def pids_of_prog(app_name: str) -> list:
-    " This function takes an app name (a string) as input and returns a list of process IDs (PIDs) associated with the given app name."
+class ProcessMeta:
+    "what is known about one run of a process: its names, cmdline, last mapping layout and whether its memory could be read"
+    __slots__ = ('starttime', 'names', 'cmdline', 'layout', 'memory', 'unreadable', 'retry', 'trend')
 
-    try:
-        pid_output = os.popen(f"pidof {app_name}").read().strip() #The `os.popen()` function is used to run the shell command `pidof {app_name}` and capture the output.
-        # `pidof {app_name}` returns the PIDs of the running processes that match the provided app name.`.read()` reads the command's output, and `.strip()` removes any leading or trailing whitespace and including newlines.
-        
-        if pid_output: # what this does is if `pid_output` is not empty ,split the output by spaces into a list of PIDs.
-            pid_list = pid_output.split()
+    def __init__(self, starttime: int) -> None:
+        self.starttime = starttime # clock ticks after boot, from /proc/<pid>/stat; a reused PID gets a new one
+        self.names = None # tuple of names, None until read
+        self.cmdline = None
+        self.layout = None # {mapping label: kB} from the last mapping_breakdown(), reused while the process's total stays the same
+        self.memory = None # the last memory reading that was not empty (kB or SmapsTotals)
+        self.unreadable = False # a kernel thread or another user's process, its memory reads as nothing
+        self.retry = 0 # ticks left before reading again a process whose memory read as nothing for another reason, its last reading stands in
+        self.trend = None # Trend of its memory, with --leaks
+
+    def __repr__(self) -> str:
+        return f"ProcessMeta(starttime={self.starttime}, names={self.names})"
+
+
+class MetaCache:
+    "process metadata keyed by (pid, starttime), so a reused PID is never mistaken for the process it used to belong to"
+
+    def __init__(self, proc: ProcSource=None, limit: int=4096) -> None:
+        self.proc = proc if proc is not None else LIVE_PROC
+        self.limit = limit # never hold more than this many processes
+        self.entries = {} # pid (str) -> ProcessMeta, least recently used first
+        self.lock = threading.Lock() # the collectors may look entries up from several threads
+        self.hits = 0
+        self.misses = 0
+        self.layout_hits = 0 # mapping layouts reused because the process's total had not changed
+        self.layout_misses = 0
+
+    def starttime(self, pid: str) -> int:
+        "return field 22 of /proc/<pid>/stat, None if the process is gone"
+        try:
+            text = self.proc.reread(f'{pid}/stat') # kept open in --watch, so a known process costs a seek
+        except OSError:
+            try: # a descriptor kept open for an earlier process with this PID fails, open it afresh
+                text = self.proc.read(f'{pid}/stat')
+            except OSError as e:
+                read_failed(f"Error while reading the start time of PID {pid}", e, quiet=True)
+                return None
+        fields = text.rpartition(')')[2].split() # comm is in parentheses and may itself contain spaces or ')'
+        return int(fields[19]) if len(fields) > 19 else None # fields[0] is field 3 (state)
+
+    def get(self, pid: str) -> ProcessMeta:
+        "return the entry for the process that has pid now, a fresh one if it is new or the PID was reused, None if it is gone"
+        starttime = self.starttime(pid)
+        with self.lock:
+            entry = self.entries.pop(pid, None)
+            reused = entry is not None and entry.starttime != starttime
+            if starttime is not None:
+                if entry is not None and not reused:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                    entry = ProcessMeta(starttime)
+                self.entries[pid] = entry # move to the most recently used end
+                while len(self.entries) > self.limit:
+                    self.entries.pop(next(iter(self.entries)))
+        if reused: # descriptors kept open for the old process would only fail with ESRCH
+            self.proc.forget_pid(pid)
+        return entry if starttime is not None else None
+
+    def peek(self, pid: str) -> ProcessMeta:
+        "return the cached entry without checking starttime, for PIDs a lookup has just validated"
+        return self.entries.get(pid)
+
+    def discard(self, pid: str) -> None:
+        with self.lock:
+            self.entries.pop(pid, None)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class ProcessIndex:
+    "a name -> PIDs index built from one scan of /proc/*/comm and /proc/*/cmdline"
+
+    MATCH_MODES = ('exact', 'prefix', 'regex')
+
+    def __init__(self, proc: ProcSource=None, meta: MetaCache=None) -> None:
+        self.proc = proc if proc is not None else LIVE_PROC
+        self.meta = meta # optional cache, a known process then costs one stat read instead of comm and cmdline
+        self.names = {} # pid (str) -> tuple of names that process answers to
+        self.by_name = {} # name -> set of pids (str) using that name
+
+    def _read(self, rel: str) -> str:
+        "read a small /proc file, empty string if the process went away or we may not read it"
+        try:
+            return self.proc.read(rel, errors='replace')
+        except OSError as e: # FileNotFoundError, ProcessLookupError and PermissionError all mean "skip this one"
+            read_failed(f"Error while reading {rel}", e, quiet=True)
+            return ''
+
+    def names_of_pid(self, pid: str) -> tuple:
+        "return the names a process can be looked up by: its comm and the basename of argv[0]"
+        entry = self.meta.get(pid) if self.meta is not None else None
+        if entry is not None and entry.names is not None:
+            return entry.names # the same process as last time, comm and cmdline are not read again
+        comm = self._read(f'{pid}/comm').strip()
+        cmdline = self._read(f'{pid}/cmdline')
+        argv0 = os.path.basename(cmdline.split('\0', 1)[0]) if cmdline else '' # kernel threads have an empty cmdline
+        if argv0 and argv0 != comm:
+            names = (comm, argv0) if comm else (argv0,)
         else:
-            pid_list = []  # what this does is if the output is empty then it returns an empty list.
-        
-    except Exception as e:
-        # This block handles any exceptions that might occur when executing the command.
-        print(f"Error while fetching PIDs for {app_name}: {e}")
-        # Print the error message if an exception occurs, including the exception message.
-        pid_list = []  # Return an empty list if an error occurs.
+            names = (comm,) if comm else ()
+        if entry is not None:
+            entry.names = names
+            entry.cmdline = cmdline.replace('\0', ' ').strip()
+        return names
+
+    def _list_pids(self) -> list:
+        "return the PIDs currently in /proc, None if it cannot be listed"
+        try:
+            return self.proc.pids()
+        except OSError as e:
+            print(f"Error while scanning {self.proc.root}: {e}")
+            return None
+
+    def scan(self) -> 'ProcessIndex':
+        "walk /proc once and (re)build the whole index, returns self so calls can be chained"
+        self.names = {}
+        self.by_name = {}
+        self.refresh()
+        return self
+
+    def refresh(self) -> tuple:
+        "bring the index up to date, reading names only for new PIDs; returns (added, removed) lists of PIDs"
+        current = self._list_pids()
+        if current is None:
+            return [], []
+        current = set(current)
+        removed = [pid for pid in self.names if pid not in current]
+        for pid in removed:
+            self.remove(pid)
+            if self.meta is not None:
+                self.meta.discard(pid)
+        added = [pid for pid in current if pid not in self.names]
+        for pid in added:
+            self.add(pid, self.names_of_pid(pid))
+        return added, removed
+
+    def add(self, pid: str, names: tuple) -> None:
+        "record that pid answers to each of names"
+        self.names[pid] = names
+        for name in names:
+            self.by_name.setdefault(name, set()).add(pid)
+
+    def remove(self, pid: str) -> None:
+        "drop a process that has exited"
+        for name in self.names.pop(pid, ()):
+            pids = self.by_name.get(name)
+            if pids is not None:
+                pids.discard(pid)
+                if not pids:
+                    del self.by_name[name]
+
+    def pids(self, app_name: str, match: str='exact') -> list:
+        "return the PIDs whose name matches app_name, newest first like pidof"
+        if match == 'exact':
+            found = self.by_name.get(app_name, [])
+        elif match == 'prefix':
+            found = [pid for name, pids in self.by_name.items() if name.startswith(app_name) for pid in pids]
+        elif match == 'regex':
+            try:
+                pattern = re.compile(app_name)
+            except re.error as e:
+                print(f"Error: invalid regular expression {app_name!r}: {e}")
+                return []
+            found = [pid for name, pids in self.by_name.items() if pattern.search(name) for pid in pids]
+        else:
+            raise ValueError(f"unknown match mode {match!r}, expected one of {self.MATCH_MODES}")
+        found = sorted(set(found), key=int, reverse=True) # a process can match by both comm and argv[0], so dedupe
+        if self.meta is not None: # a PID from an earlier scan may have exited, or been reused by another program
+            changed = [pid for pid in found if self.names_of_pid(pid) != self.names.get(pid)]
+            for pid in changed:
+                self.remove(pid)
+                names = self.names_of_pid(pid)
+                if names:
+                    self.add(pid, names)
+            if changed:
+                return self.pids(app_name, match)
+        return found
 
-    return pid_list
-    # Return the list of PIDs found for the app or an empty list if no PIDs were found or if an error occurred.
+    def lookup(self, app_names: list, match: str='exact') -> dict:
+        "answer several program queries from the same scan, returns {app_name: [pids]}"
+        return {app_name: self.pids(app_name, match) for app_name in app_names}
 
 
-def rss_mem_of_pid(proc_id: str) -> int:
+def pids_of_prog(app_name: str, match: str='exact', index: ProcessIndex=None, proc: ProcSource=None, meta: MetaCache=None) -> list:
+    " This function takes an app name (a string) as input and returns a list of process IDs (PIDs) associated with the given app name."
+    if index is None: # no index was passed in, so scan /proc just for this lookup (names of cached processes are not re-read)
+        index = ProcessIndex(proc, meta).scan()
+    return index.pids(app_name, match)
+
+
+RSS_SOURCES = ('rollup', 'statm', 'smaps') # accuracy/speed tiers accepted by rss_mem_of_pid()
+PAGE_KB = os.sysconf('SC_PAGE_SIZE') // 1024 # statm counts pages, not kB
+
+
+def _sum_rss_lines(lines) -> int:
+    rss = 0
+    for line in lines:
+        # Look for the line starting with "Rss" which contains the RSS memory info
+        if line.startswith('Rss'):
+            rss += int(line.split()[1])  # Splits value of the second item, which is in kilobytes
+    return rss
+
+
+def rss_mem_of_pid(proc_id: str, source: str='rollup', proc: ProcSource=None, quiet: bool=False) -> int:
     "given a process id, return the resident memory used, zero if not found"
+    # source picks the speed/accuracy tradeoff:
+    #   'rollup' - /proc/<pid>/smaps_rollup, one line of totals summed by the kernel (falls back to smaps on old kernels)
+    #   'statm'  - /proc/<pid>/statm, the cheapest read: the kernel's RSS counter without walking any mappings
+    #   'smaps'  - /proc/<pid>/smaps, every mapping listed, only worth it when per-mapping detail is wanted
+    # proc is where /proc data comes from, the live /proc when not given.
+    # quiet skips the error message for processes we cannot read (exited, kernel threads, other users).
+    if source not in RSS_SOURCES:
+        raise ValueError(f"unknown RSS source {source!r}, expected one of {RSS_SOURCES}")
     rss = 0 # This sets the `rss` to 0. This variable will store the Resident Set Size memory usage for the process.
 
+    proc = proc if proc is not None else LIVE_PROC
     try:
-        # Open the smaps file for the given process ID
-        with open(f'/proc/{proc_id}/smaps', 'r') as f:
-            # Iterate through each line in the file
-            for line in f:
-                # Look for the line starting with "Rss" which contains the RSS memory info
-                if line.startswith('Rss'):
-                    # Extract the RSS value in kilobytes from the line
-                    rss += int(line.split()[1])  # Splits value of the second item, which is in kilobytes
-    except Exception as e: # this handles all errors and prints an error message
+        if source == 'statm':
+            rss = int(proc.reread(f'{proc_id}/statm').split()[1]) * PAGE_KB # the second field is resident pages
+        elif source == 'rollup':
+            try:
+                rss = _sum_rss_lines(proc.reread(f'{proc_id}/smaps_rollup').splitlines()) # a few lines, fine to keep open
+            except FileNotFoundError: # smaps_rollup only exists since Linux 4.14
+                with proc.open(f'{proc_id}/smaps') as f:
+                    rss = _sum_rss_lines(f)
+        else:
+            with proc.open(f'{proc_id}/smaps') as f: # streamed and never kept open, it can be megabytes long
+                rss = _sum_rss_lines(f)
+    except OSError as e: # the process exited, is a kernel thread, or we are not allowed to read it
+        read_failed(f"Error while fetching RSS memory for PID {proc_id}", e, quiet)
+    except Exception as e: # this handles all other errors and prints an error message
         print(f"Error while fetching RSS memory for PID {proc_id}: {e}")
     
     return rss
 
 
+class SmapsTotals:
+    "the memory counters of a process (or a group of them) summed over all its mappings, in kB"
+    __slots__ = ('rss', 'pss', 'shared_clean', 'shared_dirty', 'private_clean', 'private_dirty', 'swap')
+
+    # smaps / smaps_rollup key -> attribute; every other key in the file is skipped
+    FIELDS = {'Rss': 'rss', 'Pss': 'pss', 'Shared_Clean': 'shared_clean', 'Shared_Dirty': 'shared_dirty',
+              'Private_Clean': 'private_clean', 'Private_Dirty': 'private_dirty', 'Swap': 'swap'}
+
+    def __init__(self, rss: int=0, pss: int=0, shared_clean: int=0, shared_dirty: int=0,
+                 private_clean: int=0, private_dirty: int=0, swap: int=0) -> None:
+        self.rss = rss
+        self.pss = pss
+        self.shared_clean = shared_clean
+        self.shared_dirty = shared_dirty
+        self.private_clean = private_clean
+        self.private_dirty = private_dirty
+        self.swap = swap
+
+    @property
+    def uss(self) -> int:
+        "unique set size: the memory only this process maps, which is what exiting would free"
+        return self.private_clean + self.private_dirty
+
+    @property
+    def shared(self) -> int:
+        return self.shared_clean + self.shared_dirty
+
+    def __add__(self, other: 'SmapsTotals') -> 'SmapsTotals':
+        return SmapsTotals(*[getattr(self, name) + getattr(other, name) for name in self.__slots__])
+
+    def __radd__(self, other: object) -> 'SmapsTotals':
+        if other == 0: # lets sum() start from its usual 0
+            return self
+        return NotImplemented
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, SmapsTotals) and self.as_dict() == other.as_dict()
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self) -> str:
+        return f"SmapsTotals(rss={self.rss}, pss={self.pss}, uss={self.uss})"
+
+
+def parse_smaps(lines) -> SmapsTotals:
+    "sum Rss, Pss, Shared_*, Private_* and Swap over every mapping of a smaps or smaps_rollup file in one pass"
+    fields = SmapsTotals.FIELDS
+    sums = dict.fromkeys(fields.values(), 0)
+    for line in lines:
+        key, sep, rest = line.partition(':') # mapping header lines never produce one of our keys
+        attr = fields.get(key)
+        if attr is not None:
+            sums[attr] += int(rest.split()[0])
+    return SmapsTotals(**sums)
+
+
+def read_smaps_totals(proc_id: str, source: str='rollup', proc: ProcSource=None, quiet: bool=False) -> SmapsTotals:
+    "given a process id, return its RSS, PSS and USS counters, all zero if not found"
+    # statm has no PSS or private/shared split, so that source is read from smaps_rollup here
+    proc = proc if proc is not None else LIVE_PROC
+    try:
+        if source == 'smaps':
+            with proc.open(f'{proc_id}/smaps') as f: # streamed line by line, it can be megabytes long
+                return parse_smaps(f)
+        try:
+            return parse_smaps(proc.reread(f'{proc_id}/smaps_rollup').splitlines())
+        except FileNotFoundError: # smaps_rollup only exists since Linux 4.14
+            with proc.open(f'{proc_id}/smaps') as f:
+                return parse_smaps(f)
+    except OSError as e: # the process exited, is a kernel thread, or we are not allowed to read it
+        read_failed(f"Error while fetching PSS memory for PID {proc_id}", e, quiet)
+    except Exception as e:
+        print(f"Error while fetching PSS memory for PID {proc_id}: {e}")
+    return SmapsTotals()
+
+
+def mapping_label(pathname: str) -> str:
+    "name a mapping for the breakdown: the backing file, [heap], [stack], [anon], or [shmem] for shared memory files"
+    if not pathname:
+        return '[anon]'
+    if pathname.startswith('[stack'): # older kernels name thread stacks [stack:<tid>]
+        return '[stack]'
+    if pathname.startswith(('/dev/shm/', '/memfd:', '/SYSV')):
+        return f'[shmem] {pathname}'
+    return pathname # a file path, or a kernel name such as [heap], [vdso] or [anon:<name>]
+
+
+def mapping_breakdown(proc_id: str, proc: ProcSource=None, field: str='Rss', quiet: bool=False) -> dict:
+    "stream /proc/<pid>/smaps and return {mapping label: kB of field} for one process, empty if not found"
+    proc = proc if proc is not None else LIVE_PROC
+    prefix = field + ':'
+    totals = {}
+    label = '[anon]'
+    try:
+        with proc.open(f'{proc_id}/smaps') as f: # one line at a time, the whole file is never held in memory
+            for line in f:
+                if line.startswith(prefix):
+                    kb = int(line.split()[1])
+                    if kb:
+                        totals[label] = totals.get(label, 0) + kb
+                elif not line.split(None, 1)[0].endswith(':'): # a mapping header: address perms offset dev inode [pathname]
+                    parts = line.split(None, 5)
+                    label = mapping_label(parts[5].strip() if len(parts) > 5 else '')
+    except OSError as e: # the process exited, is a kernel thread, or we are not allowed to read it
+        read_failed(f"Error while fetching mappings for PID {proc_id}", e, quiet)
+    except Exception as e:
+        print(f"Error while fetching mappings for PID {proc_id}: {e}")
+    return totals
+
+
+def unchanged_layout(entry: ProcessMeta, mem: object, field: str='Rss') -> dict:
+    "return the layout kept on entry if the process's Rss (or Pss) total is still what the layout adds up to, else None"
+    if entry is None or entry.layout is None or mem is None:
+        return None
+    if isinstance(mem, SmapsTotals):
+        total = mem.pss if field == 'Pss' else mem.rss
+    else:
+        total = mem if field == 'Rss' else None # an RSS figure says nothing about PSS
+    return entry.layout if total and total == sum(entry.layout.values()) else None
+
+
+def program_mappings(pids: list, proc: ProcSource=None, workers: int=1, field: str='Rss', quiet: bool=False, meta: MetaCache=None, mem_by_pid: dict=None) -> dict:
+    "add up mapping_breakdown() over every PID of a program, returns {mapping label: kB}"
+    # with meta, each process's breakdown is kept as its layout; with mem_by_pid as well, a process whose total
+    # has not changed since then reuses its layout instead of walking its smaps again
+    layouts = {}
+    if meta is not None and mem_by_pid is not None:
+        for pid in pids:
+            layout = unchanged_layout(meta.peek(pid), mem_by_pid.get(pid), field)
+            if layout is not None:
+                layouts[pid] = layout
+        meta.layout_hits += len(layouts)
+        meta.layout_misses += len(pids) - len(layouts)
+    for pid, breakdown in _collect(mapping_breakdown, [pid for pid in pids if pid not in layouts], workers, dict, proc, field, quiet).items():
+        entry = meta.peek(pid) if meta is not None else None
+        if entry is not None:
+            entry.layout = breakdown
+        layouts[pid] = breakdown
+    totals = {}
+    for breakdown in layouts.values():
+        for label, kb in breakdown.items():
+            totals[label] = totals.get(label, 0) + kb
+    return totals
+
+
+def _collect(read: object, pids: list, workers: int, default: object, *read_args) -> dict:
+    "call read(pid, *read_args) for every pid, on a pool of threads when workers is not 1, and return {pid: result}"
+    if workers == 1 or len(pids) < 2: # the serial path, nothing to gain from a pool
+        return {pid: read(pid, *read_args) for pid in pids}
+    results = {}
+    # each read is blocking file I/O that the kernel serves on its own, so threads overlap them well.
+    # workers=0 lets ThreadPoolExecutor choose its default size for this machine.
+    with ThreadPoolExecutor(max_workers=workers or None) as pool:
+        futures = {pool.submit(read, pid, *read_args): pid for pid in pids}
+        for future in as_completed(futures):
+            pid = futures[future]
+            try:
+                results[pid] = future.result()
+            except Exception as e: # one bad PID must not lose the results of the others
+                print(f"Error while fetching memory for PID {pid}: {e}")
+                results[pid] = default()
+    return {pid: results[pid] for pid in pids} # hand results back in the same order as pids
+
+
+def collect_rss(pids: list, source: str='rollup', workers: int=1, proc: ProcSource=None, quiet: bool=False) -> dict:
+    "return {pid: resident kB} for every pid, reading them on a pool of threads when workers is not 1"
+    return _collect(rss_mem_of_pid, pids, workers, int, source, proc, quiet)
+
+
+def collect_smaps(pids: list, source: str='rollup', workers: int=1, proc: ProcSource=None, quiet: bool=False) -> dict:
+    "return {pid: SmapsTotals} for every pid, reading them on a pool of threads when workers is not 1"
+    return _collect(read_smaps_totals, pids, workers, SmapsTotals, source, proc, quiet)
+
+
+UNREADABLE_RETRY = 5 # ticks a process whose memory read as nothing for no known reason keeps its last reading, before it is read again
+
+
+def _read_denied(proc_id: str, source: str, proc: ProcSource) -> bool:
+    "whether the memory file of a process is one we may not read (another user's process)"
+    try:
+        proc.read(f"{proc_id}/{'statm' if source == 'statm' else 'smaps_rollup'}")
+    except PermissionError:
+        return True
+    except OSError:
+        pass
+    return False
+
+
+def collect_memory(pids: list, source: str='rollup', workers: int=1, proc: ProcSource=None, quiet: bool=False, pss: bool=False, meta: MetaCache=None) -> dict:
+    "collect_smaps() when PSS/USS accounting is wanted, otherwise the cheaper collect_rss()"
+    # with meta, pids must come from a lookup that just validated them (ProcessIndex.pids() with the same cache).
+    # Kernel threads and processes we may not read are remembered, never read again and count as nothing.
+    # Anything else that reads as nothing (a race, running out of descriptors) keeps its last reading for
+    # UNREADABLE_RETRY ticks and is then read again; one never read successfully is left out meanwhile
+    unreadable, carried = set(), set()
+    if meta is not None:
+        for pid in pids:
+            entry = meta.peek(pid)
+            if entry is None:
+                continue
+            if entry.unreadable:
+                unreadable.add(pid)
+            elif entry.retry:
+                entry.retry -= 1
+                if entry.retry:
+                    carried.add(pid)
+        pids = [pid for pid in pids if pid not in unreadable and pid not in carried]
+    if pss:
+        mem_by_pid = collect_smaps(pids, source, workers, proc, quiet)
+    else:
+        mem_by_pid = collect_rss(pids, source, workers, proc, quiet)
+    if meta is None:
+        return mem_by_pid
+    for pid, mem in list(mem_by_pid.items()):
+        entry = meta.peek(pid)
+        if entry is None:
+            continue
+        if mem.rss if pss else mem:
+            entry.memory = mem
+        elif entry.cmdline == '' or _read_denied(pid, source, proc if proc is not None else LIVE_PROC): # kernel threads have no cmdline
+            entry.unreadable = True
+        else:
+            entry.retry = UNREADABLE_RETRY
+            carried.add(pid)
+    for pid in carried:
+        memory = meta.peek(pid).memory
+        if memory is not None:
+            mem_by_pid[pid] = memory
+        else:
+            mem_by_pid.pop(pid, None)
+    for pid in unreadable:
+        mem_by_pid[pid] = SmapsTotals() if pss else 0
+    return mem_by_pid
+
+
+def group_by_program(mem_by_pid: dict, index: ProcessIndex) -> dict:
+    "group per-PID memory (kB or SmapsTotals) by program name (the process comm), returns {name: [total, process count]}"
+    totals = {}
+    for pid, mem in mem_by_pid.items():
+        names = index.names.get(pid)
+        name = names[0] if names else f'[{pid}]' # a process that exited before we read its name
+        entry = totals.get(name)
+        if entry is None:
+            totals[name] = [mem, 1]
+        else:
+            entry[0] = entry[0] + mem # not +=, which would change the per-PID SmapsTotals in place
+            entry[1] += 1
+    return totals
+
+
+def top_programs(n: int, index: ProcessIndex, source: str='rollup', workers: int=1, proc: ProcSource=None, pss: bool=False) -> list:
+    "read every process in index and return the n biggest programs as (name, total, process count)"
+    # total is RSS in kB, or a SmapsTotals ranked by PSS when pss is set
+    mem_by_pid = collect_memory(list(index.names), source, workers, proc, True, pss) # one sweep over every PID
+    totals = group_by_program(mem_by_pid, index)
+    size = (lambda item: item[1][0].pss) if pss else (lambda item: item[1][0])
+    # nlargest keeps a heap of n entries, so we never sort every program on the host
+    biggest = heapq.nlargest(n, totals.items(), key=size)
+    return [(name, mem, count) for name, (mem, count) in biggest if (mem.rss if pss else mem) > 0]
+
+
+class ProcessTree:
+    "the parent/child links of every process, from one read of each /proc/<pid>/stat"
+
+    def __init__(self, proc: ProcSource=None) -> None:
+        self.proc = proc if proc is not None else LIVE_PROC
+        self.parent = {} # pid (str) -> parent pid (str); '0' for init and kthreadd
+        self.children = {} # pid -> child pids, oldest (lowest) first
+
+    def scan(self, pids: list=None) -> 'ProcessTree':
+        "read the parent of every pid (every process when not given), returns self so calls can be chained"
+        for pid in (pids if pids is not None else self.proc.pids()):
+            try:
+                fields = self.proc.read(f'{pid}/stat').rpartition(')')[2].split() # after comm, which may contain spaces
+            except OSError: # exited since the scan
+                continue
+            if len(fields) > 1:
+                self.parent[pid] = fields[1] # field 4, ppid
+        for pid, ppid in self.parent.items():
+            self.children.setdefault(ppid, []).append(pid)
+        for kids in self.children.values():
+            kids.sort(key=int)
+        return self
+
+    def roots(self, pids: list) -> list:
+        "the pids that are not descendants of another pid in the list, so a master and its workers make one tree"
+        below = set()
+        for pid in pids:
+            stack = list(self.children.get(pid, ()))
+            while stack: # every process is added to below at most once, so this is linear in the tree size
+                child = stack.pop()
+                if child not in below:
+                    below.add(child)
+                    stack.extend(self.children.get(child, ()))
+        return [pid for pid in pids if pid not in below]
+
+    def walk(self, root: str) -> list:
+        "return (pid, depth) for root and every process below it, parents before their children"
+        order = []
+        stack = [(root, 0)]
+        while stack:
+            pid, depth = stack.pop()
+            order.append((pid, depth))
+            stack.extend((child, depth + 1) for child in reversed(self.children.get(pid, ())))
+        return order
+
+    def totals(self, root: str, mem_by_pid: dict, empty: object=0) -> dict:
+        "return {pid: (memory of its whole subtree, processes in it)} for root's subtree, added up from the leaves"
+        order = self.walk(root)
+        totals = {pid: [mem_by_pid.get(pid, empty), 1] for pid, depth in order}
+        for pid, depth in reversed(order): # children come after their parent in order, so they are finished first
+            if pid != root:
+                parent = totals[self.parent[pid]]
+                parent[0] = parent[0] + totals[pid][0]
+                parent[1] += totals[pid][1]
+        return {pid: tuple(total) for pid, total in totals.items()}
+
+
+def read_program_groups(lines) -> dict:
+    "parse group lines such as 'web = nginx,php-fpm' into {'web': ['nginx', 'php-fpm']}; a bare name is a group of its own"
+    groups = {}
+    for number, line in enumerate(lines, 1):
+        line = line.split('#', 1)[0].strip() # comments and blank lines are skipped
+        if not line:
+            continue
+        name, sep, programs = line.partition('=')
+        name = name.strip()
+        programs = [program.strip() for program in (programs if sep else name).split(',') if program.strip()]
+        if not name or not programs:
+            raise ValueError(f"line {number}: expected 'group = program[,program...]', got {line!r}")
+        groups[name] = programs
+    return groups
+
+
+def collect_program_groups(program_groups: dict, index: ProcessIndex, match: str='exact', source: str='rollup', workers: int=1,
+                           proc: ProcSource=None, pss: bool=False, meta: MetaCache=None) -> list:
+    "answer every group from one index and one collection, returns (group, total, process count) rows in the order given"
+    pids_of = {}
+    for group, programs in program_groups.items():
+        found = set() # a process can match more than one program of a group, it is counted once
+        for pids in index.lookup(programs, match).values():
+            found.update(pids)
+        pids_of[group] = found
+    everything = sorted(set().union(*pids_of.values()), key=int)
+    mem_by_pid = collect_memory(everything, source, workers, proc, True, pss, meta) # a PID in several groups is read once
+    empty = SmapsTotals() if pss else 0
+    return [(group, sum((mem_by_pid[pid] for pid in pids), empty), len(pids)) for group, pids in pids_of.items()]
+
+
+def timed_collect_memory(pids: list, source: str='rollup', workers: int=1, pss: bool=False, proc: ProcSource=None, quiet: bool=False) -> tuple:
+    "run collect_memory() and return (results, wall clock seconds it took)"
+    start = time.perf_counter()
+    mem = collect_memory(pids, source, workers, proc, quiet, pss)
+    return mem, time.perf_counter() - start
+
 
 def bytes_to_human_r(kibibytes: int, decimal_places: int=2) -> str:
     "turn 1,024 into 1 MiB, for example"
@@ -150,46 +1337,1354 @@ def bytes_to_human_r(kibibytes: int, decimal_places: int=2) -> str:
     str_result += suffixes[suf_count]
     return str_result
 
-if __name__ == "__main__":
+#------------------------------------------------------------CGROUPS----------------------------------------------------------------------
+CGROUP_ROOT = "/sys/fs/cgroup" # where the cgroup v2 hierarchy is mounted
 
-    args = parse_command_args() # Call the `parse_command_args()` function to parse the command-line arguments passed to the script
 
-    # Total System Memory Section 
-    total_memory = get_sys_mem()  # Fetch the total system memory
-    available_memory = get_avail_mem()  # Fetch the available system memory
+class CgroupMem:
+    "memory of one cgroup v2 group: usage and limit in kB, memory.stat as the kernel reports it (bytes and event counts)"
+    __slots__ = ('path', 'current', 'limit', 'stat')
+
+    def __init__(self, path: str, current: int, limit: int=None, stat: dict=None) -> None:
+        "limit is None when memory.max is 'max', i.e. the group is only bounded by the host"
+        self.path = path
+        self.current = current
+        self.limit = limit
+        self.stat = stat if stat is not None else {}
+
+    @property
+    def reclaimable(self) -> int:
+        "kB of page cache the kernel can drop before the group hits its limit (inactive_file)"
+        return self.stat.get('inactive_file', 0) // 1024
+
+    def meminfo(self, host: MemInfo) -> MemInfo:
+        "return host meminfo with MemTotal and MemAvailable replaced by this group's limit and headroom"
+        total = min(self.limit, host.total) if self.limit is not None else host.total # a limit above the host's RAM cannot be reached
+        available = min(total, max(0, total - self.current + self.reclaimable), host.available)
+        return MemInfo({**host.fields, 'MemTotal': total, 'MemAvailable': available})
+
+    def __repr__(self) -> str:
+        return f"CgroupMem(path={self.path!r}, current={self.current}, limit={self.limit})"
+
+
+def cgroup_of_pid(proc_id: str='self', proc: ProcSource=None) -> str:
+    "return the cgroup v2 path of a process from /proc/<pid>/cgroup (e.g. '/system.slice/nginx.service'), None if it has none"
+    proc = proc if proc is not None else LIVE_PROC
+    try:
+        for line in proc.read(f'{proc_id}/cgroup').splitlines():
+            if line.startswith('0::'): # the v2 entry; v1 lines are 'id:controllers:path'
+                return line[3:] or '/'
+        print(f"Error: PID {proc_id} is not in a cgroup v2 hierarchy")
+    except OSError as e:
+        print(f"Error while reading the cgroup of PID {proc_id}: {e}")
+    return None
+
+
+def read_cgroup(path: str, cgroups: ProcSource, stat: bool=True, quiet: bool=False) -> CgroupMem:
+    "read memory.current, memory.max and (if stat) memory.stat of one group, None if it has no memory controller"
+    rel = path.strip('/')
+    rel = rel + '/' if rel else ''
+    try:
+        current = int(cgroups.reread(rel + 'memory.current')) // 1024
+        limit = cgroups.reread(rel + 'memory.max').strip()
+        limit = None if limit == 'max' else int(limit) // 1024
+        values = {}
+        if stat:
+            for line in cgroups.reread(rel + 'memory.stat').splitlines():
+                key, _, value = line.partition(' ')
+                values[key] = int(value)
+        return CgroupMem(path, current, limit, values)
+    except FileNotFoundError: # the root group, or the memory controller is not enabled for this group
+        if not quiet:
+            print(f"Error: no cgroup v2 memory controller for {path} under {cgroups.root}")
+    except (OSError, ValueError) as e:
+        if not quiet:
+            print(f"Error while reading cgroup {path}: {e}")
+    return None
+
+
+def cgroup_tree(cgroups: ProcSource, start: str='/', depth: int=1) -> list:
+    "return a CgroupMem for start and every group up to depth levels below it, parents before children"
+    groups = []
+
+    def visit(rel: str, level: int) -> None:
+        try:
+            dirnames, filenames = cgroups.listdir(rel) # through the source, so --record and --replay see the same tree
+        except OSError: # removed while walking
+            return
+        if 'memory.current' in filenames:
+            group = read_cgroup('/' + rel, cgroups, stat=False, quiet=True) # one counter per group instead of smaps for every process in it
+            if group is not None:
+                groups.append(group)
+        if level < depth: # do not walk deeper than asked
+            for name in dirnames:
+                visit(f'{rel}/{name}' if rel else name, level + 1)
+
+    visit(start.strip('/'), 0)
+    return groups
+
+
+#------------------------------------------------------------PRESSURE----------------------------------------------------------------------
+# /proc/vmstat counter -> the rate it is added to; pgscan_anon/_file repeat the totals by type, so they are left out
+VMSTAT_COUNTERS = {'pgfault': 'pgfault', 'pgmajfault': 'pgmajfault', 'pswpin': 'pswpin', 'pswpout': 'pswpout',
+                   'pgscan_kswapd': 'pgscan', 'pgscan_direct': 'pgscan', 'pgscan_khugepaged': 'pgscan', 'pgscan_proactive': 'pgscan',
+                   'pgsteal_kswapd': 'pgsteal', 'pgsteal_direct': 'pgsteal', 'pgsteal_khugepaged': 'pgsteal', 'pgsteal_proactive': 'pgsteal',
+                   'workingset_refault': 'refault', 'workingset_refault_anon': 'refault', 'workingset_refault_file': 'refault',
+                   'oom_kill': 'oom_kill'}
+VMSTAT_LABELS = {'pgfault': 'Page faults', 'pgmajfault': 'Major faults', 'pswpin': 'Swapped in (pages)', 'pswpout': 'Swapped out (pages)',
+                 'pgscan': 'Reclaim scanned', 'pgsteal': 'Reclaim freed', 'allocstall': 'Direct reclaim stalls',
+                 'refault': 'Refaults', 'oom_kill': 'OOM kills'}
+RATE_BAR_MAX = 1e6 # rate bars are log scaled so 10/s and 100000/s both show: 1/s is one step, 1,000,000/s a full bar
+
+
+class PressureSample:
+    "one read of /proc/vmstat, /proc/pressure/memory and /proc/uptime, so rates can be taken between two samples"
+    __slots__ = ('when', 'uptime', 'vmstat', 'psi')
+
+    def __init__(self, when: float, uptime: float, vmstat: dict, psi: dict) -> None:
+        self.when = when # time.monotonic() of the read
+        self.uptime = uptime # seconds since boot, for rates of a single sample
+        self.vmstat = vmstat # rate name -> counter summed over its vmstat keys
+        self.psi = psi # {'some': {'avg10': ..., 'avg60': ..., 'avg300': ..., 'total': microseconds}, 'full': {...}}, None without PSI
+
+
+def parse_vmstat(lines) -> dict:
+    "sum the /proc/vmstat counters the pressure view uses into their rate names"
+    counters = dict.fromkeys(VMSTAT_LABELS, 0)
+    for line in lines:
+        key, _, value = line.partition(' ')
+        name = 'allocstall' if key.startswith('allocstall') else VMSTAT_COUNTERS.get(key)
+        if name is not None:
+            counters[name] += int(value)
+    return counters
+
+
+def parse_psi(lines) -> dict:
+    "parse /proc/pressure/memory lines such as 'some avg10=0.31 avg60=0.12 avg300=0.02 total=1234'"
+    psi = {}
+    for line in lines:
+        kind, *fields = line.split()
+        psi[kind] = {key: float(value) for key, _, value in (field.partition('=') for field in fields)}
+    return psi
+
+
+def read_pressure(proc: ProcSource=None) -> PressureSample:
+    "read vmstat, PSI and uptime once each; None if vmstat cannot be read. PSI is None on kernels without it"
+    proc = proc if proc is not None else LIVE_PROC
+    try:
+        vmstat = parse_vmstat(proc.reread('vmstat').splitlines())
+        uptime = float(proc.reread('uptime').split()[0])
+    except (OSError, ValueError) as e:
+        print(f"Error while reading {proc.path('vmstat')}: {e}")
+        return None
+    try:
+        psi = parse_psi(proc.reread('pressure/memory').splitlines())
+    except OSError: # no CONFIG_PSI, or booted with psi=0
+        psi = None
+    return PressureSample(time.monotonic(), uptime, vmstat, psi)
+
+
+def pressure_rates(sample: PressureSample, previous: PressureSample=None) -> dict:
+    "return {rate name: per second} between two samples, or averaged since boot without a previous sample"
+    # 'psi.some' and 'psi.full' are the fraction of that time some or all tasks were stalled on memory
+    if previous is not None:
+        seconds = sample.when - previous.when
+        before = previous
+    else:
+        seconds = sample.uptime
+        before = None
+    if seconds <= 0:
+        return {}
+    rates = {name: (count - (before.vmstat.get(name, 0) if before else 0)) / seconds for name, count in sample.vmstat.items()}
+    for kind, values in (sample.psi or {}).items():
+        stalled = values.get('total', 0) - ((before.psi or {}).get(kind, {}).get('total', 0) if before else 0)
+        rates[f'psi.{kind}'] = stalled / 1e6 / seconds # total counts microseconds
+    return rates
+
+
+def rate_graph(rate: float, length: int=20) -> str:
+    "a log scaled bar for an event rate"
+    return percent_to_graph(math.log10(1 + max(0.0, rate)) / math.log10(1 + RATE_BAR_MAX), length)
+
+
+def pressure_report(meminfo: MemInfo, sample: PressureSample, rates: dict, since_boot: bool, length: int=20, human_readable: bool=False) -> list:
+    "return the lines of the swap, page cache and pressure view"
+    size = bytes_to_human_r if human_readable else (lambda kb: f"{kb} kB")
+    total = meminfo.total
+    lines = ["\nSwap and page cache:"]
+    swap_total = meminfo.get('SwapTotal')
+    if swap_total:
+        swap_used = swap_total - meminfo.get('SwapFree')
+        lines.append(f"{'Swap used':<22} [{percent_to_graph(swap_used / swap_total, length)}] {size(swap_used):>12} of {size(swap_total)} ({size(meminfo.get('SwapCached'))} cached)")
+    else:
+        lines.append(f"{'Swap used':<22} no swap")
+    for label, kb in (('Page cache', meminfo.get('Cached') + meminfo.get('Buffers')), ('Shared memory', meminfo.get('Shmem')),
+                      ('Dirty + writeback', meminfo.get('Dirty') + meminfo.get('Writeback'))):
+        lines.append(f"{label:<22} [{percent_to_graph(kb / total, length)}] {size(kb):>12} {kb / total * 100:6.2f}% of total")
+    lines.append("\nMemory pressure (PSI, % of time stalled):")
+    if sample.psi is None:
+        lines.append("PSI is not available on this kernel")
+    for kind in ('some', 'full'):
+        values = (sample.psi or {}).get(kind)
+        if values is not None:
+            lines.append(f"{kind:<22} [{percent_to_graph(values.get('avg10', 0) / 100, length)}] avg10 {values.get('avg10', 0):6.2f}  avg60 {values.get('avg60', 0):6.2f}"
+                         f"  avg300 {values.get('avg300', 0):6.2f}  now {rates.get(f'psi.{kind}', 0) * 100:6.2f}")
+    lines.append(f"\nVM events per second ({'average since boot' if since_boot else 'since the last sample'}, log scale):")
+    for name, label in VMSTAT_LABELS.items():
+        rate = rates.get(name, 0.0)
+        lines.append(f"{label:<22} [{rate_graph(rate, length)}] {rate:12.1f}/s")
+    return lines
+
+
+#------------------------------------------------------------HISTORY----------------------------------------------------------------------
+class RingBuffer:
+    "a fixed number of (time, value) samples in two flat arrays of doubles, the oldest is overwritten when full"
+    __slots__ = ('capacity', 'times', 'values', 'start', 'count')
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.times = array('d', bytes(8 * capacity)) # allocated once, 16 bytes per sample however long we run
+        self.values = array('d', bytes(8 * capacity))
+        self.start = 0 # index of the oldest sample
+        self.count = 0
+
+    def append(self, when: float, value: float) -> None:
+        i = (self.start + self.count) % self.capacity
+        self.times[i] = when
+        self.values[i] = value
+        if self.count < self.capacity:
+            self.count += 1
+        else: # full, so the slot we wrote was the oldest sample
+            self.start = (self.start + 1) % self.capacity
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self):
+        "yield (time, value) pairs, oldest first"
+        for n in range(self.count):
+            i = (self.start + n) % self.capacity
+            yield self.times[i], self.values[i]
+
+    def last(self) -> tuple:
+        "the newest (time, value), None when empty"
+        if not self.count:
+            return None
+        i = (self.start + self.count - 1) % self.capacity
+        return self.times[i], self.values[i]
+
+    def first_since(self, when: float) -> tuple:
+        "the oldest (time, value) taken at or after when, None if there is none"
+        first = None
+        for n in range(self.count - 1, -1, -1):
+            i = (self.start + n) % self.capacity
+            if self.times[i] < when:
+                break
+            first = self.times[i], self.values[i]
+        return first
+
+    def since(self, when: float) -> list:
+        "values of the samples taken at or after when, oldest first"
+        values = []
+        for n in range(self.count - 1, -1, -1): # walk back from the newest and stop at the window edge
+            i = (self.start + n) % self.capacity
+            if self.times[i] < when:
+                break
+            values.append(self.values[i])
+        values.reverse()
+        return values
+
+
+class HistoryStore:
+    "in-process history: one RingBuffer per metric, with a cap on the number of metrics so memory stays bounded"
+    # metric names are 'system.used', 'system.available' and 'rss:<program>' / 'pss:<program>', values in kB;
+    # with --pressure also 'swap.used' (kB), 'psi.some.avg10' / 'psi.full.avg10' (%) and 'rate.<vm event>' (per second)
+
+    def __init__(self, capacity: int=600, max_metrics: int=256, log: 'HistoryLog'=None) -> None:
+        self.capacity = capacity # samples kept per metric
+        self.max_metrics = max_metrics
+        self.series = {} # name -> RingBuffer, least recently updated first
+        self.log = log
+
+    def add(self, when: float, name: str, value: float) -> None:
+        "append one sample without logging it (used when loading a log)"
+        ring = self.series.pop(name, None) # pop and re-insert keeps the dict ordered by last update
+        if ring is None:
+            ring = RingBuffer(self.capacity)
+            if len(self.series) >= self.max_metrics: # forget the metric that has gone longest without a sample
+                self.series.pop(next(iter(self.series)))
+        ring.append(when, value)
+        self.series[name] = ring
+
+    def record(self, when: float, metrics: dict) -> None:
+        "append one sample for each {name: value} in metrics, and to the on-disk log if there is one"
+        for name, value in metrics.items():
+            self.add(when, name, value)
+        if self.log is not None:
+            self.log.append(when, metrics)
+
+    def stats(self, name: str, window: float, now: float=None) -> tuple:
+        "return (min, avg, max, samples) of a metric over the last window seconds, None if there are no samples"
+        ring = self.series.get(name)
+        if ring is None:
+            return None
+        values = ring.since((now if now is not None else time.time()) - window)
+        if not values:
+            return None
+        return min(values), sum(values) / len(values), max(values), len(values)
+
+    def close(self) -> None:
+        if self.log is not None:
+            self.log.close()
+
+
+class HistoryLog:
+    "an append-only binary log of samples, rotated to FILE.1, FILE.2 ... once it grows past max_bytes"
+    RECORD = struct.Struct('<ddH') # time, value, length of the metric name that follows in UTF-8
+
+    def __init__(self, path: str, max_bytes: int=8 * 1024 * 1024, backups: int=3) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file = open(path, 'ab')
+
+    def append(self, when: float, metrics: dict) -> None:
+        "write every metric of one sample in a single write"
+        chunk = bytearray()
+        for name, value in metrics.items():
+            encoded = name.encode()
+            chunk += self.RECORD.pack(when, value, len(encoded)) + encoded
+        self.file.write(chunk)
+        self.file.flush()
+        if self.file.tell() >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self) -> None:
+        "shift FILE.n to FILE.n+1 (dropping the oldest), FILE to FILE.1, and start an empty FILE"
+        self.file.close()
+        for n in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{n}'):
+                os.replace(f'{self.path}.{n}', f'{self.path}.{n + 1}')
+        if self.backups:
+            os.replace(self.path, f'{self.path}.1')
+        self.file = open(self.path, 'wb')
+
+    def files(self) -> list:
+        "the log and its rotated copies, oldest first"
+        rotated = [f'{self.path}.{n}' for n in range(self.backups, 0, -1)]
+        return [path for path in rotated + [self.path] if os.path.exists(path)]
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def read_history_log(path: str, since: float=None, chunk_size: int=64 * 1024):
+    "yield (time, name, value) for every sample in one history log file from since on, stopping at a torn last record"
+    # read a chunk at a time so a full 8 MiB log is never held in memory at once
+    header = HistoryLog.RECORD
+    data = b''
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            data += chunk
+            offset = 0
+            while offset + header.size <= len(data):
+                when, value, size = header.unpack_from(data, offset)
+                end = offset + header.size + size
+                if end > len(data): # the rest of this record is in the next chunk
+                    break
+                if since is None or when >= since:
+                    yield when, data[offset + header.size:end].decode(), value
+                offset = end
+            data = data[offset:] # whatever is left at the end of the file is a record the writer never finished
+
+
+def open_history(capacity: int, log_path: str=None, log_max_bytes: int=8 * 1024 * 1024, since: float=None) -> HistoryStore:
+    "create a HistoryStore appending to log_path when one is given, loaded with the logged samples from since on"
+    # since is None when nothing will look back at earlier samples, then the log is only appended to
+    if not log_path:
+        return HistoryStore(capacity)
+    try:
+        log = HistoryLog(log_path, log_max_bytes)
+    except OSError as e:
+        print(f"Error: cannot open history log {log_path}: {e}")
+        return HistoryStore(capacity)
+    store = HistoryStore(capacity, log=log)
+    if since is None:
+        return store
+    for path in log.files(): # replay earlier runs, the ring buffers keep only the newest samples
+        try:
+            if os.path.getmtime(path) < since: # last written before the window starts, every sample in it is too old
+                continue
+        except OSError:
+            continue
+        for when, name, value in read_history_log(path, since):
+            store.add(when, name, value)
+    return store
+
+
+def metric_unit(name: str) -> str:
+    "the unit of a history metric: '%' for PSI averages, '/s' for VM event rates, 'kB' for every memory size"
+    if name.startswith('psi.'):
+        return '%'
+    if name.startswith('rate.'):
+        return '/s'
+    return 'kB'
+
+
+def history_metrics(meminfo: MemInfo, program_name: str=None, mem_by_pid: dict=None, rows: list=None, pressure: tuple=None) -> dict:
+    "turn what one report collected into {metric name: value} for a HistoryStore, in the unit metric_unit() gives; pressure is (PressureSample, rates)"
+    metrics = {'system.used': meminfo.used, 'system.available': meminfo.available}
+    if pressure is not None:
+        sample, rates = pressure
+        metrics['swap.used'] = meminfo.get('SwapTotal') - meminfo.get('SwapFree')
+        for kind, values in (sample.psi or {}).items():
+            metrics[f'psi.{kind}.avg10'] = values.get('avg10', 0.0)
+        for name in VMSTAT_LABELS:
+            metrics[f'rate.{name}'] = rates.get(name, 0.0)
+    if program_name and mem_by_pid is not None:
+        totals = sum(mem_by_pid.values())
+        if isinstance(totals, SmapsTotals):
+            metrics[f'rss:{program_name}'] = totals.rss
+            metrics[f'pss:{program_name}'] = totals.pss
+        else:
+            metrics[f'rss:{program_name}'] = totals
+    for name, mem, count in rows or ():
+        if isinstance(mem, SmapsTotals):
+            metrics[f'rss:{name}'] = mem.rss
+            metrics[f'pss:{name}'] = mem.pss
+        else:
+            metrics[f'rss:{name}'] = mem
+    return metrics
+
+
+#------------------------------------------------------------TRENDS----------------------------------------------------------------------
+LEAK_MIN_R2 = 0.8 # how well the samples must fit a straight line before steady growth is called a leak
+LEAK_HALF_LIFE = 3 # a sample counts half after this many times --leak-samples newer ones, so growth that stopped is forgotten
+
+
+class Trend:
+    "an exponentially weighted least squares line through (time, kB) samples, updated one sample at a time so no samples are kept"
+    __slots__ = ('n', 'decay', 'weight', 'mean_t', 'mean_v', 'ctv', 'mtt', 'mvv', 'last', 'baseline', 'baseline_time')
+
+    def __init__(self, half_life: float=30.0) -> None:
+        self.n = 0
+        self.decay = 0.5 ** (1 / half_life) # each new sample scales the weight of the older ones by this
+        self.weight = 0.0 # sum of the sample weights
+        self.mean_t = self.mean_v = 0.0
+        self.ctv = self.mtt = self.mvv = 0.0 # running sums of co-deviations (Welford), numerically stable for large t
+        self.last = None # the newest value
+        self.baseline = None # mapping breakdown from when the process was first flagged, for the mapping diff
+        self.baseline_time = None
+
+    def add(self, when: float, value: float) -> None:
+        "add one sample of weight 1 after decaying the others; the means and co-deviations are updated in place (weighted Welford)"
+        self.n += 1
+        self.weight = self.weight * self.decay + 1
+        dt = when - self.mean_t
+        dv = value - self.mean_v
+        self.mean_t += dt / self.weight
+        self.mean_v += dv / self.weight
+        # decaying every weight leaves the means alone and scales the co-deviation sums by the same factor
+        self.ctv = self.ctv * self.decay + dt * (value - self.mean_v)
+        self.mtt = self.mtt * self.decay + dt * (when - self.mean_t)
+        self.mvv = self.mvv * self.decay + dv * (value - self.mean_v)
+        self.last = value
+
+    @property
+    def slope(self) -> float:
+        "growth in kB per second"
+        return self.ctv / self.mtt if self.mtt > 0 else 0.0
+
+    @property
+    def r2(self) -> float:
+        "how well a straight line fits, 0.0 - 1.0"
+        if self.mtt <= 0 or self.mvv <= 0:
+            return 0.0
+        return self.ctv * self.ctv / (self.mtt * self.mvv)
+
+    def __repr__(self) -> str:
+        return f"Trend(n={self.n}, slope={self.slope:.3f} kB/s, r2={self.r2:.2f})"
+
+
+def update_trends(mem_by_pid: dict, meta: MetaCache, when: float, half_life: float=30.0) -> None:
+    "add this tick's memory of each process to its Trend, kept on its (pid, starttime) cache entry so a reused PID starts over"
+    for pid, mem in mem_by_pid.items():
+        entry = meta.peek(pid)
+        if entry is None or entry.unreadable or entry.retry or not (mem.rss if isinstance(mem, SmapsTotals) else mem):
+            continue # nothing was read this tick, a carried reading or a zero is not a sample
+        if entry.trend is None:
+            entry.trend = Trend(half_life)
+        entry.trend.add(when, mem.pss if isinstance(mem, SmapsTotals) else mem)
+
+
+def leaking(pids: list, meta: MetaCache, min_rate: float, min_samples: int=10) -> list:
+    "return (pid, Trend) of the processes growing by at least min_rate kB per hour along a straight line, fastest first"
+    found = []
+    for pid in pids:
+        entry = meta.peek(pid)
+        trend = entry.trend if entry is not None and not entry.unreadable else None
+        if trend is not None and trend.n >= min_samples and trend.slope * 3600 >= min_rate and trend.r2 >= LEAK_MIN_R2:
+            found.append((pid, trend))
+    found.sort(key=lambda item: item[1].slope, reverse=True)
+    return found
+
+
+def mapping_growth(before: dict, after: dict, n: int=5) -> list:
+    "diff two mapping breakdowns, returns the n mappings that grew the most as (label, kB gained)"
+    grown = [(label, kb - before.get(label, 0)) for label, kb in after.items() if kb > before.get(label, 0)]
+    return heapq.nlargest(n, grown, key=lambda item: item[1])
+
+
+def check_leaks(pids: list, meta: MetaCache, proc: ProcSource, args: object, when: float) -> list:
+    "flag leaking processes and diff their mappings against when they were first flagged, returns (pid, Trend, growth) rows"
+    rows = []
+    for pid, trend in leaking(pids, meta, args.leak_rate, args.leak_samples):
+        entry = meta.peek(pid)
+        layout = unchanged_layout(entry, entry.memory, mapping_field(args))
+        if layout is None:
+            layout = mapping_breakdown(pid, proc, mapping_field(args), quiet=True) # only flagged processes pay for a full smaps walk
+            entry.layout = layout
+            meta.layout_misses += 1
+        else:
+            meta.layout_hits += 1
+        if trend.baseline is None:
+            trend.baseline, trend.baseline_time = layout, when
+        rows.append((pid, trend, mapping_growth(trend.baseline, layout)))
+    return rows
+
+
+def leak_report(leaks: list, names: dict, when: float, human_readable: bool=False) -> list:
+    "return the lines of the leak section: each growing process, then the mappings that grew since it was flagged"
+    size = bytes_to_human_r if human_readable else (lambda kb: f"{kb:.0f} kB")
+    lines = ["\nGrowing processes:"]
+    if not leaks:
+        return lines + ["none"]
+    for pid, trend, growth in leaks:
+        name = (names.get(pid) or ('?',))[0]
+        lines.append(f"{name} [{pid}] +{size(trend.slope * 3600)}/h, now {size(trend.last)} (fit {trend.r2:.2f} over {trend.n} samples)")
+        for label, kb in growth:
+            lines.append(f"    +{size(kb):>12} in {when - trend.baseline_time:.0f}s  {label}")
+    return lines
+
+
+#------------------------------------------------------------ALERTS----------------------------------------------------------------------
+SIZE_UNITS = {'kB': 1, 'KiB': 1, 'MiB': 1024, 'GiB': 1024 ** 2, 'TiB': 1024 ** 3} # alert thresholds are compared in kB
+RATE_UNITS = {'/s': 1, '/min': 60, '/h': 3600}
+TIME_UNITS = {'s': 1, 'm': 60, 'h': 3600}
 
-    if total_memory is None or available_memory is None:
-        sys.exit(1)  # Exit the program if fetching memory info failed.
 
+class AlertRule:
+    "one threshold rule on a history metric, e.g. 'system.used > 90% for 30s' or 'rate(rss:nginx) > 100MiB/min'"
+    PATTERN = re.compile(r'^\s*(?:(rate)\((?P<rmetric>[^()\s]+)\)|(?P<metric>[^\s<>=]+))\s*(?P<op>[<>]=?)\s*'
+                         r'(?P<value>\d+(?:\.\d+)?)\s*(?P<unit>%|kB|KiB|MiB|GiB|TiB)?(?P<per>/s|/min|/h)?'
+                         r'(?:\s+for\s+(?P<for>\d+(?:\.\d+)?)(?P<tunit>[smh])?)?\s*$')
+    OPS = {'>': lambda a, b: a > b, '>=': lambda a, b: a >= b, '<': lambda a, b: a < b, '<=': lambda a, b: a <= b}
+    RATE_WINDOW = 60.0 # rates are the change between the oldest sample of the last minute and the newest one
+
+    def __init__(self, text: str, hysteresis: float=0.05, cooldown: float=300.0) -> None:
+        "parse text, raises ValueError if it is not a rule"
+        m = self.PATTERN.match(text)
+        if m is None:
+            raise ValueError(f"cannot parse alert rule {text!r}, expected e.g. 'system.used > 90% for 30s' or 'rate(rss:nginx) > 100MiB/min'")
+        self.text = text.strip()
+        self.rate = m['rmetric'] is not None
+        self.metric = m['rmetric'] or m['metric']
+        self.op = m['op']
+        self.percent = m['unit'] == '%'
+        if self.percent and self.rate:
+            raise ValueError(f"alert rule {text!r}: a rate cannot be a percentage")
+        if m['per'] and not self.rate:
+            raise ValueError(f"alert rule {text!r}: {m['per']} only applies to rate(...)")
+        unit = metric_unit(self.metric)
+        if unit != 'kB' and m['unit'] and not (unit == '%' and self.percent):
+            raise ValueError(f"alert rule {text!r}: {self.metric} is measured in {unit}, not a size")
+        self.threshold = float(m['value']) * (1 if self.percent else SIZE_UNITS[m['unit'] or 'kB'])
+        self.percent = self.percent and unit == 'kB' # a PSI average is a percentage already and is compared as it is
+        self.per = RATE_UNITS[m['per'] or '/min'] # seconds in the rate's unit of time
+        self.duration = float(m['for']) * TIME_UNITS[m['tunit'] or 's'] if m['for'] else 0.0
+        # hysteresis: once firing, the value has to come back past the threshold by this fraction before it resolves
+        self.clear = self.threshold * (1 - hysteresis if self.op[0] == '>' else 1 + hysteresis)
+        self.cooldown = cooldown
+        self.firing = False
+        self.pending_since = None # when the threshold was first crossed, for 'for' rules
+        self.last_fired = None
+
+    def value(self, history: HistoryStore, now: float, total_memory: int) -> float:
+        "the value the rule compares, from samples already in history; None if there is no sample from this tick"
+        ring = history.series.get(self.metric)
+        last = ring.last() if ring is not None else None
+        if last is None or last[0] < now:
+            return None # not collected this tick (e.g. the program is not being watched)
+        if self.rate:
+            first = ring.first_since(now - self.RATE_WINDOW)
+            if first is None or first[0] >= last[0]:
+                return None # one sample is not a rate
+            return (last[1] - first[1]) / (last[0] - first[0]) * self.per
+        if self.percent:
+            return last[1] / total_memory * 100 if total_memory else None
+        return last[1]
+
+    def crossed(self, value: float, limit: float) -> bool:
+        return self.OPS[self.op](value, limit)
+
+    def evaluate(self, history: HistoryStore, now: float, total_memory: int) -> tuple:
+        "update the rule's state, return ('firing' or 'resolved', value) when it changes, else None"
+        value = self.value(history, now, total_memory)
+        if value is None:
+            return None
+        if self.firing:
+            if not self.crossed(value, self.clear):
+                self.firing = False
+                self.pending_since = None
+                return 'resolved', value
+            return None
+        if not self.crossed(value, self.threshold):
+            self.pending_since = None
+            return None
+        if self.pending_since is None:
+            self.pending_since = now
+        if now - self.pending_since < self.duration:
+            return None # not for long enough yet
+        if self.last_fired is not None and now - self.last_fired < self.cooldown:
+            return None # fired recently, fires when the cooldown is over if it still holds
+        self.firing = True
+        self.last_fired = now
+        return 'firing', value
+
+    def __repr__(self) -> str:
+        return f"AlertRule({self.text!r}, firing={self.firing})"
+
+
+class AlertSink:
+    "sends alert events to a command, and/or as JSON lines to a file or a unix:PATH, tcp:HOST:PORT or udp:HOST:PORT socket"
+
+    def __init__(self, command: str=None, target: str=None) -> None:
+        self.command = command
+        self.target = target
+        self.children = [] # commands still running, reaped on the next event so none are left as zombies
+
+    def send(self, event: dict) -> None:
+        "deliver one event; failures are printed and never stop the watch loop"
+        line = json.dumps(event, separators=(',', ':')) + '\n'
+        if self.command:
+            self.children = [child for child in self.children if child.poll() is None]
+            env = {**os.environ, 'ALERT_RULE': event['rule'], 'ALERT_STATE': event['state'],
+                   'ALERT_METRIC': event['metric'], 'ALERT_VALUE': str(event['value'])}
+            try: # not waited for, a slow command must not delay the next redraw
+                child = subprocess.Popen(self.command, shell=True, env=env, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+                child.stdin.write(line.encode())
+                child.stdin.close()
+                self.children.append(child)
+            except OSError as e:
+                print(f"Error while running alert command {self.command!r}: {e}", file=sys.stderr)
+        if self.target:
+            try:
+                self.write(line.encode())
+            except OSError as e:
+                print(f"Error while sending alert to {self.target}: {e}", file=sys.stderr)
+
+    def write(self, data: bytes) -> None:
+        "write data to the target: one short connection per event, alerts are rare"
+        kind, _, address = self.target.partition(':')
+        if kind == 'unix':
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(2)
+                sock.connect(address)
+                sock.sendall(data)
+        elif kind in ('tcp', 'udp'):
+            host, _, port = address.rpartition(':')
+            if kind == 'tcp':
+                with socket.create_connection((host, int(port)), timeout=2) as sock:
+                    sock.sendall(data)
+            else:
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                    sock.sendto(data, (host, int(port)))
+        else:
+            with open(self.target, 'ab') as f:
+                f.write(data)
+
+
+class AlertEngine:
+    "evaluates every rule against the history after each watch tick and sends the state changes"
+
+    def __init__(self, rules: list, sink: AlertSink=None) -> None:
+        self.rules = rules
+        self.sink = sink
+
+    def evaluate(self, history: HistoryStore, now: float, total_memory: int) -> list:
+        "return the events (dicts) of this tick, after sending them"
+        events = []
+        for rule in self.rules:
+            change = rule.evaluate(history, now, total_memory)
+            if change is None:
+                continue
+            state, value = change
+            event = {'record': 'alert', 'time': round(now, 3), 'rule': rule.text, 'state': state, 'metric': rule.metric, 'value': round(value, 2)}
+            events.append(event)
+            if self.sink is not None:
+                self.sink.send(event)
+        return events
+
+    def firing(self) -> list:
+        return [rule for rule in self.rules if rule.firing]
+
+
+def alert_report(engine: AlertEngine, events: list) -> list:
+    "return the lines of the alerts section: this tick's changes, then every rule still firing"
+    lines = ["\nAlerts:"]
+    lines += [f"{event['state'].upper()}: {event['rule']} (value {event['value']})" for event in events]
+    changed = {event['rule'] for event in events}
+    lines += [f"firing: {rule.text}" for rule in engine.firing() if rule.text not in changed]
+    if len(lines) == 1:
+        lines.append("none firing")
+    return lines
+
+
+#------------------------------------------------------------STRUCTURED OUTPUT----------------------------------------------------------------------
+OUTPUT_FORMATS = ('text', 'json', 'ndjson', 'csv')
+
+
+class RecordWriter:
+    "writes report records as json, ndjson or csv one at a time, so a long process list is never held in memory as text"
+
+    CSV_COLUMNS = ('record', 'time', 'name', 'program', 'pid', 'processes', 'kb', 'pss_kb', 'uss_kb', 'limit_kb', 'value')
+
+    def __init__(self, fmt: str, stream: object=None) -> None:
+        if fmt not in OUTPUT_FORMATS[1:]:
+            raise ValueError(f"unknown output format {fmt!r}, expected one of {OUTPUT_FORMATS[1:]}")
+        self.fmt = fmt
+        self.stream = stream if stream is not None else sys.stdout
+        self.count = 0 # records written so far
+        if fmt == 'csv':
+            self.csv = csv.DictWriter(self.stream, self.CSV_COLUMNS, lineterminator='\n')
+            self.csv.writeheader()
+        elif fmt == 'json':
+            self.stream.write('[') # one array, written element by element and closed in close()
+
+    def write(self, record: dict) -> None:
+        "write one record (a dict using the CSV_COLUMNS keys, plus 'fields' for meminfo in json)"
+        if self.fmt == 'csv':
+            self.csv.writerow(record)
+        else:
+            text = json.dumps(record, separators=(',', ':'))
+            if self.fmt == 'json':
+                self.stream.write(('\n' if self.count == 0 else ',\n') + text)
+            else:
+                self.stream.write(text + '\n')
+        self.count += 1
+
+    def meminfo(self, snapshot: MemInfo, when: float) -> None:
+        "write a meminfo snapshot: one record with every field, or one CSV row per field"
+        if self.fmt == 'csv':
+            for key, value in snapshot.fields.items():
+                self.write({'record': 'meminfo', 'time': when, 'name': key, 'kb': value})
+        else:
+            self.write({'record': 'meminfo', 'time': when, 'fields': snapshot.fields})
+
+    @staticmethod
+    def sizes(mem: object) -> dict:
+        "the size columns for an RSS figure in kB, or for a SmapsTotals (which adds PSS and USS)"
+        if isinstance(mem, SmapsTotals):
+            return {'kb': mem.rss, 'pss_kb': mem.pss, 'uss_kb': mem.uss}
+        return {'kb': mem}
+
+    def program(self, name: str, mem_by_pid: dict, when: float, per_pid: bool=False) -> None:
+        "write the total for one program, then one record per PID when per_pid is set"
+        self.write({'record': 'program', 'time': when, 'name': name, 'processes': len(mem_by_pid), **self.sizes(sum(mem_by_pid.values()))})
+        if per_pid:
+            for pid, mem in mem_by_pid.items():
+                self.write({'record': 'process', 'time': when, 'name': name, 'pid': int(pid), **self.sizes(mem)})
+
+    def mappings(self, name: str, mappings: dict, when: float, n: int) -> None:
+        "write the n largest mappings of a program, one record each"
+        for label, kb in heapq.nlargest(n, mappings.items(), key=lambda item: item[1]):
+            self.write({'record': 'mapping', 'time': when, 'name': label, 'program': name, 'kb': kb})
+
+    def tree(self, name: str, tree: ProcessTree, roots: list, mem_by_pid: dict, when: float) -> None:
+        "write one record per process of the tree with the memory and process count of its subtree"
+        empty = SmapsTotals() if any(isinstance(mem, SmapsTotals) for mem in mem_by_pid.values()) else 0
+        for root in roots:
+            for pid, (total, count) in tree.totals(root, mem_by_pid, empty).items():
+                self.write({'record': 'tree', 'time': when, 'name': name, 'pid': int(pid), 'processes': count, **self.sizes(total)})
+
+    def pressure(self, meminfo: MemInfo, sample: PressureSample, rates: dict, when: float) -> None:
+        "write swap use, the PSI averages and stall time (%) and every VM event rate (per second), one record each"
+        self.write({'record': 'pressure', 'time': when, 'name': 'swap.used', 'kb': meminfo.get('SwapTotal') - meminfo.get('SwapFree')})
+        for kind, values in (sample.psi or {}).items():
+            for key in ('avg10', 'avg60', 'avg300'):
+                self.write({'record': 'pressure', 'time': when, 'name': f'psi.{kind}.{key}', 'value': values.get(key, 0.0)})
+            if f'psi.{kind}' in rates: # pressure_rates() gives the stalled fraction, the averages above are percentages
+                self.write({'record': 'pressure', 'time': when, 'name': f'psi.{kind}.stalled', 'value': round(rates[f'psi.{kind}'] * 100, 3)})
+        for name, rate in rates.items():
+            if not name.startswith('psi.'): # only VM events are rates
+                self.write({'record': 'pressure', 'time': when, 'name': f'rate.{name}', 'value': round(rate, 3)})
+
+    def leaks(self, name: str, leaks: list, when: float) -> None:
+        "write one record per growing process; value is its growth in kB per hour"
+        for pid, trend, growth in leaks:
+            self.write({'record': 'leak', 'time': when, 'name': name, 'pid': int(pid), 'kb': trend.last, 'value': round(trend.slope * 3600, 1)})
+
+    def cgroups(self, groups: list, when: float) -> None:
+        "write one record per cgroup with its usage and limit"
+        for group in groups:
+            self.write({'record': 'cgroup', 'time': when, 'name': group.path, 'kb': group.current, 'limit_kb': group.limit})
+
+    def flush(self) -> None:
+        self.stream.flush()
+
+    def close(self) -> None:
+        "finish the output (closes the json array) and flush it"
+        if self.fmt == 'json':
+            self.stream.write('\n]\n' if self.count else ']\n')
+        self.flush()
+
+
+#------------------------------------------------------------REPORTS AND WATCH MODE----------------------------------------------------------------------
+def system_report(meminfo: MemInfo, length: int=20) -> list:
+    "return the lines of the total system memory section for one meminfo snapshot"
+    total_memory = get_sys_mem(meminfo)  # Fetch the total system memory
+    available_memory = get_avail_mem(meminfo)  # Fetch the available system memory
     used_memory = total_memory - available_memory  # This is to calculate used memory
     mem_percent = (used_memory / total_memory) * 100  # This is to calculate the percentage of memory used
 
-    # Display memory usage as a graph
-    print(f"Total Memory: {total_memory} kB")
-    print(f"Used Memory: {used_memory} kB")
-    print(f"Available Memory: {available_memory} kB")
+    return [f"Total Memory: {total_memory} kB",
+            f"Used Memory: {used_memory} kB",
+            f"Available Memory: {available_memory} kB",
+            f"Memory Usage: {percent_to_graph(mem_percent / 100, length)}", # percent_to_graph() wants 0.0 - 1.0
+            f"Memory Usage Percentage: {mem_percent:.2f}%"]
+
+
+def program_report(program_name: str, mem_by_pid: dict, human_readable: bool=False) -> list:
+    "return the lines of the memory section for one program, given the RSS (or SmapsTotals) of each of its PIDs"
+    lines = [f"\nMemory usage for processes related to {program_name}:"]
+    if not mem_by_pid:
+        return lines + [f"No running processes found for {program_name}."]
+    totals = sum(mem_by_pid.values())  # Add up the memory used by all processes of the program
+    total_prog_mem = totals.rss if isinstance(totals, SmapsTotals) else totals
+    lines.append(f"Total Memory Used by {program_name}: {total_prog_mem} kB")
+    if human_readable: # This adds the total memory in a human readable format
+        lines.append(f"Total Memory Used by {program_name} (Human Readable): {bytes_to_human_r(total_prog_mem)}")
+    if isinstance(totals, SmapsTotals): # shared pages are counted once per process in RSS, PSS and USS do not double count them
+        for label, kb in (("Proportional Memory (PSS)", totals.pss), ("Unique Memory (USS)", totals.uss)):
+            lines.append(f"{label} of {program_name}: {kb} kB" + (f" ({bytes_to_human_r(kb)})" if human_readable else ""))
+    return lines
+
+
+def top_report(rows: list, total_memory: int, length: int=20, human_readable: bool=False, title: str=None) -> list:
+    "return the lines of the top programs (or program groups) table, one percent_to_graph bar per row"
+    pss = bool(rows) and isinstance(rows[0][1], SmapsTotals) # rows from top_programs(pss=True) are ranked and drawn by PSS
+    kind = 'proportional (PSS)' if pss else 'resident'
+    lines = [f"\n{title or f'Top {len(rows)} programs'} by {kind} memory:"]
+    width = max([len(name) for name, mem, count in rows] + [7])
+    size = bytes_to_human_r if human_readable else (lambda kb: f"{kb} kB")
+    for name, mem, count in rows:
+        kb = mem.pss if pss else mem
+        line = f"{name:<{width}} {count:>5} procs [{percent_to_graph(kb / total_memory, length)}] {size(kb):>12} {kb / total_memory * 100:6.2f}%"
+        if pss:
+            line += f"  rss {size(mem.rss)}  uss {size(mem.uss)}"
+        lines.append(line)
+    return lines
+
+
+def tree_report(program_name: str, tree: ProcessTree, roots: list, mem_by_pid: dict, names: dict, total_memory: int, length: int=20) -> list:
+    "return an indented tree of the program's processes and their children, each with a bar of its subtree's memory"
+    pss = any(isinstance(mem, SmapsTotals) for mem in mem_by_pid.values())
+    empty = SmapsTotals() if pss else 0
+    lines = [f"\nProcess tree of {program_name} ({'PSS' if pss else 'RSS'} of each process and everything below it):"]
+    for root in roots:
+        totals = tree.totals(root, mem_by_pid, empty)
+        for pid, depth in tree.walk(root):
+            total, count = totals[pid]
+            kb = total.pss if pss else total
+            name = (names.get(pid) or ('?',))[0]
+            below = f" ({count} processes)" if count > 1 else ""
+            lines.append(f"[{percent_to_graph(kb / total_memory, length)}] {bytes_to_human_r(kb):>12} {'  ' * depth}{name} [{pid}]{below}")
+    return lines
+
+
+def mappings_report(program_name: str, mappings: dict, n: int, field: str='Rss', length: int=20, human_readable: bool=False) -> list:
+    "return the n mappings holding the most of a program's memory, with a bar for each one's share"
+    total = sum(mappings.values())
+    lines = [f"\nTop mappings of {program_name} by {field}:"]
+    if not total:
+        return lines + ["No mappings could be read."]
+    size = bytes_to_human_r if human_readable else (lambda kb: f"{kb} kB")
+    for label, kb in heapq.nlargest(n, mappings.items(), key=lambda item: item[1]):
+        lines.append(f"[{percent_to_graph(kb / total, length)}] {size(kb):>12} {kb / total * 100:6.2f}%  {label}")
+    return lines
+
+
+def cgroup_report(groups: list, total_memory: int, length: int=20, human_readable: bool=False) -> list:
+    "return one line per cgroup, indented by depth, with a bar of its usage against its limit (or total_memory)"
+    if not groups:
+        return ["\nNo cgroup v2 memory usage could be read."]
+    size = bytes_to_human_r if human_readable else (lambda kb: f"{kb} kB")
+    lines = ["\nMemory by cgroup:"]
+    for group in groups:
+        limit = group.limit if group.limit is not None else total_memory
+        depth = group.path.strip('/').count('/') + 1 if group.path != '/' else 0
+        name = '  ' * depth + (group.path.rsplit('/', 1)[-1] or '/')
+        of = f"/ {size(group.limit)}" if group.limit is not None else "(no limit)"
+        lines.append(f"[{percent_to_graph(min(1.0, group.current / limit) if limit else 0.0, length)}] {size(group.current):>12} {of:<16} {name}")
+    return lines
+
+
+def history_report(history: HistoryStore, names: list, window: float, total_memory: int, length: int=20, human_readable: bool=False) -> list:
+    "return min/avg/max bars for each metric over the last window seconds: sizes as a share of total memory, PSI out of 100%, rates log scaled"
+    lines = [f"\nHistory over the last {window:g}s:"]
+    width = max([len(name) for name in names] + [11])
+    size = bytes_to_human_r if human_readable else (lambda kb: f"{kb:.0f} kB")
+    scales = {'kB': (lambda kb: percent_to_graph(kb / total_memory, length), size),
+              '%': (lambda pct: percent_to_graph(pct / 100, length), lambda pct: f"{pct:.2f}%"),
+              '/s': (lambda rate: rate_graph(rate, length), lambda rate: f"{rate:.1f}/s")}
+    for name in names:
+        stats = history.stats(name, window)
+        if stats is None:
+            continue
+        low, avg, high, samples = stats
+        graph, show = scales[metric_unit(name)]
+        for label, value in (("min", low), ("avg", avg), ("max", high)):
+            lines.append(f"{name if label == 'min' else '':<{width}} {label} [{graph(value)}] {show(value):>12}"
+                         + (f"  ({samples} samples)" if label == 'min' else ""))
+    return lines
+
+
+def write_records(writer: RecordWriter, args: object, meminfo: MemInfo, mem_by_pid: dict=None, rows: list=None, mappings: dict=None, groups: list=None, tree: tuple=None, pressure: tuple=None, leaks: list=None) -> None:
+    "write what the text report would show as records: meminfo, pressure, cgroups, then the program (mem_by_pid, mappings) or top programs (rows)"
+    when = round(time.time(), 3)
+    writer.meminfo(meminfo, when)
+    if pressure is not None:
+        writer.pressure(meminfo, pressure[0], pressure[1], when)
+    if groups is not None:
+        writer.cgroups(groups, when)
+    if args.program and mem_by_pid is not None:
+        writer.program(args.program, mem_by_pid, when, args.per_pid)
+    if args.program and mappings:
+        writer.mappings(args.program, mappings, when, args.mappings)
+    if args.program and tree is not None:
+        writer.tree(args.program, tree[0], tree[1], mem_by_pid, when)
+    if args.program and leaks is not None:
+        writer.leaks(args.program, leaks, when)
+    for name, mem, count in rows or ():
+        writer.write({'record': 'program', 'time': when, 'name': name, 'processes': count, **writer.sizes(mem)})
+    writer.flush()
+
+
+def tree_pids(args: object, index: ProcessIndex, proc: ProcSource) -> tuple:
+    "with --tree, return (tree, roots, every pid in their subtrees) for args.program, built from one read of each stat"
+    tree = ProcessTree(proc).scan(list(index.names)) # the PIDs the index already listed, /proc is not scanned again
+    roots = tree.roots(index.pids(args.program, args.match))
+    return tree, roots, [pid for root in roots for pid, depth in tree.walk(root)]
 
-    # Graphically display memory usage
-    print(f"Memory Usage: {percent_to_graph(mem_percent, args.length)}")
-    print(f"Memory Usage Percentage: {mem_percent:.2f}%")
 
-    # ---- Program-Specific Memory Section ----
+def group_title(args: object) -> str:
+    "the heading of the rows table: program groups, or the default top programs heading"
+    return f"{len(args.program_groups)} program groups" if args.program_groups else None
+
+
+def history_since(args: object) -> float:
+    "return the time from which logged history is needed (--history-window, and the last minute for rate alerts), None if it is not"
+    span = args.history_window or 0.0
+    if args.alert and any(rule.rate for rule in args.alert):
+        span = max(span, AlertRule.RATE_WINDOW)
+    return time.time() - span if span else None
+
+
+def mapping_field(args: object) -> str:
+    "the smaps field the mapping breakdown adds up: Pss with --pss (shared libraries are not counted once per worker), else Rss"
+    return 'Pss' if args.pss else 'Rss'
+
+
+def container_meminfo(meminfo: MemInfo, args: object, proc: ProcSource, cgroups: ProcSource, quiet: bool=False) -> MemInfo:
+    "with --cgroup, return meminfo as seen from this process's cgroup (its limit and usage), else meminfo unchanged"
+    if not args.cgroup or meminfo is None:
+        return meminfo
+    path = cgroup_of_pid('self', proc)
+    group = read_cgroup(path, cgroups, quiet=quiet) if path else None
+    return group.meminfo(meminfo) if group is not None else meminfo # without a readable group the host numbers are still right
+
+
+def watch(args: object, proc: ProcSource, profile: Profile=NO_PROFILE) -> None:
+    "redraw the report every args.watch seconds from one long lived process until interrupted"
+    # proc should keep files open (keep_open=True) so meminfo and per-PID files are re-read without reopening them
+    meta = MetaCache(proc, args.meta_cache) if args.meta_cache else None # survives between ticks, keyed by (pid, starttime)
+    index = ProcessIndex(proc, meta).scan() if args.program or args.program_groups or args.top else None # the full scan is paid once, then only new PIDs are read
+    clear = "\033[H\033[J" if sys.stdout.isatty() else "\n" # move to the top left and clear, or just separate frames in a pipe
+    writer = RecordWriter(args.output) if args.output != 'text' else None # structured output appends records every tick
+    history = open_history(args.history, args.history_log, args.history_log_max, history_since(args))
+    alerts = AlertEngine(args.alert, AlertSink(args.alert_exec, args.alert_to)) if args.alert else None
+    cgroups = make_cgroup_source(args, proc) if args.cgroup or args.cgroups is not None else None
+    previous = None # the last PressureSample, rates are the change since it
+    try:
+        while True:
+            started = time.monotonic()
+            with profile.stage('meminfo'):
+                meminfo = container_meminfo(read_meminfo(proc), args, proc, cgroups, writer is not None)
+            if meminfo is None or get_sys_mem(meminfo) is None or get_avail_mem(meminfo) is None:
+                sys.exit(1)
+            if index is not None:
+                with profile.stage('pid discovery'):
+                    added, removed = index.refresh() # rescan only the PIDs that appeared, drop the ones that are gone
+                    for pid in removed:
+                        proc.forget_pid(pid)
+            mem_by_pid = rows = mappings = groups = tree = pressure = leaks = None
+            if args.pressure:
+                with profile.stage('pressure'):
+                    sample = read_pressure(proc)
+                    if sample is not None:
+                        pressure = (sample, pressure_rates(sample, previous))
+                        since_boot = previous is None # the first frame has nothing to take a difference from
+                        previous = sample
+            if args.cgroups is not None:
+                with profile.stage('cgroups'):
+                    groups = cgroup_tree(cgroups, '/', args.cgroups)
+            if args.program:
+                with profile.stage('pid discovery'):
+                    if args.tree:
+                        tree = tree_pids(args, index, proc)
+                        pids = tree[2]
+                    else:
+                        pids = index.pids(args.program, args.match)
+                    proc.keep_pids_open(len(pids))
+                with profile.stage('per-pid read'):
+                    mem_by_pid = collect_memory(pids, args.rss_source, args.workers, proc, writer is not None, args.pss, meta)
+                if args.mappings:
+                    with profile.stage('mappings'):
+                        mappings = program_mappings(pids, proc, args.workers, mapping_field(args), True, meta, mem_by_pid)
+                if args.leaks:
+                    with profile.stage('leaks'):
+                        ticked = time.monotonic()
+                        update_trends(mem_by_pid, meta, ticked, LEAK_HALF_LIFE * args.leak_samples)
+                        leaks = check_leaks(pids, meta, proc, args, ticked)
+            elif args.program_groups:
+                proc.keep_pids_open(len(index.names)) # the groups may match most processes
+                with profile.stage('per-pid read'):
+                    rows = collect_program_groups(args.program_groups, index, args.match, args.rss_source, args.workers, proc, args.pss, meta)
+            elif args.top:
+                proc.keep_pids_open(len(index.names)) # --top reads every process
+                with profile.stage('per-pid read'):
+                    rows = top_programs(args.top, index, args.rss_source, args.workers, proc, args.pss)
+            with profile.stage('history'):
+                metrics = history_metrics(meminfo, args.program, mem_by_pid, rows, pressure)
+                now = time.time()
+                history.record(now, metrics)
+                events = alerts.evaluate(history, now, meminfo.total) if alerts is not None else [] # only the samples just recorded, no extra reads
+
+            with profile.stage('output'):
+                if writer is not None: # error text would corrupt the records, so collection above was quiet
+                    write_records(writer, args, meminfo, mem_by_pid, rows, mappings, groups, tree, pressure, leaks)
+                else:
+                    lines = [f"Every {args.watch:g}s: {time.strftime('%Y-%m-%d %H:%M:%S')}", ""]
+                    lines += system_report(meminfo, args.length)
+                    if pressure is not None:
+                        lines += pressure_report(meminfo, pressure[0], pressure[1], since_boot, args.length, args.human_readable)
+                    if groups is not None:
+                        lines += cgroup_report(groups, meminfo.total, args.length, args.human_readable)
+                    if args.program:
+                        lines += program_report(args.program, mem_by_pid, args.human_readable)
+                        if tree is not None:
+                            lines += tree_report(args.program, tree[0], tree[1], mem_by_pid, index.names, meminfo.total, args.length)
+                        if mappings is not None:
+                            lines += mappings_report(args.program, mappings, args.mappings, mapping_field(args), args.length, args.human_readable)
+                        if leaks is not None:
+                            lines += leak_report(leaks, index.names, ticked, args.human_readable)
+                    elif rows is not None:
+                        lines += top_report(rows, meminfo.total, args.length, args.human_readable, group_title(args))
+                    if args.history_window:
+                        lines += history_report(history, list(metrics), args.history_window, meminfo.total, args.length, args.human_readable)
+                    if alerts is not None:
+                        lines += alert_report(alerts, events)
+                    print(clear + "\n".join(lines), flush=True)
+            time.sleep(max(0.0, args.watch - (time.monotonic() - started))) # keep a steady interval however long collection took
+    except KeyboardInterrupt:
+        if writer is None:
+            print()
+    finally:
+        if meta is not None:
+            profile.cache('process metadata', meta.hits, meta.misses)
+            if args.mappings or args.leaks:
+                profile.cache('mapping layouts', meta.layout_hits, meta.layout_misses)
+        history.close()
+        proc.close()
+        if cgroups is not None:
+            cgroups.close()
+        if writer is not None: # last, it writes to stdout and can fail if the reader went away
+            writer.close()
+
+
+def report(args: object, proc: ProcSource, profile: Profile=NO_PROFILE) -> None:
+    "print the report once, as text or as records"
+    # Total System Memory Section 
+    structured = args.output != 'text'
+    cgroups = make_cgroup_source(args, proc) if args.cgroup or args.cgroups is not None else None
+    with profile.stage('meminfo'):
+        meminfo = read_meminfo(proc)  # Read /proc/meminfo once so both values come from the same moment
+        meminfo = container_meminfo(meminfo, args, proc, cgroups, structured)  # With --cgroup, the container's limit is the total
+    groups = None
+    if args.cgroups is not None:
+        with profile.stage('cgroups'):
+            groups = cgroup_tree(cgroups, '/', args.cgroups)  # Per cgroup counters, no per-PID reads
+
+    if get_sys_mem(meminfo) is None or get_avail_mem(meminfo) is None:
+        sys.exit(1)  # Exit the program if fetching memory info failed.
+
+    mem_by_pid = rows = mappings = tree = pressure = None
+    if args.pressure: # Swap, page cache, PSI and VM event rates; one sample, so the rates are averages since boot
+        with profile.stage('pressure'):
+            sample = read_pressure(proc)
+            if sample is not None:
+                pressure = (sample, pressure_rates(sample))
+
     if args.program:  # If a program name is provided
-        program_name = args.program
-        print(f"\nMemory usage for processes related to {program_name}:")
-        pids = pids_of_prog(program_name)  # Get all PIDs for the program
-
-        if pids:
-            total_prog_mem = 0  # To store the total memory used by all processes of the program
-            for pid in pids:
-                total_prog_mem += rss_mem_of_pid(pid)  # Add RSS memory of each PID
-            
-            print(f"Total Memory Used by {program_name}: {total_prog_mem} kB")
-            
-            if args.human_readable: # This prints the total memory in a human readable format
-                print(f"Total Memory Used by {program_name} (Human Readable): {bytes_to_human_r(total_prog_mem)}")
+        with profile.stage('pid discovery'):
+            if args.tree: # The program's processes and every process they started, whatever its name
+                index = ProcessIndex(proc).scan()
+                tree = tree_pids(args, index, proc)
+                pids = tree[2]
+            else:
+                pids = pids_of_prog(args.program, args.match, proc=proc)  # Get all PIDs for the program
+        with profile.stage('per-pid read'):
+            mem_by_pid, elapsed = timed_collect_memory(pids, args.rss_source, args.workers, args.pss, proc, structured)  # Read the memory of each PID
+        if args.mappings: # Which files and anonymous regions that memory is in
+            with profile.stage('mappings'):
+                mappings = program_mappings(pids, proc, args.workers, mapping_field(args), quiet=True)
+    elif args.program_groups or args.top: # Several programs at once, or the programs using the most memory
+        started = time.perf_counter()
+        with profile.stage('pid discovery'):
+            index = ProcessIndex(proc).scan() # one scan answers every group
+        with profile.stage('per-pid read'):
+            if args.program_groups:
+                rows = collect_program_groups(args.program_groups, index, args.match, args.rss_source, args.workers, proc, args.pss)
+            else:
+                rows = top_programs(args.top, index, args.rss_source, args.workers, proc, args.pss)
+        elapsed = time.perf_counter() - started
+
+    history = None
+    if args.history_log: # a one-shot run adds its sample to the log, so runs from cron build up a history too
+        with profile.stage('history'):
+            history = open_history(args.history, args.history_log, args.history_log_max, history_since(args))
+            metrics = history_metrics(meminfo, args.program, mem_by_pid, rows, pressure)
+            history.record(time.time(), metrics)
+            history.close()
+
+    with profile.stage('output'):
+        if structured: # Machine readable records instead of the text report
+            writer = RecordWriter(args.output)
+            write_records(writer, args, meminfo, mem_by_pid, rows, mappings, groups, tree, pressure)
+            writer.close()
+            return
+
+        # Display memory usage, with a graph
+        print("\n".join(system_report(meminfo, args.length)))
+        if pressure is not None:
+            print("\n".join(pressure_report(meminfo, pressure[0], pressure[1], True, args.length, args.human_readable)))
+        if groups is not None:
+            print("\n".join(cgroup_report(groups, meminfo.total, args.length, args.human_readable)))
+
+        # ---- Program-Specific Memory Section ----
+        if args.program:
+            print("\n".join(program_report(args.program, mem_by_pid, args.human_readable)))
+            if tree is not None:
+                print("\n".join(tree_report(args.program, tree[0], tree[1], mem_by_pid, index.names, meminfo.total, args.length)))
+            if mappings is not None:
+                print("\n".join(mappings_report(args.program, mappings, args.mappings, mapping_field(args), args.length, args.human_readable)))
+
+            if mem_by_pid and args.timing: # This shows the wall clock time of the collection, and of the serial path for comparison
+                print(f"Collected {len(pids)} processes in {elapsed * 1000:.2f} ms using {args.workers or 'auto'} worker(s)")
+                if args.workers != 1:
+                    serial_elapsed = timed_collect_memory(pids, args.rss_source, 1, args.pss, proc)[1]
+                    print(f"Serial collection took {serial_elapsed * 1000:.2f} ms ({serial_elapsed / elapsed:.2f}x)")
+
+        elif rows is not None: # No single program, so show the groups or the programs using the most memory
+            print("\n".join(top_report(rows, meminfo.total, args.length, args.human_readable, group_title(args))))
+            if args.timing:
+                print(f"Scanned and collected {'every group' if args.program_groups else 'every process'} in {elapsed * 1000:.2f} ms using {args.workers or 'auto'} worker(s)")
+
+        if history is not None and args.history_window:
+            print("\n".join(history_report(history, list(metrics), args.history_window, meminfo.total, args.length, args.human_readable)))
+
+
+#------------------------------------------------------------EXPORTER----------------------------------------------------------------------
+def prometheus_label(value: str) -> str:
+    "escape a label value for the Prometheus text format"
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_metrics(meminfo: MemInfo, programs: dict, elapsed: float, when: float) -> str:
+    "render one collection as Prometheus text format; programs maps a name to (kB or SmapsTotals, process count)"
+    out = []
+
+    def metric(name: str, kind: str, description: str, samples: list) -> None:
+        out.append(f"# HELP memvis_{name} {description}")
+        out.append(f"# TYPE memvis_{name} {kind}")
+        for labels, value in samples:
+            out.append(f"memvis_{name}{labels} {value}")
+
+    metric('memory_total_bytes', 'gauge', 'Total memory (MemTotal, or the cgroup limit with --cgroup).', [('', get_sys_mem(meminfo) * 1024)])
+    metric('memory_available_bytes', 'gauge', 'Available memory (MemAvailable).', [('', get_avail_mem(meminfo) * 1024)])
+    metric('memory_used_bytes', 'gauge', 'Total minus available memory.', [('', meminfo.used * 1024)])
+    labelled = [(f'{{program="{prometheus_label(name)}"}}', mem, count) for name, (mem, count) in programs.items()]
+    metric('program_processes', 'gauge', 'Processes of the program.', [(labels, count) for labels, mem, count in labelled])
+    metric('program_rss_bytes', 'gauge', 'Resident memory of all processes of the program.',
+           [(labels, (mem.rss if isinstance(mem, SmapsTotals) else mem) * 1024) for labels, mem, count in labelled])
+    pss = [(labels, mem) for labels, mem, count in labelled if isinstance(mem, SmapsTotals)]
+    if pss: # only with --pss, RSS alone does not have them
+        metric('program_pss_bytes', 'gauge', 'Proportional set size of the program (shared pages split between their users).', [(labels, mem.pss * 1024) for labels, mem in pss])
+        metric('program_uss_bytes', 'gauge', 'Unique set size of the program (memory only it maps).', [(labels, mem.uss * 1024) for labels, mem in pss])
+    metric('collect_duration_seconds', 'gauge', 'How long the last collection took.', [('', f'{elapsed:.6f}')])
+    metric('last_collect_timestamp_seconds', 'gauge', 'When the last collection finished.', [('', f'{when:.3f}')])
+    return "\n".join(out) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    "answers GET /metrics from the exporter's cached snapshot, never from /proc"
+
+    def do_GET(self) -> None:
+        if self.path.split('?', 1)[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = self.server.exporter.body # one reference read, the collector swaps in a whole new snapshot
+        if body is None:
+            self.send_error(503, "no collection has finished yet")
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass # scrapes every few seconds would flood the terminal
+
+
+class Exporter:
+    "collects on a background thread every interval seconds and keeps the rendered metrics for scrapes to share"
+
+    def __init__(self, args: object, proc: ProcSource) -> None:
+        self.args = args
+        self.proc = proc
+        self.interval = args.serve_interval
+        self.meta = MetaCache(proc, args.meta_cache) if args.meta_cache else None
+        self.index = ProcessIndex(proc, self.meta).scan() if args.program or args.program_groups or args.top else None
+        self.cgroups = make_cgroup_source(args, proc) if args.cgroup else None
+        self.body = None # bytes of the last snapshot, None until the first collection
+        self.stop = threading.Event()
+
+    def collect(self) -> bytes:
+        "read everything once and render it"
+        args = self.args
+        started = time.perf_counter()
+        meminfo = container_meminfo(read_meminfo(self.proc), args, self.proc, self.cgroups, quiet=True)
+        if meminfo is None or get_sys_mem(meminfo) is None or get_avail_mem(meminfo) is None:
+            return None
+        programs = {}
+        if self.index is not None:
+            for pid in self.index.refresh()[1]:
+                self.proc.forget_pid(pid)
+        if args.program:
+            pids = self.index.pids(args.program, args.match)
+            self.proc.keep_pids_open(len(pids))
+            mem_by_pid = collect_memory(pids, args.rss_source, args.workers, self.proc, True, args.pss, self.meta)
+            programs[args.program] = (sum(mem_by_pid.values()) if mem_by_pid else (SmapsTotals() if args.pss else 0), len(pids))
+        elif args.program_groups or args.top:
+            self.proc.keep_pids_open(len(self.index.names))
+            if args.program_groups:
+                rows = collect_program_groups(args.program_groups, self.index, args.match, args.rss_source, args.workers, self.proc, args.pss, self.meta)
+            else:
+                rows = top_programs(args.top, self.index, args.rss_source, args.workers, self.proc, args.pss)
+            for name, mem, count in rows:
+                programs[name] = (mem, count)
+        return prometheus_metrics(meminfo, programs, time.perf_counter() - started, time.time()).encode()
+
+    def run(self) -> None:
+        "the collector thread: collect, publish, wait for the next tick"
+        while not self.stop.is_set():
+            started = time.monotonic()
+            try:
+                body = self.collect()
+                if body is not None:
+                    self.body = body
+            except Exception as e: # keep serving the last good snapshot
+                print(f"Error while collecting metrics: {e}", file=sys.stderr)
+            self.stop.wait(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def close(self) -> None:
+        self.stop.set()
+        if self.cgroups is not None:
+            self.cgroups.close()
+
+
+def serve(args: object, proc: ProcSource) -> None:
+    "serve the metrics on args.serve until interrupted; a burst of scrapes shares one collection"
+    exporter = Exporter(args, proc)
+    try:
+        server = ThreadingHTTPServer((args.serve_bind, args.serve), MetricsHandler)
+    except OSError as e:
+        print(f"Error: cannot listen on {args.serve_bind or '*'}:{args.serve}: {e}")
+        sys.exit(1)
+    server.exporter = exporter
+    collector = threading.Thread(target=exporter.run, name='collector', daemon=True)
+    collector.start()
+    print(f"Serving metrics on http://{args.serve_bind or '0.0.0.0'}:{server.server_address[1]}/metrics every {args.serve_interval:g}s", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print()
+    finally:
+        server.server_close()
+        exporter.close()
+        collector.join(timeout=5)
+        proc.close()
+
+
+def make_cgroup_source(args: object, proc: ProcSource) -> ProcSource:
+    "the cgroup hierarchy that goes with proc: recorded into and replayed from the same snapshot, else --cgroup-root"
+    if args.replay:
+        return proc.attached('cgroups')
+    if args.record:
+        return proc.attach('cgroups', RecordingSource(args.cgroup_root))
+    return ProcSource(args.cgroup_root, keep_open=args.watch is not None or args.serve is not None)
+
+
+def make_source(args: object) -> ProcSource:
+    "build the data source the command line asks for: a recording to replay, a recorder, or a /proc directory"
+    if args.replay:
+        try:
+            return RecordedSource(args.replay)
+        except (OSError, ValueError, KeyError) as e: # missing file, not JSON, or not one of our snapshots
+            print(f"Error: cannot replay {args.replay}: {e}")
+            sys.exit(1)
+    if args.record:
+        return RecordingSource(args.proc_root)
+    return ProcSource(args.proc_root, keep_open=args.watch is not None) # only worth holding descriptors when reading repeatedly
+
+
+if __name__ == "__main__":
+
+    args = parse_command_args() # Call the `parse_command_args()` function to parse the command-line arguments passed to the script
+    proc = make_source(args) # Where /proc data is read from
+    profile = Profile() if args.profile else NO_PROFILE # Without --profile nothing is counted and proc is not wrapped
+    if args.profile:
+        proc = ProfiledSource(proc, profile)
+
+    try:
+        if args.serve is not None: # Keep running and answer Prometheus scrapes until Ctrl-C
+            serve(args, proc)
+        elif args.watch is not None: # Keep running and redraw the report until Ctrl-C
+            watch(args, proc, profile)
         else:
-            print(f"No running processes found for {program_name}.")
+            report(args, proc, profile)
+    except BrokenPipeError: # the reader of our output went away, e.g. `-o ndjson | head`
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno()) # so flushing stdout at exit does not fail a second time
+        sys.exit(1)
+    finally:
+        if args.record: # Save everything that was read so it can be replayed with --replay
+            proc.save(args.record)
+        if args.profile and args.profile_format == 'json': # On stderr, so it never mixes with the report or its records on stdout
+            print(json.dumps(profile.as_dict()), file=sys.stderr)
+        elif args.profile:
+            print("\n".join(profile.summary()), file=sys.stderr)
 
     # process args
     # if no parameter passed, 
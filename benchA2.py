@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+'''
+OPS445 Assignment 2
+Program: benchA2.py
+Author: "Ranmunige Senitha Ransen Rajapaksha"
+Semester: "Fall 2024"
+
+Description: Benchmarks for the collection hot paths in assignment2.py. A synthetic /proc tree with a
+configurable number of processes, mappings per process and programs is built in a temporary directory,
+then get_sys_mem, get_avail_mem, pids_of_prog, rss_mem_of_pid, mapping_breakdown and an end-to-end report are timed against it.
+Throughput and p50/p99 latency are printed, can be appended to a results file, and can be compared with
+an earlier run from that file to catch regressions.
+
+Usage: python3 ./benchA2.py --processes 2000 --mappings 200 --results bench_results.ndjson --baseline bench_results.ndjson
+'''
+
+import argparse
+import json
+import os, sys
+import platform
+import shutil
+import tempfile
+import time
+from importlib import import_module
+
+a2 = import_module('assignment2')
+
+
+def parse_command_args() -> object:
+    "parse the benchmark options"
+    parser = argparse.ArgumentParser(description="Benchmark the memory collection hot paths of assignment2.py on a synthetic /proc tree")
+    parser.add_argument("-p", "--processes", type=int, default=1000, help="Number of synthetic processes. Default is 1000.")
+    parser.add_argument("-m", "--mappings", type=int, default=100, help="Mappings in each process's smaps, this sets the smaps size. Default is 100.")
+    parser.add_argument("-g", "--programs", type=int, default=50, help="Number of distinct program names the processes are spread over. Default is 50.")
+    parser.add_argument("-n", "--repeat", type=int, default=200, help="Timed runs of each case. Default is 200.")
+    parser.add_argument("-r", "--results", metavar="FILE", help="Append this run's results to FILE (one JSON object per line).")
+    parser.add_argument("-b", "--baseline", metavar="FILE", help="Compare with the last run recorded in FILE.")
+    parser.add_argument("-t", "--threshold", type=float, default=0.20, help="Relative p50 slowdown counted as a regression. Default is 0.20 (20%%).")
+    return parser.parse_args()
+
+
+#------------------------------------------------------------SYNTHETIC /proc----------------------------------------------------------------------
+MEMINFO = ('MemTotal:       32593367 kB\n'
+           'MemFree:         1917640 kB\n'
+           'MemAvailable:   25124192 kB\n'
+           'Buffers:         1908176 kB\n'
+           'Cached:         20887140 kB\n'
+           'SwapCached:            0 kB\n'
+           'Active:          8902796 kB\n'
+           'Inactive:       17753404 kB\n'
+           'SwapTotal:       8388604 kB\n'
+           'SwapFree:        8388604 kB\n'
+           'Dirty:               312 kB\n'
+           'Writeback:             0 kB\n'
+           'Shmem:            813468 kB\n'
+           'HugePages_Total:       0\n'
+           'Hugepagesize:       2048 kB\n')
+
+MAPPING = ('{start:012x}-{end:012x} r-xp 00000000 08:01 {inode:<10} /usr/lib/x86_64-linux-gnu/lib{n}.so\n'
+           'Size:                 {size} kB\n'
+           'KernelPageSize:        4 kB\n'
+           'MMUPageSize:           4 kB\n'
+           'Rss:                  {rss} kB\n'
+           'Pss:                  {pss} kB\n'
+           'Shared_Clean:         {shared} kB\n'
+           'Shared_Dirty:          0 kB\n'
+           'Private_Clean:         0 kB\n'
+           'Private_Dirty:        {private} kB\n'
+           'Referenced:           {rss} kB\n'
+           'Anonymous:            {private} kB\n'
+           'LazyFree:              0 kB\n'
+           'AnonHugePages:         0 kB\n'
+           'Swap:                  0 kB\n'
+           'SwapPss:               0 kB\n'
+           'Locked:                0 kB\n'
+           'VmFlags: rd ex mr mw me sd\n')
+
+
+def build_proc_tree(root: str, processes: int, mappings: int, programs: int) -> dict:
+    "write a fake /proc under root and return {program name: [pids]}"
+    with open(os.path.join(root, 'meminfo'), 'w') as f:
+        f.write(MEMINFO)
+    by_program = {}
+    for i in range(processes):
+        pid = str(1000 + i)
+        name = f'prog{i % programs}'
+        by_program.setdefault(name, []).append(pid)
+        pid_dir = os.path.join(root, pid)
+        os.mkdir(pid_dir)
+        with open(os.path.join(pid_dir, 'comm'), 'w') as f:
+            f.write(name + '\n')
+        with open(os.path.join(pid_dir, 'cmdline'), 'w') as f:
+            f.write(f'/usr/bin/{name}\0--worker\0{i}\0')
+        with open(os.path.join(pid_dir, 'stat'), 'w') as f:
+            f.write(f"{pid} ({name}) S 1 {pid} {pid} 0 -1 4194560 {' '.join(['0'] * 12)} {5000 + i} 10485760 2048\n")
+        smaps = []
+        totals = a2.SmapsTotals()
+        for n in range(mappings):
+            rss, private = 8 + n % 64, n % 8
+            smaps.append(MAPPING.format(start=0x7f0000000000 + n * 0x10000, end=0x7f0000000000 + n * 0x10000 + 0x8000,
+                                        inode=n, n=n, size=rss * 2, rss=rss, pss=private + (rss - private) // 4,
+                                        shared=rss - private, private=private))
+            totals = totals + a2.SmapsTotals(rss=rss, pss=private + (rss - private) // 4, shared_clean=rss - private, private_dirty=private)
+        with open(os.path.join(pid_dir, 'smaps'), 'w') as f:
+            f.write(''.join(smaps))
+        with open(os.path.join(pid_dir, 'smaps_rollup'), 'w') as f:
+            f.write('7f0000000000-7fffffffffff ---p 00000000 00:00 0                          [rollup]\n')
+            f.write(''.join(f'{key}: {getattr(totals, attr):>12} kB\n' for key, attr in a2.SmapsTotals.FIELDS.items()))
+        with open(os.path.join(pid_dir, 'statm'), 'w') as f:
+            f.write(f'{totals.rss // a2.PAGE_KB * 4} {totals.rss // a2.PAGE_KB} {totals.shared // a2.PAGE_KB} 180 0 1095 0\n')
+    return by_program
+
+
+#------------------------------------------------------------TIMING----------------------------------------------------------------------
+def percentile(samples: list, pct: float) -> float:
+    "nearest-rank percentile of an already sorted list"
+    rank = max(1, round(pct / 100 * len(samples)))
+    return samples[min(rank, len(samples)) - 1]
+
+
+def time_case(func: object, repeat: int, items: int=1) -> dict:
+    "call func() repeat times after one warm-up call, return latency percentiles (ms) and throughput (items/s)"
+    func() # warm the page cache and any lazily built state
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    total = sum(samples)
+    return {'runs': repeat,
+            'p50_ms': round(percentile(samples, 50) * 1000, 4),
+            'p99_ms': round(percentile(samples, 99) * 1000, 4),
+            'mean_ms': round(total / repeat * 1000, 4),
+            'throughput': round(repeat * items / total, 1) if total else None}
+
+
+def run_cases(root: str, by_program: dict, repeat: int) -> dict:
+    "time every hot path against the synthetic tree at root"
+    proc = a2.ProcSource(root)
+    program = next(iter(by_program))
+    pid = by_program[program][0]
+    pids = by_program[program]
+    results = {}
+    results['get_sys_mem'] = time_case(lambda: a2.get_sys_mem(proc=proc), repeat)
+    results['get_avail_mem'] = time_case(lambda: a2.get_avail_mem(proc=proc), repeat)
+    # scanning /proc is the expensive part, so it runs fewer times
+    results['pids_of_prog'] = time_case(lambda: a2.pids_of_prog(program, proc=proc), max(1, repeat // 10))
+    meta = a2.MetaCache(proc, limit=sum(map(len, by_program.values()))) # warm after time_case's first call
+    results['pids_of_prog[meta]'] = time_case(lambda: a2.pids_of_prog(program, proc=proc, meta=meta), max(1, repeat // 10))
+    index = a2.ProcessIndex(proc).scan()
+    results['index_lookup_all'] = time_case(lambda: index.lookup(list(by_program)), repeat, len(by_program))
+    for source in a2.RSS_SOURCES:
+        results[f'rss_mem_of_pid[{source}]'] = time_case(lambda: a2.rss_mem_of_pid(pid, source, proc), repeat)
+    results['read_smaps_totals[rollup]'] = time_case(lambda: a2.read_smaps_totals(pid, proc=proc), repeat)
+    results['mapping_breakdown'] = time_case(lambda: a2.mapping_breakdown(pid, proc), repeat)
+    results['collect_rss[program]'] = time_case(lambda: a2.collect_rss(pids, proc=proc), max(1, repeat // 10), len(pids))
+
+    def report() -> None:
+        meminfo = a2.read_meminfo(proc)
+        a2.system_report(meminfo)
+        found = a2.pids_of_prog(program, proc=proc)
+        a2.program_report(program, a2.collect_memory(found, proc=proc), True)
+    results['end_to_end_report'] = time_case(report, max(1, repeat // 10))
+    return results
+
+
+#------------------------------------------------------------RESULTS----------------------------------------------------------------------
+def last_run(path: str) -> dict:
+    "return the last run recorded in a results file, None if there is none"
+    try:
+        with open(path, 'r') as f:
+            lines = [line for line in f if line.strip()]
+    except FileNotFoundError:
+        return None
+    return json.loads(lines[-1]) if lines else None
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    "return (case, old p50, new p50, change) for every case whose p50 got slower by more than threshold"
+    regressions = []
+    for case, now in results.items():
+        before = baseline['results'].get(case)
+        if before and before['p50_ms']:
+            change = now['p50_ms'] / before['p50_ms'] - 1
+            if change > threshold:
+                regressions.append((case, before['p50_ms'], now['p50_ms'], change))
+    return regressions
+
+
+if __name__ == "__main__":
+    args = parse_command_args()
+    baseline = last_run(args.baseline) if args.baseline else None # read before this run is appended to the same file
+
+    root = tempfile.mkdtemp(prefix='benchA2-proc-')
+    try:
+        print(f"Building /proc with {args.processes} processes x {args.mappings} mappings in {root} ...")
+        by_program = build_proc_tree(root, args.processes, args.mappings, args.programs)
+        results = run_cases(root, by_program, args.repeat)
+    finally:
+        shutil.rmtree(root)
+
+    print(f"{'case':<28} {'p50 ms':>10} {'p99 ms':>10} {'ops/s':>12}")
+    for case, r in results.items():
+        print(f"{case:<28} {r['p50_ms']:>10.4f} {r['p99_ms']:>10.4f} {r['throughput']:>12}")
+
+    run = {'time': round(time.time(), 3), 'python': platform.python_version(), 'host': platform.node(),
+           'config': {'processes': args.processes, 'mappings': args.mappings, 'programs': args.programs, 'repeat': args.repeat},
+           'results': results}
+    if args.results:
+        with open(args.results, 'a') as f:
+            f.write(json.dumps(run) + '\n')
+
+    if baseline is not None:
+        if baseline.get('config') != run['config']:
+            print("Warning: the baseline was recorded with a different configuration")
+        regressions = compare(results, baseline, args.threshold)
+        for case, before, now, change in regressions:
+            print(f"REGRESSION {case}: p50 {before:.4f} ms -> {now:.4f} ms (+{change:.0%})")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions over {args.threshold:.0%} against the baseline.")
@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
 
 import unittest
+import errno, resource, time
+import argparse
 from random import randint
 import sys, os
+import shutil, tempfile
+import csv, io, json
+import threading, urllib.request
 import subprocess as sp
 from importlib import import_module
 from unittest.mock import mock_open, patch, call
@@ -125,6 +130,44 @@ class TestMemFuncs(unittest.TestCase):
             self.assertEqual(m.call_count, 1, error)
             m.assert_has_calls([call('/proc/meminfo', 'r')])
 
+
+class TestMemInfoSnapshot(unittest.TestCase):
+    "read_meminfo reads every field in one pass and the getters reuse it"
+
+    data = TestMemFuncs.data
+
+    def setUp(self):
+        self.filename = 'assignment2.py'
+        self.pypath = sys.executable
+        error_output = f'{self.filename} cannot be found (HINT: make sure this script AND your file are in the same directory)'
+        file = os.path.join(os.getcwd(), self.filename)
+        self.assertTrue(os.path.exists(file), msg=error_output)
+        try:
+            self.a2 = import_module(self.filename.split('.')[0])
+        except ModuleNotFoundError:
+            print("Cannot find a function inside your assignment2.py. Do not rename or delete any of the required functions.")
+
+    def test_snapshot_fields(self):
+        error = 'ERROR: read_meminfo() should keep every meminfo field from a single open()'
+        m = mock_open(read_data=self.data)
+        with patch('builtins.open', m, create=True):
+            snap = self.a2.read_meminfo()
+            self.assertEqual(m.call_count, 1, error)
+        self.assertEqual(snap['MemTotal'], int(TestMemFuncs.mem1), error)
+        self.assertEqual(snap['Cached'], 20887140, error)
+        self.assertEqual(snap.get('SwapTotal'), 0, error)
+        self.assertFalse(hasattr(snap, '__dict__'), 'ERROR: MemInfo should use __slots__')
+
+    def test_getters_share_snapshot(self):
+        error = 'ERROR: get_sys_mem()/get_avail_mem() should not reopen meminfo when given a snapshot'
+        snap = self.a2.parse_meminfo(self.data.splitlines())
+        m = mock_open(read_data=self.data)
+        with patch('builtins.open', m, create=True):
+            self.assertEqual(self.a2.get_sys_mem(snap), int(TestMemFuncs.mem1), error)
+            self.assertEqual(self.a2.get_avail_mem(snap), int(TestMemFuncs.mem3), error)
+            self.assertEqual(m.call_count, 0, error)
+
+
 '''
 I decided I didn't care about making this, BUT:
 you can call main block with a2.main(), but also need to
@@ -218,15 +261,158 @@ class TestPidList(unittest.TestCase):
         except ModuleNotFoundError:
             print("Cannot find a function inside your assignment2.py. Do not rename or delete any of the required functions.")
 
+    def make_proc(self, procs: dict) -> str:
+        "build a fake /proc with {pid: (comm, cmdline)} in a temporary directory"
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        for pid, (comm, cmdline) in procs.items():
+            os.mkdir(os.path.join(root, pid))
+            with open(os.path.join(root, pid, 'comm'), 'w') as f:
+                f.write(comm + '\n')
+            with open(os.path.join(root, pid, 'cmdline'), 'w') as f:
+                f.write(cmdline)
+        os.mkdir(os.path.join(root, 'sys')) # non-numeric entries must be ignored
+        return root
+
     def test_pids(self):
-        error = 'Error: use os.popen to the call the "pidof" command. Use .read() to get the output. Return a list'
-        pid_out = '197592 197549 197432 197417 165748 165718 165690 165669 165649 165623 165621 165620 165615'
-        expected = pid_out.split()
+        error = 'Error: pids_of_prog should scan /proc/*/comm and /proc/*/cmdline and return a list of PIDs, newest first'
+        root = self.make_proc({'165620': ('code', '/usr/share/code/code\0--type=zygote\0'),
+                               '197592': ('code', '/usr/share/code/code\0'),
+                               '4242': ('bash', '/bin/bash\0'),
+                               '88': ('kworker/0:1', '')})
+        index = self.a2.ProcessIndex(self.a2.ProcSource(root)).scan()
         with patch.object(os, 'popen') as mock_popen:
-            mock_popen().read.return_value = pid_out
-            given = self.a2.pids_of_prog('code')
-            self.assertEqual(given, expected, error)  
-            self.assertEqual(mock_popen().read.call_count, 1, error)
+            given = self.a2.pids_of_prog('code', index=index)
+            self.assertEqual(given, ['197592', '165620'], error)
+            self.assertEqual(mock_popen.call_count, 0, 'Error: pids_of_prog should not spawn pidof any more')
+
+    def test_pids_match_modes(self):
+        error = 'Error: ProcessIndex should answer exact, prefix and regex queries from one scan'
+        root = self.make_proc({'10': ('php-fpm8.2', '/usr/sbin/php-fpm8.2\0'),
+                               '11': ('nginx', 'nginx: worker process\0'),
+                               '12': ('nginx', 'nginx: master process\0')})
+        index = self.a2.ProcessIndex(self.a2.ProcSource(root)).scan()
+        self.assertEqual(index.pids('php', 'prefix'), ['10'], error)
+        self.assertEqual(index.pids('^(nginx|php)', 'regex'), ['12', '11', '10'], error)
+        self.assertEqual(index.lookup(['nginx', 'missing']), {'nginx': ['12', '11'], 'missing': []}, error)
+
+    def test_refresh(self):
+        error = 'Error: ProcessIndex.refresh() should only read new PIDs and drop the ones that have gone'
+        root = self.make_proc({'11': ('nginx', 'nginx\0'), '12': ('nginx', 'nginx\0')})
+        index = self.a2.ProcessIndex(self.a2.ProcSource(root)).scan()
+        shutil.rmtree(os.path.join(root, '11'))
+        os.mkdir(os.path.join(root, '13'))
+        with open(os.path.join(root, '13', 'comm'), 'w') as f:
+            f.write('nginx\n')
+        with patch.object(index, 'names_of_pid', wraps=index.names_of_pid) as names_of_pid:
+            added, removed = index.refresh()
+            self.assertEqual(names_of_pid.call_args_list, [call('13')], error)
+        self.assertEqual((added, removed), (['13'], ['11']), error)
+        self.assertEqual(index.pids('nginx'), ['13', '12'], error)
+
+
+class TestMetaCache(unittest.TestCase):
+    "process metadata is cached by (pid, starttime) so names are only re-read for new or reused PIDs"
+
+    def setUp(self):
+        self.filename = 'assignment2.py'
+        self.pypath = sys.executable
+        error_output = f'{self.filename} cannot be found (HINT: make sure this script AND your file are in the same directory)'
+        file = os.path.join(os.getcwd(), self.filename)
+        self.assertTrue(os.path.exists(file), msg=error_output)
+        try:
+            self.a2 = import_module(self.filename.split('.')[0])
+        except ModuleNotFoundError:
+            print("Cannot find a function inside your assignment2.py. Do not rename or delete any of the required functions.")
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def start(self, pid: str, comm: str, starttime: int) -> None:
+        "write comm, cmdline and stat for a process started starttime ticks after boot"
+        os.makedirs(os.path.join(self.root, pid), exist_ok=True)
+        with open(os.path.join(self.root, pid, 'comm'), 'w') as f:
+            f.write(comm + '\n')
+        with open(os.path.join(self.root, pid, 'cmdline'), 'w') as f:
+            f.write(f'/usr/bin/{comm}\0')
+        with open(os.path.join(self.root, pid, 'stat'), 'w') as f:
+            f.write(f"{pid} ({comm} (x)) S 1 {' '.join(['0'] * 17)} {starttime} 1000 250\n")
+
+    def test_reuse_detected(self):
+        error = 'ERROR: ProcessIndex with a MetaCache should skip comm/cmdline for known processes and re-read reused PIDs'
+        self.start('20', 'nginx', 500)
+        self.start('21', 'nginx', 510)
+        proc = self.a2.ProcSource(self.root)
+        meta = self.a2.MetaCache(proc)
+        self.assertEqual(meta.starttime('20'), 500, error)
+        index = self.a2.ProcessIndex(proc, meta).scan()
+        self.assertEqual(index.pids('nginx'), ['21', '20'], error)
+        self.assertEqual(meta.peek('20').cmdline, '/usr/bin/nginx', error)
+        self.start('21', 'redis', 900) # 21 exited and the PID went to another program before the next lookup
+        with patch.object(index, '_read', wraps=index._read) as read, patch.object(proc, 'forget_pid') as forget:
+            self.assertEqual(index.pids('nginx'), ['20'], error)
+            self.assertEqual(sorted(c.args[0] for c in read.call_args_list), ['21/cmdline', '21/comm'], error)
+            forget.assert_called_once_with('21') # files kept open for the old process 21 are closed
+        self.assertEqual(index.pids('redis'), ['21'], error)
+
+    def test_lru_and_unreadable(self):
+        error = 'ERROR: MetaCache should evict the least recently used entry, and collect_memory() skip unreadable processes'
+        for n in range(3):
+            self.start(str(30 + n), 'kthread', 100 + n)
+        meta = self.a2.MetaCache(self.a2.ProcSource(self.root), limit=2)
+        for pid in ('30', '31', '30', '32'):
+            meta.get(pid)
+        self.assertEqual(list(meta.entries), ['30', '32'], error)
+        for pid in ('30', '32'):
+            meta.peek(pid).cmdline = '' # kernel threads
+        with patch.object(self.a2, 'rss_mem_of_pid', return_value=0) as rss:
+            self.assertEqual(self.a2.collect_memory(['30', '32'], meta=meta), {'30': 0, '32': 0}, error)
+            self.assertEqual(self.a2.collect_memory(['30', '32'], meta=meta), {'30': 0, '32': 0}, error)
+            self.assertEqual(rss.call_count, 2, error)
+
+    def test_unreadable_only_when_known(self):
+        error = 'ERROR: collect_memory() should only give up on kernel threads and processes it may not read, and retry other empty reads'
+        for pid in ('40', '41', '42'):
+            self.start(pid, 'worker', int(pid))
+        proc = self.a2.ProcSource(self.root)
+        meta = self.a2.MetaCache(proc)
+        for pid in ('40', '41', '42'):
+            meta.get(pid).cmdline = '/usr/bin/worker'
+        meta.peek('40').cmdline = '' # a kernel thread
+        with open(os.path.join(self.root, '41', 'smaps_rollup'), 'w') as f:
+            f.write('Rss: 8 kB\n')
+        real_read = proc.read
+        def denied(rel, *args):
+            if rel == '41/smaps_rollup':
+                raise PermissionError(13, 'Permission denied')
+            return real_read(rel, *args)
+        with patch.object(self.a2, 'rss_mem_of_pid', return_value=0), patch.object(proc, 'read', side_effect=denied):
+            self.assertEqual(self.a2.collect_memory(['40', '41', '42'], proc=proc, meta=meta), {'40': 0, '41': 0}, error) # 42 was never read
+        self.assertEqual([meta.peek(pid).unreadable for pid in ('40', '41', '42')], [True, True, False], error)
+        readings = iter([100, 0, 120])
+        mem = []
+        with patch.object(self.a2, 'rss_mem_of_pid', side_effect=lambda *args: next(readings)) as rss:
+            for tick in range(self.a2.UNREADABLE_RETRY + 3):
+                mem.append(self.a2.collect_memory(['42'], proc=proc, meta=meta).get('42'))
+        # read again UNREADABLE_RETRY ticks after the empty read, then an empty read carries 100 forward until the next retry
+        self.assertEqual(mem, [None] * (self.a2.UNREADABLE_RETRY - 1) + [100, 100, 100, 100], error)
+        self.assertEqual(rss.call_count, 2, error)
+
+    def test_stat_kept_open(self):
+        error = 'ERROR: MetaCache.starttime() should re-read stat through a kept open descriptor, and open it afresh if that fails'
+        self.start('50', 'nginx', 700)
+        proc = self.a2.ProcSource(self.root, keep_open=True)
+        self.addCleanup(proc.close)
+        meta = self.a2.MetaCache(proc)
+        with patch.object(proc, 'reread', wraps=proc.reread) as reread:
+            self.assertEqual(meta.starttime('50'), 700, error)
+            reread.assert_called_once_with('50/stat')
+        with patch.object(proc, 'reread', side_effect=ProcessLookupError(3, 'No such process')):
+            self.assertEqual(meta.starttime('50'), 700, error)
+            self.assertIsNone(meta.starttime('51'), error)
+        self.assertEqual((meta.hits, meta.misses), (0, 0), error)
+        meta.get('50')
+        meta.get('50')
+        self.assertEqual((meta.hits, meta.misses), (1, 1), error)
 
 
 class TestPidMem(unittest.TestCase):
@@ -316,5 +502,932 @@ class TestPidMem(unittest.TestCase):
             self.assertEqual(m.call_count, 1, error)
 
 
+class TestRssSources(unittest.TestCase):
+    "rss_mem_of_pid reads statm, smaps_rollup or smaps depending on the source"
+
+    rollup = ('55d0c6b6e000-7ffd2b1fe000 ---p 00000000 00:00 0                          [rollup]\n'
+              'Rss:                9864 kB\n'
+              'Pss:                4102 kB\n')
+
+    def setUp(self):
+        self.filename = 'assignment2.py'
+        self.pypath = sys.executable
+        error_output = f'{self.filename} cannot be found (HINT: make sure this script AND your file are in the same directory)'
+        file = os.path.join(os.getcwd(), self.filename)
+        self.assertTrue(os.path.exists(file), msg=error_output)
+        try:
+            self.a2 = import_module(self.filename.split('.')[0])
+        except ModuleNotFoundError:
+            print("Cannot find a function inside your assignment2.py. Do not rename or delete any of the required functions.")
+
+    def test_statm(self):
+        error = 'ERROR: the statm source should read /proc/<pid>/statm and convert resident pages to kB'
+        m = mock_open(read_data='4728 2466 1280 180 0 1095 0\n')
+        with patch('builtins.open', m, create=True):
+            given = self.a2.rss_mem_of_pid('74168', 'statm')
+            self.assertEqual(given, 2466 * self.a2.PAGE_KB, error)
+            m.assert_has_calls([call('/proc/74168/statm', 'r')])
+
+    def test_rollup_fallback(self):
+        error = 'ERROR: the rollup source should fall back to smaps when smaps_rollup does not exist'
+        def fake_open(path, mode='r'):
+            if path.endswith('smaps_rollup'):
+                raise FileNotFoundError(path)
+            return mock_open(read_data=self.rollup)()
+        with patch('builtins.open', side_effect=fake_open, create=True) as m:
+            self.assertEqual(self.a2.rss_mem_of_pid('74168'), 9864, error)
+            self.assertEqual(m.call_args_list, [call('/proc/74168/smaps_rollup', 'r'), call('/proc/74168/smaps', 'r')], error)
+
+
+class TestSmapsTotals(unittest.TestCase):
+    "parse_smaps collects RSS, PSS and USS in one pass"
+
+    smaps = ('5581a0e8a000-5581a0eb9000 r--p 00000000 08:01 1835   /usr/bin/bash\n'
+             'Size:                188 kB\n'
+             'Rss:                 188 kB\n'
+             'Pss:                  94 kB\n'
+             'Shared_Clean:        188 kB\n'
+             'Shared_Dirty:          0 kB\n'
+             'Private_Clean:         0 kB\n'
+             'Private_Dirty:         0 kB\n'
+             'Swap:                  0 kB\n'
+             'VmFlags: rd mr mw me sd\n'
+             '5581a2b47000-5581a2cd1000 rw-p 00000000 00:00 0      [heap]\n'
+             'Rss:                1576 kB\n'
+             'Pss:                1576 kB\n'
+             'Shared_Clean:          0 kB\n'
+             'Shared_Dirty:          0 kB\n'
+             'Private_Clean:        12 kB\n'
+             'Private_Dirty:      1564 kB\n'
+             'Swap:                  8 kB\n')
+
+    def setUp(self):
+        self.filename = 'assignment2.py'
+        self.pypath = sys.executable
+        error_output = f'{self.filename} cannot be found (HINT: make sure this script AND your file are in the same directory)'
+        file = os.path.join(os.getcwd(), self.filename)
+        self.assertTrue(os.path.exists(file), msg=error_output)
+        try:
+            self.a2 = import_module(self.filename.split('.')[0])
+        except ModuleNotFoundError:
+            print("Cannot find a function inside your assignment2.py. Do not rename or delete any of the required functions.")
+
+    def test_parse_smaps(self):
+        error = 'ERROR: parse_smaps() should sum Rss, Pss and Private_* over every mapping'
+        totals = self.a2.parse_smaps(self.smaps.splitlines())
+        self.assertEqual((totals.rss, totals.pss, totals.uss, totals.shared, totals.swap), (1764, 1670, 1576, 188, 8), error)
+
+    def test_read_and_sum(self):
+        error = 'ERROR: read_smaps_totals() should read the file once, and SmapsTotals should add up with sum()'
+        m = mock_open(read_data=self.smaps)
+        with patch('builtins.open', m, create=True):
+            totals = self.a2.read_smaps_totals('74168', 'smaps')
+            m.assert_has_calls([call('/proc/74168/smaps', 'r')])
+            self.assertEqual(m.call_count, 1, error)
+        both = sum([totals, totals])
+        self.assertEqual(both.as_dict(), {name: value * 2 for name, value in totals.as_dict().items()}, error)
+        self.assertEqual(totals.rss, 1764, error)
+
+
+class TestCollectRss(unittest.TestCase):
+    "collect_rss gives the same results serially and on a thread pool"
+
+    def setUp(self):
+        self.filename = 'assignment2.py'
+        self.pypath = sys.executable
+        error_output = f'{self.filename} cannot be found (HINT: make sure this script AND your file are in the same directory)'
+        file = os.path.join(os.getcwd(), self.filename)
+        self.assertTrue(os.path.exists(file), msg=error_output)
+        try:
+            self.a2 = import_module(self.filename.split('.')[0])
+        except ModuleNotFoundError:
+            print("Cannot find a function inside your assignment2.py. Do not rename or delete any of the required functions.")
+
+    def test_pool_matches_serial(self):
+        error = 'ERROR: collect_rss() should return {pid: rss} in pid order and isolate per-PID failures'
+        def fake_rss(pid, *args):
+            if pid == '13':
+                raise RuntimeError('boom')
+            return int(pid) * 10
+        pids = [str(n) for n in range(1, 40)]
+        with patch.object(self.a2, 'rss_mem_of_pid', side_effect=fake_rss):
+            serial = self.a2.collect_rss([p for p in pids if p != '13'], workers=1)
+            pooled = self.a2.collect_rss(pids, workers=8)
+        self.assertEqual(list(pooled), pids, error)
+        self.assertEqual(pooled['13'], 0, error)
+        del pooled['13']
+        self.assertEqual(pooled, serial, error)
+
+    def test_negative_workers(self):
+        error = 'ERROR: parse_command_args() should reject a negative --workers instead of crashing in the thread pool'
+        with patch.object(sys, 'argv', ['assignment2.py', '-w', '-2']), patch('sys.stderr', new_callable=io.StringIO):
+            with self.assertRaises(SystemExit, msg=error):
+                self.a2.parse_command_args()
+
+
+class TestTopPrograms(unittest.TestCase):
+    "with no program, memory of every process is grouped by program name and the top N kept"
+
+    def setUp(self):
+        self.filename = 'assignment2.py'
+        self.pypath = sys.executable
+        error_output = f'{self.filename} cannot be found (HINT: make sure this script AND your file are in the same directory)'
+        file = os.path.join(os.getcwd(), self.filename)
+        self.assertTrue(os.path.exists(file), msg=error_output)
+        try:
+            self.a2 = import_module(self.filename.split('.')[0])
+        except ModuleNotFoundError:
+            print("Cannot find a function inside your assignment2.py. Do not rename or delete any of the required functions.")
+
+    def test_top_programs(self):
+        error = 'ERROR: top_programs() should group RSS by program name and keep only the N biggest'
+        index = self.a2.ProcessIndex(self.a2.ProcSource('/nonexistent'))
+        for pid, name in [('1', 'nginx'), ('2', 'nginx'), ('3', 'postgres'), ('4', 'bash'), ('5', 'kthreadd')]:
+            index.add(pid, (name,))
+        rss = {'1': 300, '2': 300, '3': 500, '4': 100, '5': 0}
+        with patch.object(self.a2, 'rss_mem_of_pid', side_effect=lambda pid, *args: rss[pid]):
+            self.assertEqual(self.a2.top_programs(2, index), [('nginx', 600, 2), ('postgres', 500, 1)], error)
+            self.assertEqual(len(self.a2.top_programs(10, index)), 3, 'ERROR: programs with no resident memory should be left out')
+
+    def test_top_at_least_one(self):
+        error = 'ERROR: parse_command_args() should reject --top N below 1 before reading every process'
+        for n in ('0', '-1'):
+            with patch.object(sys, 'argv', ['assignment2.py', '-n', n]), patch('sys.stderr', new_callable=io.StringIO):
+                with self.assertRaises(SystemExit, msg=error):
+                    self.a2.parse_command_args()
+
+
+class TestMappings(unittest.TestCase):
+    "mapping_breakdown attributes memory to the file or region behind each mapping"
+
+    smaps = TestSmapsTotals.smaps + ('7f5c2a000000-7f5c2a100000 rw-s 00000000 00:19 4021   /dev/shm/pool\n'
+                                     'Rss:                 512 kB\n'
+                                     'Pss:                 256 kB\n'
+                                     '7f5c2b000000-7f5c2b021000 rw-p 00000000 00:00 0 \n'
+                                     'Rss:                  32 kB\n'
+                                     'Pss:                  32 kB\n'
+                                     '7ffd8e1f0000-7ffd8e211000 rw-p 00000000 00:00 0      [stack]\n'
+                                     'Rss:                  20 kB\n'
+                                     'Pss:                  20 kB\n')
+
+    def setUp(self):
+        self.filename = 'assignment2.py'
+        self.pypath = sys.executable
+        error_output = f'{self.filename} cannot be found (HINT: make sure this script AND your file are in the same directory)'
+        file = os.path.join(os.getcwd(), self.filename)
+        self.assertTrue(os.path.exists(file), msg=error_output)
+        try:
+            self.a2 = import_module(self.filename.split('.')[0])
+        except ModuleNotFoundError:
+            print("Cannot find a function inside your assignment2.py. Do not rename or delete any of the required functions.")
+
+    def test_breakdown(self):
+        error = 'ERROR: mapping_breakdown() should add Rss (or Pss) by file, [heap], [stack], [anon] and [shmem]'
+        m = mock_open(read_data=self.smaps)
+        with patch('builtins.open', m, create=True):
+            rss = self.a2.mapping_breakdown('74168')
+            m.assert_has_calls([call('/proc/74168/smaps', 'r')])
+        self.assertEqual(rss, {'/usr/bin/bash': 188, '[heap]': 1576, '[shmem] /dev/shm/pool': 512, '[anon]': 32, '[stack]': 20}, error)
+        with patch('builtins.open', mock_open(read_data=self.smaps), create=True):
+            pss = self.a2.mapping_breakdown('74168', field='Pss')
+        self.assertEqual(pss['/usr/bin/bash'], 94, error)
+        self.assertEqual(pss['[shmem] /dev/shm/pool'], 256, error)
+
+    def test_program_mappings(self):
+        error = 'ERROR: program_mappings() should add the breakdowns of every PID, and mappings_report() list the largest first'
+        with patch.object(self.a2, 'mapping_breakdown', lambda pid, *args: {'[heap]': 100, '/lib/libc.so.6': int(pid)}):
+            totals = self.a2.program_mappings(['10', '20'], workers=2)
+        self.assertEqual(totals, {'[heap]': 200, '/lib/libc.so.6': 30}, error)
+        lines = self.a2.mappings_report('bash', totals, 1, length=10)
+        self.assertEqual(len(lines), 2, error)
+        self.assertIn('[heap]', lines[1], error)
+        self.assertIn('[########  ]', lines[1], error)
+
+    def test_layout_reused(self):
+        error = 'ERROR: program_mappings() should reuse the layout of a process whose total has not changed, and re-read the others'
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        for pid in ('10', '20'):
+            os.mkdir(os.path.join(root, pid))
+            with open(os.path.join(root, pid, 'stat'), 'w') as f:
+                f.write(f"{pid} (bash) S 1 {' '.join(['0'] * 17)} {pid} 1000 250\n")
+        meta = self.a2.MetaCache(self.a2.ProcSource(root))
+        for pid in ('10', '20'):
+            meta.get(pid)
+        breakdown = lambda pid, *args: {'[heap]': 100, '/lib/libc.so.6': int(pid)}
+        with patch.object(self.a2, 'mapping_breakdown', side_effect=breakdown) as walk:
+            first = self.a2.program_mappings(['10', '20'], meta=meta, mem_by_pid={'10': 110, '20': 120})
+            second = self.a2.program_mappings(['10', '20'], meta=meta, mem_by_pid={'10': 110, '20': 130})
+        self.assertEqual(first, second, error)
+        self.assertEqual([c.args[0] for c in walk.call_args_list], ['10', '20', '20'], error) # 20 grew, 10 did not
+        self.assertEqual((meta.layout_hits, meta.layout_misses), (1, 3), error)
+        self.assertIsNone(self.a2.unchanged_layout(meta.peek('10'), 110, 'Pss'), error) # an RSS figure cannot vouch for PSS
+
+    def test_mappings_at_least_one(self):
+        error = 'ERROR: parse_command_args() should reject --mappings N below 1'
+        for n in ('0', '-3'):
+            with patch.object(sys, 'argv', ['assignment2.py', '--mappings', n, 'bash']), patch('sys.stderr', new_callable=io.StringIO):
+                with self.assertRaises(SystemExit, msg=error):
+                    self.a2.parse_command_args()
+
+
+class TestProcFileCache(unittest.TestCase):
+    "ProcFileCache re-reads files through the descriptor it already has open"
+
+    def setUp(self):
+        self.filename = 'assignment2.py'
+        self.pypath = sys.executable
+        error_output = f'{self.filename} cannot be found (HINT: make sure this script AND your file are in the same directory)'
+        file = os.path.join(os.getcwd(), self.filename)
+        self.assertTrue(os.path.exists(file), msg=error_output)
+        try:
+            self.a2 = import_module(self.filename.split('.')[0])
+        except ModuleNotFoundError:
+            print("Cannot find a function inside your assignment2.py. Do not rename or delete any of the required functions.")
+
+    def test_reuse_and_limit(self):
+        error = 'ERROR: ProcFileCache should open each file once and keep at most `limit` open'
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        paths = [os.path.join(root, name) for name in ('a', 'b', 'c')]
+        for path in paths:
+            with open(path, 'w') as f:
+                f.write('1')
+        cache = self.a2.ProcFileCache(limit=2)
+        self.addCleanup(cache.close_all)
+        self.assertEqual(cache.read(paths[0]), '1', error)
+        with open(paths[0], 'w') as f:
+            f.write('22')
+        with patch('builtins.open', wraps=open) as m:
+            self.assertEqual(cache.read(paths[0]), '22', error)
+            self.assertEqual(m.call_count, 0, error)
+        cache.read(paths[1])
+        cache.read(paths[2])
+        self.assertEqual(list(cache.files), paths[1:], error)
+
+    def test_parallel_reads(self):
+        error = 'ERROR: ProcFileCache should not hold its lock while a kept-open file is read'
+        class SlowFile:
+            def seek(self, offset):
+                pass
+            def read(self):
+                time.sleep(0.05)
+                return 'x'
+            def close(self):
+                pass
+        cache = self.a2.ProcFileCache(limit=16)
+        for n in range(8):
+            cache.files[f'/proc/{n}/statm'] = SlowFile()
+        started = time.perf_counter()
+        threads = [threading.Thread(target=cache.read, args=(f'/proc/{n}/statm',)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLess(time.perf_counter() - started, 0.3, error)
+        self.assertEqual(len(cache.files), 8, error)
+
+    def test_out_of_descriptors(self):
+        error = 'ERROR: ProcFileCache should stay under RLIMIT_NOFILE, give descriptors back on EMFILE and stop keeping per-PID files open when they do not fit'
+        soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        self.assertLess(self.a2.fd_budget(), soft if soft != resource.RLIM_INFINITY else 1025, error)
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        for name in ('meminfo', '1', '2', '3'):
+            os.makedirs(os.path.join(root, name) if name.isdigit() else root, exist_ok=True)
+            with open(os.path.join(root, f'{name}/statm' if name.isdigit() else name), 'w') as f:
+                f.write('1 2 3\n')
+        proc = self.a2.ProcSource(root, keep_open=True)
+        self.addCleanup(proc.close)
+        proc.files.limit = 4
+        for rel in ('meminfo', '1/statm', '2/statm'):
+            proc.reread(rel)
+        real_open = open
+        def no_descriptors(path, *args, **kwargs):
+            if len(proc.files.files) > 1:
+                raise OSError(errno.EMFILE, 'Too many open files')
+            return real_open(path, *args, **kwargs)
+        with patch('builtins.open', side_effect=no_descriptors):
+            self.assertEqual(proc.reread('3/statm'), '1 2 3\n', error)
+        proc.keep_pids_open(3) # more than half of the 4 slots
+        proc.reread('1/statm')
+        proc.reread('meminfo')
+        self.assertEqual(list(proc.files.files), [os.path.join(root, 'meminfo')], error)
+        with patch('sys.stderr', new_callable=io.StringIO) as err:
+            self.a2.read_failed('Error while fetching RSS memory for PID 1', OSError(errno.EMFILE, 'Too many open files'), quiet=True)
+            self.a2.read_failed('Error while fetching RSS memory for PID 2', FileNotFoundError(errno.ENOENT, 'gone'), quiet=True)
+        self.assertIn('PID 1', err.getvalue(), error)
+        self.assertNotIn('PID 2', err.getvalue(), error)
+
+
+class TestProcSources(unittest.TestCase):
+    "collection functions read through a ProcSource, which can be another root or a recording"
+
+    def setUp(self):
+        self.filename = 'assignment2.py'
+        self.pypath = sys.executable
+        error_output = f'{self.filename} cannot be found (HINT: make sure this script AND your file are in the same directory)'
+        file = os.path.join(os.getcwd(), self.filename)
+        self.assertTrue(os.path.exists(file), msg=error_output)
+        try:
+            self.a2 = import_module(self.filename.split('.')[0])
+        except ModuleNotFoundError:
+            print("Cannot find a function inside your assignment2.py. Do not rename or delete any of the required functions.")
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        files = {'meminfo': TestMemFuncs.data,
+                 '4242/comm': 'nginx\n', '4242/cmdline': 'nginx: worker process\0', '4242/statm': '4728 2466 1280 180 0 1095 0\n',
+                 '4242/smaps_rollup': TestRssSources.rollup}
+        for rel, text in files.items():
+            os.makedirs(os.path.dirname(os.path.join(self.root, rel)), exist_ok=True)
+            with open(os.path.join(self.root, rel), 'w') as f:
+                f.write(text)
+
+    def test_proc_root(self):
+        error = 'ERROR: the readers should use the ProcSource root instead of /proc'
+        proc = self.a2.ProcSource(self.root)
+        self.assertEqual(self.a2.get_sys_mem(proc=proc), int(TestMemFuncs.mem1), error)
+        self.assertEqual(self.a2.pids_of_prog('nginx', proc=proc), ['4242'], error)
+        self.assertEqual(self.a2.rss_mem_of_pid('4242', 'rollup', proc), 9864, error)
+        self.assertEqual(self.a2.rss_mem_of_pid('4242', 'statm', proc), 2466 * self.a2.PAGE_KB, error)
+
+    def test_record_and_replay(self):
+        error = 'ERROR: a RecordedSource should give the same answers as the run that was recorded'
+        recorder = self.a2.RecordingSource(self.root)
+        expected = (self.a2.get_sys_mem(proc=recorder), self.a2.pids_of_prog('nginx', proc=recorder),
+                    self.a2.rss_mem_of_pid('4242', 'rollup', recorder, quiet=True), self.a2.rss_mem_of_pid('999', 'statm', recorder, quiet=True))
+        snapshot = os.path.join(self.root, 'snapshot.json.gz')
+        recorder.save(snapshot)
+        shutil.rmtree(os.path.join(self.root, '4242')) # the replay must not need the original files
+        replay = self.a2.RecordedSource(snapshot)
+        given = (self.a2.get_sys_mem(proc=replay), self.a2.pids_of_prog('nginx', proc=replay),
+                 self.a2.rss_mem_of_pid('4242', 'rollup', replay, quiet=True), self.a2.rss_mem_of_pid('999', 'statm', replay, quiet=True))
+        self.assertEqual(given, expected, error)
+        self.assertEqual(expected[1:], (['4242'], 9864, 0), error)
+        with self.assertRaises(FileNotFoundError):
+            replay.read('4242/smaps')
+
+
+class TestRecordWriter(unittest.TestCase):
+    "RecordWriter writes json, ndjson and csv records"
+
+    def setUp(self):
+        self.filename = 'assignment2.py'
+        self.pypath = sys.executable
+        error_output = f'{self.filename} cannot be found (HINT: make sure this script AND your file are in the same directory)'
+        file = os.path.join(os.getcwd(), self.filename)
+        self.assertTrue(os.path.exists(file), msg=error_output)
+        try:
+            self.a2 = import_module(self.filename.split('.')[0])
+        except ModuleNotFoundError:
+            print("Cannot find a function inside your assignment2.py. Do not rename or delete any of the required functions.")
+
+    def write_all(self, fmt: str) -> str:
+        out = io.StringIO()
+        writer = self.a2.RecordWriter(fmt, out)
+        writer.meminfo(self.a2.parse_meminfo(['MemTotal: 100 kB', 'MemAvailable: 40 kB']), 1.5)
+        writer.program('nginx', {'12': 30, '11': 10}, 1.5, per_pid=True)
+        writer.close()
+        return out.getvalue()
+
+    def test_formats(self):
+        error = 'ERROR: RecordWriter output does not parse back into the expected records'
+        records = self.write_all('json')
+        self.assertEqual(json.loads(records), [json.loads(line) for line in self.write_all('ndjson').splitlines()], error)
+        records = json.loads(records)
+        self.assertEqual(records[0]['fields'], {'MemTotal': 100, 'MemAvailable': 40}, error)
+        self.assertEqual(records[1], {'record': 'program', 'time': 1.5, 'name': 'nginx', 'processes': 2, 'kb': 40}, error)
+        self.assertEqual([r['pid'] for r in records[2:]], [12, 11], error)
+        rows = list(csv.DictReader(io.StringIO(self.write_all('csv'))))
+        self.assertEqual([(r['record'], r['name'], r['kb']) for r in rows[:3]],
+                         [('meminfo', 'MemTotal', '100'), ('meminfo', 'MemAvailable', '40'), ('program', 'nginx', '40')], error)
+
+
+class TestHistory(unittest.TestCase):
+    "ring buffers, the history store and the on-disk history log"
+
+    def setUp(self):
+        self.filename = 'assignment2.py'
+        self.pypath = sys.executable
+        error_output = f'{self.filename} cannot be found (HINT: make sure this script AND your file are in the same directory)'
+        file = os.path.join(os.getcwd(), self.filename)
+        self.assertTrue(os.path.exists(file), msg=error_output)
+        try:
+            self.a2 = import_module(self.filename.split('.')[0])
+        except ModuleNotFoundError:
+            print("Cannot find a function inside your assignment2.py. Do not rename or delete any of the required functions.")
+
+    def test_ring_buffer(self):
+        error = 'ERROR: RingBuffer should keep only the newest `capacity` samples, oldest first'
+        ring = self.a2.RingBuffer(3)
+        for n in range(5):
+            ring.append(float(n), n * 10.0)
+        self.assertEqual(list(ring), [(2.0, 20.0), (3.0, 30.0), (4.0, 40.0)], error)
+        self.assertEqual(ring.since(3.0), [30.0, 40.0], error)
+        self.assertEqual(ring.last(), (4.0, 40.0), error)
+
+    def test_store_bounded(self):
+        error = 'ERROR: HistoryStore should compute min/avg/max over a window and cap the number of metrics'
+        store = self.a2.HistoryStore(capacity=10, max_metrics=2)
+        for n in range(4):
+            store.record(100.0 + n, {'system.used': 10.0 * (n + 1), 'rss:a': 1.0})
+        self.assertEqual(store.stats('system.used', 2.0, now=103.0), (20.0, 30.0, 40.0, 3), error)
+        store.record(104.0, {'rss:b': 5.0})
+        self.assertEqual(set(store.series), {'rss:a', 'rss:b'}, error) # system.used was updated least recently
+        self.assertIsNone(store.stats('missing', 60.0), error)
+
+    def test_log_rotation(self):
+        error = 'ERROR: HistoryLog should rotate past max_bytes and read_history_log should read the samples back'
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        path = os.path.join(root, 'history.log')
+        log = self.a2.HistoryLog(path, max_bytes=100, backups=2)
+        for n in range(10):
+            log.append(float(n), {'system.used': float(n)})
+        log.close()
+        self.assertEqual(log.files(), [path + '.2', path + '.1', path], error)
+        samples = [sample for f in log.files() for sample in self.a2.read_history_log(f)]
+        self.assertEqual(samples[-1], (9.0, 'system.used', 9.0), error)
+        self.assertEqual([when for when, name, value in samples], sorted(when for when, name, value in samples), error)
+        store = self.a2.open_history(5, path, 100, since=0.0)
+        self.addCleanup(store.close)
+        self.assertEqual(list(store.series['system.used'])[-1], (9.0, 9.0), error)
+        self.assertEqual(list(store.series['system.used'])[0], (5.0, 5.0), error)
+        with patch.object(self.a2, 'read_history_log') as m:
+            self.a2.open_history(5, path, 1000).close() # nothing will look back, so the log is not read
+        m.assert_not_called()
+        self.assertEqual([when for when, name, value in self.a2.read_history_log(path + '.1', since=6.0, chunk_size=7)],
+                         [when for when, name, value in self.a2.read_history_log(path + '.1')
+                          if when >= 6.0], 'ERROR: read_history_log should give the same samples a chunk at a time')
+
+    def test_window_needs_history(self):
+        error = 'ERROR: --history-window without --watch or --history-log should be rejected, a single run has no history'
+        with patch.object(sys, 'argv', ['assignment2.py', '--history-window', '60']), patch('sys.stderr', new_callable=io.StringIO):
+            with self.assertRaises(SystemExit, msg=error):
+                self.a2.parse_command_args()
+
+
+class TestAlerts(unittest.TestCase):
+    "alert rules are evaluated on the history samples, with for, hysteresis and cooldown"
+
+    def setUp(self):
+        self.filename = 'assignment2.py'
+        self.pypath = sys.executable
+        error_output = f'{self.filename} cannot be found (HINT: make sure this script AND your file are in the same directory)'
+        file = os.path.join(os.getcwd(), self.filename)
+        self.assertTrue(os.path.exists(file), msg=error_output)
+        try:
+            self.a2 = import_module(self.filename.split('.')[0])
+        except ModuleNotFoundError:
+            print("Cannot find a function inside your assignment2.py. Do not rename or delete any of the required functions.")
+
+    def run_rule(self, rule: object, values: list, metric: str='system.used', total: int=1000) -> list:
+        "feed one sample per second and return the state changes as (second, state)"
+        history = self.a2.HistoryStore(capacity=120)
+        changes = []
+        for second, value in enumerate(values):
+            history.record(float(second), {metric: value})
+            change = rule.evaluate(history, float(second), total)
+            if change is not None:
+                changes.append((second, change[0]))
+        return changes
+
+    def test_threshold_rules(self):
+        error = 'ERROR: AlertRule should fire after "for", resolve only past the hysteresis band, and respect the cooldown'
+        rule = self.a2.AlertRule('system.used > 90% for 2s', hysteresis=0.05, cooldown=10)
+        self.assertEqual(self.run_rule(rule, [950, 950, 950, 880, 850, 950, 950, 950, 950, 950, 950, 950, 950]),
+                         [(2, 'firing'), (4, 'resolved'), (12, 'firing')], error)
+        rule = self.a2.AlertRule('rate(rss:nginx) > 1MiB/min')
+        self.assertEqual(self.run_rule(rule, [1000 + 20 * n for n in range(5)], 'rss:nginx'), [(1, 'firing')], error)
+        self.assertEqual(self.a2.AlertRule('pss:db <= 2GiB').threshold, 2 * 1024 * 1024, error)
+        for bad in ('system.used >', 'rate(system.used) > 5%', 'system.used > 5MiB/min'):
+            with self.assertRaises(ValueError, msg=error):
+                self.a2.AlertRule(bad)
+
+    def test_sink(self):
+        error = 'ERROR: AlertEngine should send each state change once to the --alert-to file as a JSON line'
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        target = os.path.join(root, 'alerts.ndjson')
+        engine = self.a2.AlertEngine([self.a2.AlertRule('system.available < 100')], self.a2.AlertSink(target=target))
+        history = self.a2.HistoryStore()
+        for second, value in enumerate([50, 40, 200]):
+            history.record(float(second), {'system.available': value})
+            engine.evaluate(history, float(second), 1000)
+        with open(target) as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual([(e['state'], e['value']) for e in events], [('firing', 50), ('resolved', 200)], error)
+        self.assertIn('none firing', self.a2.alert_report(engine, []), error)
+
+
+class TestExporter(unittest.TestCase):
+    "--serve renders Prometheus text from a cached collection"
+
+    def setUp(self):
+        self.filename = 'assignment2.py'
+        self.pypath = sys.executable
+        error_output = f'{self.filename} cannot be found (HINT: make sure this script AND your file are in the same directory)'
+        file = os.path.join(os.getcwd(), self.filename)
+        self.assertTrue(os.path.exists(file), msg=error_output)
+        try:
+            self.a2 = import_module(self.filename.split('.')[0])
+        except ModuleNotFoundError:
+            print("Cannot find a function inside your assignment2.py. Do not rename or delete any of the required functions.")
+
+    def make_args(self, **options) -> object:
+        "the parsed command line of assignment2.py --serve 0 with options"
+        with patch.object(sys, 'argv', ['assignment2.py', '--serve', '0']):
+            args = self.a2.parse_command_args()
+        for name, value in options.items():
+            setattr(args, name, value)
+        return args
+
+    def test_metrics_text(self):
+        error = 'ERROR: prometheus_metrics() should write gauges in bytes with escaped program labels'
+        meminfo = self.a2.MemInfo({'MemTotal': 1000, 'MemAvailable': 400})
+        text = self.a2.prometheus_metrics(meminfo, {'web "a"': (self.a2.SmapsTotals(rss=10, pss=6, private_dirty=4), 2)}, 0.5, 100.0)
+        self.assertIn('memvis_memory_used_bytes 614400\n', text, error)
+        self.assertIn('memvis_program_rss_bytes{program="web \\"a\\""} 10240\n', text, error)
+        self.assertIn('memvis_program_uss_bytes{program="web \\"a\\""} 4096\n', text, error)
+        self.assertIn('# TYPE memvis_program_pss_bytes gauge\n', text, error)
+
+    def test_scrapes_use_snapshot(self):
+        error = 'ERROR: scrapes should be answered from the last collection without reading /proc again'
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        with open(os.path.join(root, 'meminfo'), 'w') as f:
+            f.write('MemTotal: 1000 kB\nMemAvailable: 600 kB\n')
+        os.mkdir(os.path.join(root, '7'))
+        for name, text in (('comm', 'nginx\n'), ('cmdline', 'nginx\0'), ('statm', f'100 {2048 // self.a2.PAGE_KB} 0 0 0 0 0\n')):
+            with open(os.path.join(root, '7', name), 'w') as f:
+                f.write(text)
+        exporter = self.a2.Exporter(self.make_args(program='nginx', rss_source='statm', meta_cache=0), self.a2.ProcSource(root))
+        exporter.body = exporter.collect()
+        server = self.a2.ThreadingHTTPServer(('127.0.0.1', 0), self.a2.MetricsHandler)
+        server.exporter = exporter
+        self.addCleanup(server.server_close)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+        with patch.object(exporter, 'collect', side_effect=AssertionError('collected during a scrape')):
+            for _ in range(3):
+                with urllib.request.urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics') as response:
+                    text = response.read().decode()
+        self.assertIn('memvis_program_rss_bytes{program="nginx"} 2097152\n', text, error)
+        self.assertIn('memvis_memory_available_bytes 614400\n', text, error)
+
+
+class TestProfile(unittest.TestCase):
+    "--profile times each stage and counts the files and bytes read through the source"
+
+    def setUp(self):
+        self.filename = 'assignment2.py'
+        self.pypath = sys.executable
+        error_output = f'{self.filename} cannot be found (HINT: make sure this script AND your file are in the same directory)'
+        file = os.path.join(os.getcwd(), self.filename)
+        self.assertTrue(os.path.exists(file), msg=error_output)
+        try:
+            self.a2 = import_module(self.filename.split('.')[0])
+        except ModuleNotFoundError:
+            print("Cannot find a function inside your assignment2.py. Do not rename or delete any of the required functions.")
+
+    def test_counts(self):
+        error = 'ERROR: ProfiledSource should count opens, reads, bytes and failures per kind of file'
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        with open(os.path.join(root, 'meminfo'), 'w') as f:
+            f.write('MemTotal: 1000 kB\nMemAvailable: 600 kB\n')
+        os.mkdir(os.path.join(root, '5'))
+        with open(os.path.join(root, '5', 'smaps'), 'w') as f:
+            f.write(TestSmapsTotals.smaps)
+        profile = self.a2.Profile()
+        proc = self.a2.ProfiledSource(self.a2.ProcSource(root, keep_open=True), profile)
+        self.addCleanup(proc.close)
+        with profile.stage('meminfo'):
+            for _ in range(3):
+                self.a2.read_meminfo(proc)
+        self.assertEqual(self.a2.rss_mem_of_pid('5', 'smaps', proc), 1764, error)
+        self.assertEqual(self.a2.rss_mem_of_pid('6', 'statm', proc, quiet=True), 0, error)
+        data = profile.as_dict()
+        self.assertEqual(data['files']['meminfo'], {'opened': 1, 'reads': 3, 'bytes': 3 * 39, 'failed': 0}, error)
+        self.assertEqual(data['files']['smaps'], {'opened': 1, 'reads': 1, 'bytes': len(TestSmapsTotals.smaps), 'failed': 0}, error)
+        self.assertEqual(data['files']['statm']['failed'], 1, error)
+        self.assertEqual(data['stages']['meminfo']['passes'], 1, error)
+        self.assertTrue(profile.summary()[0].startswith('Profile:'), error)
+
+    def test_caches(self):
+        error = 'ERROR: Profile should report the hits and misses of the caches a watch keeps'
+        profile = self.a2.Profile()
+        self.assertEqual(profile.as_dict()['caches'], {}, error)
+        profile.cache('process metadata', 90, 10)
+        self.assertEqual(profile.as_dict()['caches'], {'process metadata': {'hits': 90, 'misses': 10}}, error)
+        self.assertTrue(any(line.startswith('process metadata') and line.split()[-2:] == ['90', '10'] for line in profile.summary()), error)
+        self.a2.NO_PROFILE.cache('process metadata', 90, 10) # does nothing without --profile
+
+    def test_disabled(self):
+        error = 'ERROR: without --profile the source should not be wrapped and stages should do nothing'
+        with self.a2.NO_PROFILE.stage('meminfo') as stage:
+            self.assertIs(stage, self.a2.NO_PROFILE, error)
+        with patch.object(sys, 'argv', ['assignment2.py']):
+            args = self.a2.parse_command_args()
+        self.assertFalse(args.profile, error)
+        self.assertIs(type(self.a2.make_source(args)), self.a2.ProcSource, error)
+
+
+class TestProgramGroups(unittest.TestCase):
+    "several programs, or groups of them from a file, are answered from one scan and one collection"
+
+    def setUp(self):
+        self.filename = 'assignment2.py'
+        self.pypath = sys.executable
+        error_output = f'{self.filename} cannot be found (HINT: make sure this script AND your file are in the same directory)'
+        file = os.path.join(os.getcwd(), self.filename)
+        self.assertTrue(os.path.exists(file), msg=error_output)
+        try:
+            self.a2 = import_module(self.filename.split('.')[0])
+        except ModuleNotFoundError:
+            print("Cannot find a function inside your assignment2.py. Do not rename or delete any of the required functions.")
+
+    def test_read_groups(self):
+        error = 'ERROR: read_program_groups() should read "name = a,b" lines, bare names, and skip comments'
+        groups = self.a2.read_program_groups(['# services\n', 'web = nginx, php-fpm\n', '\n', 'redis-server  # cache\n'])
+        self.assertEqual(groups, {'web': ['nginx', 'php-fpm'], 'redis-server': ['redis-server']}, error)
+        with self.assertRaises(ValueError, msg=error):
+            self.a2.read_program_groups(['web =\n'])
+        with patch.object(sys, 'argv', ['assignment2.py', 'nginx, redis,']):
+            args = self.a2.parse_command_args()
+        self.assertEqual((args.program, args.program_groups), (None, {'nginx': ['nginx'], 'redis': ['redis']}), error)
+
+    def test_collect_groups(self):
+        error = 'ERROR: collect_program_groups() should read each PID once and add it up per group'
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        for pid, comm in (('10', 'nginx'), ('11', 'nginx'), ('12', 'php-fpm'), ('13', 'redis')):
+            os.mkdir(os.path.join(root, pid))
+            with open(os.path.join(root, pid, 'comm'), 'w') as f:
+                f.write(comm + '\n')
+        index = self.a2.ProcessIndex(self.a2.ProcSource(root)).scan()
+        with patch.object(self.a2, 'rss_mem_of_pid', side_effect=lambda pid, *args: int(pid)) as rss:
+            rows = self.a2.collect_program_groups({'web': ['nginx', 'php-fpm'], 'nginx': ['nginx'], 'none': ['mysqld']}, index)
+            self.assertEqual(sorted(c.args[0] for c in rss.call_args_list), ['10', '11', '12'], error)
+        self.assertEqual(rows, [('web', 33, 3), ('nginx', 21, 2), ('none', 0, 0)], error)
+        lines = self.a2.top_report(rows, 100, 10, title='3 program groups')
+        self.assertEqual(lines[0], '\n3 program groups by resident memory:', error)
+        self.assertIn('[###       ]', lines[1], error)
+
+
+class TestProcessTree(unittest.TestCase):
+    "--tree adds up memory per subtree of the matched processes, built from /proc/<pid>/stat"
+
+    def setUp(self):
+        self.filename = 'assignment2.py'
+        self.pypath = sys.executable
+        error_output = f'{self.filename} cannot be found (HINT: make sure this script AND your file are in the same directory)'
+        file = os.path.join(os.getcwd(), self.filename)
+        self.assertTrue(os.path.exists(file), msg=error_output)
+        try:
+            self.a2 = import_module(self.filename.split('.')[0])
+        except ModuleNotFoundError:
+            print("Cannot find a function inside your assignment2.py. Do not rename or delete any of the required functions.")
+        # 1 init -> 100 code -> (101 code, 102 zsh -> 103 node), 1 -> 200 bash
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        for pid, comm, ppid in (('1', 'systemd', '0'), ('100', 'code', '1'), ('101', 'code', '100'),
+                                ('102', 'zsh', '100'), ('103', 'node', '102'), ('200', 'bash', '1')):
+            os.mkdir(os.path.join(self.root, pid))
+            with open(os.path.join(self.root, pid, 'comm'), 'w') as f:
+                f.write(comm + '\n')
+            with open(os.path.join(self.root, pid, 'stat'), 'w') as f:
+                f.write(f"{pid} ({comm}) S {ppid} {pid} {pid} 0 -1 4194560 0 0 0 0\n")
+
+    def test_subtree_totals(self):
+        error = 'ERROR: ProcessTree should find the subtrees of the matched PIDs and total memory from the leaves up'
+        proc = self.a2.ProcSource(self.root)
+        index = self.a2.ProcessIndex(proc).scan()
+        tree = self.a2.ProcessTree(proc).scan()
+        self.assertEqual(tree.roots(index.pids('code')), ['100'], error)
+        self.assertEqual(tree.walk('100'), [('100', 0), ('101', 1), ('102', 1), ('103', 2)], error)
+        mem = {'100': 1000, '101': 200, '102': 30, '103': 4, '200': 99999}
+        totals = tree.totals('100', mem)
+        self.assertEqual((totals['100'], totals['102'], totals['103']), ((1234, 4), (34, 2), (4, 1)), error)
+        args = argparse.Namespace(program='code', match='exact')
+        self.assertEqual(self.a2.tree_pids(args, index, proc)[2], ['100', '101', '102', '103'], error)
+        lines = self.a2.tree_report('code', tree, ['100'], mem, index.names, 2468, 10)
+        self.assertEqual(lines[1], '[#####     ]     1.21 MiB code [100] (4 processes)', error)
+        self.assertTrue(lines[4].endswith('     node [103]'), error)
+
+
+class TestPressure(unittest.TestCase):
+    "--pressure reads vmstat and PSI once per sample and turns counters into rates"
+
+    vmstat = ('pgfault 5000\npgmajfault 10\npswpin 0\npswpout 4\nallocstall_normal 2\nallocstall_movable 1\n'
+              'pgscan_kswapd 100\npgscan_direct 20\npgscan_anon 120\nworkingset_refault_file 7\noom_kill 0\n')
+    psi = 'some avg10=12.50 avg60=3.00 avg300=0.50 total=2000000\nfull avg10=1.00 avg60=0.20 avg300=0.00 total=500000\n'
+
+    def setUp(self):
+        self.filename = 'assignment2.py'
+        self.pypath = sys.executable
+        error_output = f'{self.filename} cannot be found (HINT: make sure this script AND your file are in the same directory)'
+        file = os.path.join(os.getcwd(), self.filename)
+        self.assertTrue(os.path.exists(file), msg=error_output)
+        try:
+            self.a2 = import_module(self.filename.split('.')[0])
+        except ModuleNotFoundError:
+            print("Cannot find a function inside your assignment2.py. Do not rename or delete any of the required functions.")
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        os.mkdir(os.path.join(self.root, 'pressure'))
+        for name, text in (('vmstat', self.vmstat), ('pressure/memory', self.psi), ('uptime', '100.00 150.00\n')):
+            with open(os.path.join(self.root, name), 'w') as f:
+                f.write(text)
+
+    def test_rates(self):
+        error = 'ERROR: pressure_rates() should give per second rates since boot, or between two samples'
+        sample = self.a2.read_pressure(self.a2.ProcSource(self.root))
+        self.assertEqual((sample.vmstat['pgscan'], sample.vmstat['allocstall'], sample.vmstat['refault']), (120, 3, 7), error)
+        self.assertEqual(sample.psi['some']['avg10'], 12.5, error)
+        rates = self.a2.pressure_rates(sample)
+        self.assertEqual((rates['pgfault'], rates['psi.some']), (50.0, 0.02), error)
+        later = self.a2.PressureSample(sample.when + 2, 102.0, {**sample.vmstat, 'pgmajfault': 30}, {'some': {'total': 3000000}})
+        rates = self.a2.pressure_rates(later, sample)
+        self.assertEqual((rates['pgmajfault'], rates['pgfault'], rates['psi.some']), (10.0, 0.0, 0.5), error)
+        self.assertEqual(self.a2.rate_graph(0, 6), '      ', error)
+        self.assertEqual(self.a2.rate_graph(1e6, 6), '######', error)
+
+    def test_report(self):
+        error = 'ERROR: pressure_report() should draw swap, page cache and PSI bars, and history_metrics() include them'
+        meminfo = self.a2.MemInfo({'MemTotal': 1000, 'MemAvailable': 500, 'SwapTotal': 200, 'SwapFree': 50, 'SwapCached': 5,
+                                   'Cached': 240, 'Buffers': 10, 'Shmem': 20, 'Dirty': 4, 'Writeback': 1})
+        sample = self.a2.read_pressure(self.a2.ProcSource(self.root))
+        rates = self.a2.pressure_rates(sample)
+        lines = self.a2.pressure_report(meminfo, sample, rates, True, 4)
+        self.assertIn('Swap used              [### ]       150 kB of 200 kB (5 kB cached)', lines, error)
+        self.assertTrue(any(line.startswith('Page cache             [#   ]') for line in lines), error)
+        self.assertTrue(any(line.startswith('some ') and 'avg10  12.50' in line for line in lines), error)
+        metrics = self.a2.history_metrics(meminfo, pressure=(sample, rates))
+        self.assertEqual((metrics['swap.used'], metrics['psi.some.avg10'], metrics['rate.pgfault']), (150, 12.5, 50.0), error)
+
+    def test_records(self):
+        error = 'ERROR: RecordWriter.pressure() should write PSI stall time as psi.<kind>.stalled in %, and only VM events as rate.<event>'
+        meminfo = self.a2.MemInfo({'MemTotal': 1000, 'MemAvailable': 500, 'SwapTotal': 200, 'SwapFree': 50})
+        sample = self.a2.read_pressure(self.a2.ProcSource(self.root))
+        out = io.StringIO()
+        self.a2.RecordWriter('ndjson', out).pressure(meminfo, sample, self.a2.pressure_rates(sample), 1.5)
+        values = {r['name']: r.get('value', r.get('kb')) for r in map(json.loads, out.getvalue().splitlines())}
+        self.assertEqual((values['psi.some.avg10'], values['psi.some.stalled'], values['rate.pgfault']), (12.5, 2.0, 50.0), error)
+        self.assertFalse([name for name in values if name.startswith('rate.psi')], error)
+        self.assertEqual(self.a2.metric_unit('psi.some.stalled'), '%', error)
+
+    def test_units(self):
+        error = 'ERROR: PSI and rate metrics should keep their own unit and scale in history_report() and alert rules'
+        history = self.a2.HistoryStore(10)
+        now = time.time()
+        history.record(now, {'system.used': 500, 'psi.some.avg10': 50.0, 'rate.pgfault': 1e6})
+        lines = self.a2.history_report(history, ['system.used', 'psi.some.avg10', 'rate.pgfault'], 60, 1000, 4)
+        self.assertIn('psi.some.avg10 min [##  ]       50.00%  (1 samples)', lines, error)
+        self.assertIn('rate.pgfault   min [####]  1000000.0/s  (1 samples)', lines, error)
+        self.assertIn('system.used    min [##  ]       500 kB  (1 samples)', lines, error)
+        rule = self.a2.AlertRule('psi.some.avg10 > 10%')
+        self.assertEqual(rule.value(history, now, 1000), 50.0, error)
+        for text in ('rate.pgfault > 10%', 'psi.some.avg10 > 1MiB', 'rate.pgfault > 5kB'):
+            with self.assertRaises(ValueError, msg=error):
+                self.a2.AlertRule(text)
+        self.assertEqual(self.a2.AlertRule('rate.pgfault > 5000').value(history, now, 1000), 1e6, error)
+
+
+class TestCgroups(unittest.TestCase):
+    "cgroup v2 limits replace host MemTotal, and groups are read from their own counters"
+
+    def setUp(self):
+        self.filename = 'assignment2.py'
+        self.pypath = sys.executable
+        error_output = f'{self.filename} cannot be found (HINT: make sure this script AND your file are in the same directory)'
+        file = os.path.join(os.getcwd(), self.filename)
+        self.assertTrue(os.path.exists(file), msg=error_output)
+        try:
+            self.a2 = import_module(self.filename.split('.')[0])
+        except ModuleNotFoundError:
+            print("Cannot find a function inside your assignment2.py. Do not rename or delete any of the required functions.")
+
+    def make_cgroups(self, groups: dict) -> str:
+        "write a fake cgroup v2 tree, groups maps a path to (memory.current, memory.max) in bytes"
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        for path, (current, limit) in groups.items():
+            group = os.path.join(root, path.strip('/'))
+            os.makedirs(group, exist_ok=True)
+            for name, text in (('memory.current', f'{current}\n'), ('memory.max', f'{limit}\n'),
+                               ('memory.stat', 'anon 104857600\ninactive_file 52428800\npgfault 1234\n')):
+                with open(os.path.join(group, name), 'w') as f:
+                    f.write(text)
+        return root
+
+    def test_container_meminfo(self):
+        error = 'ERROR: CgroupMem.meminfo() should use memory.max as MemTotal and count inactive_file as available'
+        root = self.make_cgroups({'/docker/abc': (400 * 1024 * 1024, 1024 * 1024 * 1024)})
+        proc = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, proc)
+        os.mkdir(os.path.join(proc, 'self'))
+        with open(os.path.join(proc, 'self', 'cgroup'), 'w') as f:
+            f.write('0::/docker/abc\n')
+        path = self.a2.cgroup_of_pid('self', self.a2.ProcSource(proc))
+        self.assertEqual(path, '/docker/abc', error)
+        group = self.a2.read_cgroup(path, self.a2.ProcSource(root))
+        self.assertEqual((group.current, group.limit, group.stat['pgfault']), (409600, 1048576, 1234), error)
+        host = self.a2.MemInfo({'MemTotal': 16 * 1048576, 'MemAvailable': 8 * 1048576, 'SwapTotal': 0})
+        meminfo = group.meminfo(host)
+        self.assertEqual((meminfo.total, meminfo.available, meminfo['SwapTotal']), (1048576, 1048576 - 409600 + 51200, 0), error)
+
+    def test_cgroup_tree(self):
+        error = 'ERROR: cgroup_tree() should read each group down to depth, parents first, without a limit for "max"'
+        root = self.make_cgroups({'/system.slice': (2048, 'max'), '/system.slice/nginx.service': (1024, 4096),
+                                  '/system.slice/nginx.service/deep': (512, 'max'), '/user.slice': (4096, 'max')})
+        groups = self.a2.cgroup_tree(self.a2.ProcSource(root), '/', 2)
+        self.assertEqual([(g.path, g.current, g.limit) for g in groups],
+                         [('/system.slice', 2, None), ('/system.slice/nginx.service', 1, 4), ('/user.slice', 4, None)], error)
+        lines = self.a2.cgroup_report(groups, 8, length=4)
+        self.assertIn('[#   ]', lines[2], error)
+        self.assertTrue(lines[2].endswith('    nginx.service'), error)
+
+    def test_record_and_replay(self):
+        error = 'ERROR: cgroup files and directory listings should be saved with --record and read back by --replay'
+        root = self.make_cgroups({'/docker/abc': (400 * 1024 * 1024, 1024 * 1024 * 1024), '/user.slice': (4096, 'max')})
+        proc = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, proc)
+        recorder = self.a2.RecordingSource(proc)
+        cgroups = recorder.attach('cgroups', self.a2.RecordingSource(root))
+        live = [(g.path, g.current, g.limit) for g in self.a2.cgroup_tree(cgroups, '/', 2)]
+        snapshot = os.path.join(proc, 'snap.json')
+        recorder.save(snapshot)
+        replayed = self.a2.RecordedSource(snapshot).attached('cgroups')
+        self.assertEqual([(g.path, g.current, g.limit) for g in self.a2.cgroup_tree(replayed, '/', 2)], live, error)
+        self.assertEqual(len(live), 2, error)
+        self.assertIsNone(self.a2.read_cgroup('/docker/abc', self.a2.RecordedSource(snapshot).attached('missing'), quiet=True), error)
+
+
+class TestLeaks(unittest.TestCase):
+    "a running regression line per process flags steady growth, and the mappings that grew are diffed"
+
+    def setUp(self):
+        self.filename = 'assignment2.py'
+        self.pypath = sys.executable
+        error_output = f'{self.filename} cannot be found (HINT: make sure this script AND your file are in the same directory)'
+        file = os.path.join(os.getcwd(), self.filename)
+        self.assertTrue(os.path.exists(file), msg=error_output)
+        try:
+            self.a2 = import_module(self.filename.split('.')[0])
+        except ModuleNotFoundError:
+            print("Cannot find a function inside your assignment2.py. Do not rename or delete any of the required functions.")
+
+    def test_trend(self):
+        error = 'ERROR: Trend should give the least squares slope and fit of its samples without keeping them'
+        trend = self.a2.Trend()
+        for t in range(10):
+            trend.add(1e6 + t * 2, 5000 + 3 * t * 2 + (1 if t % 2 else -1)) # 3 kB/s with a little noise, late in uptime
+        self.assertAlmostEqual(trend.slope, 3.0303, 3, error)
+        self.assertGreater(trend.r2, 0.99, error)
+        self.assertEqual((trend.n, trend.last), (10, 5055), error)
+        flat = self.a2.Trend()
+        for t in range(10):
+            flat.add(t, 5000)
+        self.assertEqual((flat.slope, flat.r2), (0.0, 0.0), error)
+
+    def test_leaking(self):
+        error = 'ERROR: leaking() should only flag processes watched long enough that grow fast along a straight line'
+        meta = self.a2.MetaCache(limit=10)
+        for pid in ('10', '20', '30', '40'):
+            meta.entries[pid] = self.a2.ProcessMeta(1)
+        for t in range(12):
+            self.a2.update_trends({'10': 1000 + 10 * t, '20': 1000 + t // 10, '30': 1000 + (400 if t % 2 else 0) + 10 * t,
+                                   '40': self.a2.SmapsTotals(rss=900, pss=800 + 20 * t)}, meta, float(t))
+        meta.entries['40'].unreadable = True
+        found = self.a2.leaking(['10', '20', '30', '40', '50'], meta, min_rate=3600, min_samples=10)
+        self.assertEqual([pid for pid, trend in found], ['10'], error) # 20 is too slow, 30 too noisy, 40 unreadable, 50 unknown
+        self.assertEqual(self.a2.leaking(['10'], meta, min_rate=3600, min_samples=20), [], error)
+        self.assertAlmostEqual(meta.entries['40'].trend.slope, 20.0, 6, error)
+
+    def test_growth_that_stopped(self):
+        error = 'ERROR: Trend should weigh older samples less, so a process that stopped growing is no longer flagged'
+        meta = self.a2.MetaCache(limit=10)
+        meta.entries['10'] = self.a2.ProcessMeta(1)
+        steady = self.a2.Trend(half_life=1e12) # the same samples with (practically) no decay, one line over the whole life
+        for t in range(320):
+            kb = 1000 + 10 * min(t, 200) # 10 kB/s for 200 frames, then flat for 120
+            self.a2.update_trends({'10': kb}, meta, float(t), half_life=30)
+            steady.add(float(t), kb)
+        self.assertGreater(steady.r2, self.a2.LEAK_MIN_R2, error)
+        self.assertLess(meta.entries['10'].trend.r2, self.a2.LEAK_MIN_R2, error)
+        self.assertEqual(self.a2.leaking(['10'], meta, min_rate=3600), [], error)
+        for t in range(320, 420):
+            self.a2.update_trends({'10': 3000 + 10 * (t - 320)}, meta, float(t), half_life=30) # and growing again
+        self.assertEqual([pid for pid, trend in self.a2.leaking(['10'], meta, min_rate=3600)], ['10'], error)
+
+    def test_mapping_growth(self):
+        error = 'ERROR: mapping_growth() should list the mappings that grew the most, largest first'
+        before = {'[heap]': 1000, 'libc.so.6': 2000, '[anon]': 500}
+        after = {'[heap]': 9000, 'libc.so.6': 2000, '[anon]': 400, '/dev/shm/cache': 300}
+        self.assertEqual(self.a2.mapping_growth(before, after), [('[heap]', 8000), ('/dev/shm/cache', 300)], error)
+        self.assertEqual(self.a2.mapping_growth(before, after, 1), [('[heap]', 8000)], error)
+
+
 if __name__ == "__main__":
     unittest.main(buffer=True)
\ No newline at end of file